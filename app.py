@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import cachetools
 import flask
 from flask.typing import ResponseReturnValue as RRV
 import json
@@ -8,15 +9,16 @@ import mwapi  # type: ignore
 import mwoauth  # type: ignore
 import random
 import re
-import requests
-import requests_oauthlib  # type: ignore
+import secrets
 import string
 import sys
+import threading
+import time
 import toolforge
 from toolforge_i18n import ToolforgeI18n, \
     interface_language_code_from_request, lang_autonym, message
 from typing import Container, Dict, \
-    Iterable, List, Optional, Tuple
+    Iterable, List, Mapping, Optional, Set, Tuple
 import werkzeug
 import yaml
 
@@ -25,6 +27,14 @@ from converters import EntityIdConverter, PropertyIdConverter, \
     WikiWithoutQueryServiceException
 from query_service import query_wiki, \
     query_service_id, query_service_url
+import cassette
+import entitycache
+import jsonstream
+import metrics
+import servertiming
+import sessions
+import sharedcache
+import tracing
 import wbformat
 
 
@@ -65,6 +75,29 @@ else:
         random_string = ''.join(random.choice(characters) for _ in range(64))
         app.secret_key = random_string
 
+sessions.pool_size = app.config.get('API_POOL_SIZE', sessions.pool_size)
+shared_format_cache = sharedcache.from_config(app.config)
+for format_cache, maxbytes_key in [
+        (wbformat.format_value_cache, 'FORMAT_VALUE_CACHE_BYTES'),
+        (wbformat.format_entity_cache, 'FORMAT_ENTITY_CACHE_BYTES'),
+]:
+    format_cache.shared_cache = shared_format_cache
+    format_cache.max_stale = app.config.get('FORMAT_CACHE_MAX_STALE', 0)
+    format_cache.maxbytes = app.config.get(maxbytes_key,
+                                           format_cache.maxbytes)
+    format_cache.wiki_maxbytes = app.config.get('FORMAT_CACHE_WIKI_BYTES',
+                                                {})
+wbformat.label_store.shared_cache = shared_format_cache
+wbformat.label_store.maxbytes = app.config.get('LABEL_STORE_BYTES',
+                                               wbformat.label_store.maxbytes)
+entitycache.entity_cache.shared_cache = shared_format_cache
+entitycache.entity_cache.maxbytes = app.config.get(
+    'ENTITY_CACHE_BYTES',
+    entitycache.entity_cache.maxbytes)
+tracing.exporter = tracing.from_config(app.config)
+if 'RECORD_CASSETTE' in app.config:
+    cassette.install(cassette.Recorder(app.config['RECORD_CASSETTE']))
+
 
 app.url_map.converters['eid'] = EntityIdConverter
 app.url_map.converters['pid'] = PropertyIdConverter
@@ -104,18 +137,14 @@ def authentication_area() -> Markup:
     if 'OAUTH' not in app.config:
         return Markup()
 
-    session = authenticated_session('www.wikidata.org')
-    if session is None:
+    user_name = logged_in_user_name()
+    if user_name is None:
         return (Markup(r'<a id="login" class="nav-link" href="') +
                 Markup.escape(flask.url_for('login')) +
                 Markup(r'">') +
                 message('nav-login') +
                 Markup(r'</a>'))
 
-    userinfo = session.get(action='query',
-                           meta='userinfo')['query']['userinfo']
-
-    user_name = userinfo['name']
     logged_in_message = message('nav-logged-in',
                                 user_name=user_name,
                                 user_link=user_link(user_name))
@@ -124,6 +153,24 @@ def authentication_area() -> Markup:
             Markup(r'</span>'))
 
 
+def logged_in_user_name() -> Optional[str]:
+    """Get the name of the logged-in user, or None if not logged in.
+
+    The name is looked up once and then remembered in the session,
+    until the user logs out or logs in again."""
+    session = authenticated_session('www.wikidata.org')
+    if session is None:
+        return None
+    if 'user_name' in flask.session:
+        return flask.session['user_name']
+
+    userinfo = session.get(action='query',
+                           meta='userinfo')['query']['userinfo']
+    user_name = userinfo['name']
+    flask.session['user_name'] = user_name
+    return user_name
+
+
 @app.template_global()
 def can_edit() -> bool:
     if 'OAUTH' not in app.config:
@@ -167,15 +214,18 @@ def batch_query_individual_message(wiki: str) -> Markup:
     return message(message_key, url=query_service_url(wiki))
 
 
+reason_wikis = {
+    'www.wikidata.org': 'www.wikidata.org',
+    'commons.wikimedia.org': 'www.wikidata.org',
+    'test.wikidata.org': 'test.wikidata.org',
+    'test-commons.wikimedia.org': 'test.wikidata.org',
+}
+
+
 @app.template_filter()
 def wiki_reason_wiki(wiki: str) -> str:
     """The wiki which contains the deprecation reasons for the given wiki."""
-    return {
-        'www.wikidata.org': 'www.wikidata.org',
-        'commons.wikimedia.org': 'www.wikidata.org',
-        'test.wikidata.org': 'test.wikidata.org',
-        'test-commons.wikimedia.org': 'test.wikidata.org',
-    }[wiki]
+    return reason_wikis[wiki]
 
 
 @app.template_filter()
@@ -227,9 +277,40 @@ def prefetch_entities(wiki: str, entity_ids: list[str]) -> None:
                                entity_ids)
 
 
+def prewarm_format_caches(languages: List[str]) -> None:
+    """Format the reason items and properties in the given languages.
+
+    These are rendered on every edit and batch form,
+    so we format them ahead of the first request for each language."""
+    for wiki in sorted(set(reason_wikis.values())):
+        entity_ids = wiki_reasons_preferred(wiki) + \
+            wiki_reasons_deprecated(wiki)
+        for property_id in [wiki_reason_preferred_property(wiki),
+                            wiki_reason_deprecated_property(wiki)]:
+            if property_id is not None:
+                entity_ids.append(property_id)
+        if not entity_ids:
+            continue
+        wbformat.refresh_entities(anonymous_session(wiki),
+                                  languages,
+                                  entity_ids)
+
+
+def prewarm_format_caches_forever(languages: List[str]) -> None:
+    """Prewarm the format caches, and refresh them before they expire.
+
+    Errors are only logged, so that the next cycle tries again."""
+    while True:
+        try:
+            prewarm_format_caches(languages)
+        except Exception as e:
+            print('caught error while prewarming format caches:', e,
+                  file=sys.stderr)
+        time.sleep(wbformat.format_entity_cache.ttl * 0.9)
+
+
 def anonymous_session(wiki: str) -> mwapi.Session:
-    return mwapi.Session('https://' + wiki,
-                         user_agent=user_agent)
+    return sessions.anonymous_session(wiki, user_agent)
 
 
 def authenticated_session(wiki: str) -> Optional[mwapi.Session]:
@@ -238,13 +319,11 @@ def authenticated_session(wiki: str) -> Optional[mwapi.Session]:
 
     access_token = mwoauth.AccessToken(
         **flask.session['oauth_access_token'])
-    auth = requests_oauthlib.OAuth1(client_key=consumer_token.key,
-                                    client_secret=consumer_token.secret,
-                                    resource_owner_key=access_token.key,
-                                    resource_owner_secret=access_token.secret)
-    return mwapi.Session(host='https://' + wiki,
-                         auth=auth,
-                         user_agent=user_agent)
+    with servertiming.timed('oauth-session'):
+        return sessions.authenticated_session(wiki,
+                                              user_agent,
+                                              consumer_token,
+                                              access_token)
 
 
 @app.route('/')
@@ -305,13 +384,16 @@ def redirect_batch_query_individual() -> RRV:
 @app.route('/edit/<wiki:wiki>/<eid:entity_id>/<pid:property_id>/')
 def show_edit_form(wiki: str, entity_id: str, property_id: str) -> RRV:
     session = anonymous_session(wiki)
-    entity = get_entities(session, [entity_id])[entity_id]
+    entity = get_property_entity(session, entity_id, property_id)
     if 'missing' in entity:
         return flask.render_template('no-such-entity.html',
                                      wiki=wiki,
                                      entity_id=entity_id), 404
     base_revision_id = entity['lastrevid']
     statements = entity_statements(entity).get(property_id, [])
+    # the rank edits submitted from the form need the same statements
+    entitycache.entity_cache.put(wiki, entity_id, base_revision_id,
+                                 property_id, statements)
 
     prefetch_entity_ids = {entity_id, property_id}
     for statement in statements:
@@ -319,6 +401,9 @@ def show_edit_form(wiki: str, entity_id: str, property_id: str) -> RRV:
     wbformat.prefetch_entities(session,
                                flask.g.interface_language_code,
                                prefetch_entity_ids)
+    wbformat.prefetch_values(session,
+                             flask.g.interface_language_code,
+                             statements_values(statements))
 
     return flask.render_template('edit.html',
                                  wiki=wiki,
@@ -343,10 +428,10 @@ def edit_set_rank(wiki: str, entity_id: str, property_id: str, rank: str) \
     reason = flask.request.form.get('reason')
     custom_summary = flask.request.form.get('summary')
     base_revision_id = flask.request.form['base_revision_id']
-    response = requests.get(f'https://{wiki}/wiki/Special:EntityData/'
-                            f'{entity_id}.json?revision={base_revision_id}')
-    entity = response.json()['entities'][entity_id]
-    statements = entity_statements(entity).get(property_id, [])
+    statements = get_base_statements(wiki,
+                                     entity_id,
+                                     property_id,
+                                     base_revision_id)
 
     statement_groups, edited_statements = statements_set_rank_to(
         statement_ids,
@@ -386,10 +471,10 @@ def edit_increment_rank(wiki: str, entity_id: str, property_id: str) -> RRV:
     reason = flask.request.form.get('reason')
     custom_summary = flask.request.form.get('summary')
     base_revision_id = flask.request.form['base_revision_id']
-    response = requests.get(f'https://{wiki}/wiki/Special:EntityData/'
-                            f'{entity_id}.json?revision={base_revision_id}')
-    entity = response.json()['entities'][entity_id]
-    statements = entity_statements(entity).get(property_id, [])
+    statements = get_base_statements(wiki,
+                                     entity_id,
+                                     property_id,
+                                     base_revision_id)
 
     statement_groups, edited_statements = statements_increment_rank(
         statement_ids,
@@ -631,13 +716,18 @@ def oauth_callback() -> RRV:
                                                    access_token))
     flask.session.permanent = True
     flask.session.pop('csrf_token', None)
+    flask.session.pop('user_name', None)
     redirect_target = flask.session.pop('oauth_redirect_target', None)
     return flask.redirect(redirect_target or flask.url_for('index'))
 
 
 @app.route('/logout')
 def logout() -> RRV:
-    flask.session.pop('oauth_access_token', None)
+    oauth_access_token = flask.session.pop('oauth_access_token', None)
+    if oauth_access_token is not None:
+        sessions.discard_authenticated_sessions(oauth_access_token['key'])
+        discard_edit_tokens(oauth_access_token['key'])
+    flask.session.pop('user_name', None)
     flask.session.permanent = False
     return flask.redirect(flask.url_for('index'))
 
@@ -647,6 +737,59 @@ def health() -> RRV:
     return ''
 
 
+metrics_interval = 15
+"""How often (in seconds) each worker writes its metrics to METRICS_DIR."""
+
+
+def check_metrics_token() -> None:
+    """Abort the request unless it may see the metrics.
+
+    The metrics endpoints are disabled unless METRICS_TOKEN is configured,
+    and then require it as a bearer token (Authorization header)."""
+    token = app.config.get('METRICS_TOKEN')
+    if not token:
+        flask.abort(404)
+    authorization = flask.request.headers.get('Authorization', '')
+    if not secrets.compare_digest(authorization.encode('utf-8'),
+                                  f'Bearer {token}'.encode('utf-8')):
+        flask.abort(401)
+
+
+@app.route('/metrics')
+def show_metrics() -> RRV:
+    """Show the metrics of all workers (if METRICS_DIR is configured)
+    or just this worker, in the Prometheus text exposition format."""
+    check_metrics_token()
+    if 'METRICS_DIR' in app.config:
+        metrics.write_snapshot(app.config['METRICS_DIR'])
+        snapshot = metrics.merge(metrics.read_snapshots(
+            app.config['METRICS_DIR'],
+            max_age=4 * metrics_interval,
+        ))
+    else:
+        snapshot = metrics.snapshot()
+    return flask.Response(metrics.render(snapshot),
+                          mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/metrics/worker')
+def show_worker_metrics() -> RRV:
+    """Show the metrics of the worker serving this request."""
+    check_metrics_token()
+    return flask.Response(metrics.render(metrics.snapshot()),
+                          mimetype='text/plain; version=0.0.4')
+
+
+def write_metrics_forever(directory: str) -> None:
+    """Periodically write this worker’s metrics for show_metrics()."""
+    while True:
+        try:
+            metrics.write_snapshot(directory)
+        except OSError as e:
+            print('caught error while writing metrics:', e, file=sys.stderr)
+        time.sleep(metrics_interval)
+
+
 def full_url(endpoint: str, **kwargs) -> str:
     scheme = flask.request.headers.get('X-Forwarded-Proto', 'http')
     return flask.url_for(endpoint, _external=True, _scheme=scheme, **kwargs)
@@ -673,6 +816,73 @@ def submitted_request_valid() -> bool:
     return True
 
 
+@app.before_request
+def start_server_timing() -> None:
+    flask.g.server_timing_token = servertiming.start()
+
+
+@app.before_request
+def start_request_span() -> None:
+    """Start the root span of the request, which outbound calls nest under."""
+    flask.g.tracing_token = tracing.start_span(
+        f'{flask.request.method} {flask.request.url_rule or "(no route)"}',
+        'server',
+        **{'http.method': flask.request.method,
+           'http.target': flask.request.path},
+    )
+
+
+@flask.before_render_template.connect_via(app)
+def start_render_timing(sender, **extra) -> None:
+    flask.g.render_start = time.perf_counter()
+
+
+@flask.template_rendered.connect_via(app)
+def stop_render_timing(sender, **extra) -> None:
+    if 'render_start' in flask.g:
+        servertiming.record('render',
+                            time.perf_counter() - flask.g.pop('render_start'))
+
+
+@app.after_request
+def add_server_timing(response: flask.Response) -> flask.Response:
+    """Add a Server-Timing header breaking down the request’s duration
+    (and, if SERVER_TIMING_FOOTER is configured, a footer with the same
+    information at the end of HTML pages)."""
+    timings = servertiming.current()
+    if timings is None:
+        return response
+    server_timing = timings.header()
+    response.headers['Server-Timing'] = server_timing
+    if app.config.get('SERVER_TIMING_FOOTER') \
+       and response.mimetype == 'text/html' \
+       and not response.is_streamed:
+        footer = Markup('<footer class="container mt-3 text-muted small">'
+                        '<code>Server-Timing: {}</code></footer>'
+                        '</body>').format(server_timing)
+        response.set_data(response.get_data(as_text=True)
+                          .replace('</body>', footer, 1))
+    return response
+
+
+@app.teardown_request
+def stop_server_timing(exception: Optional[BaseException]) -> None:
+    if 'server_timing_token' in flask.g:
+        servertiming.stop(flask.g.pop('server_timing_token'))
+
+
+@app.after_request
+def add_status_to_request_span(response: flask.Response) -> flask.Response:
+    tracing.set_attribute('http.status_code', response.status_code)
+    return response
+
+
+@app.teardown_request
+def end_request_span(exception: Optional[BaseException]) -> None:
+    if 'tracing_token' in flask.g:
+        tracing.end_span(flask.g.pop('tracing_token'), exception)
+
+
 @app.after_request
 def deny_frame(response: flask.Response) -> flask.Response:
     """Disallow embedding the tool’s pages in other websites.
@@ -812,28 +1022,191 @@ def query_statement_ids_with_ranks_and_reasons(wiki: str, query: str) \
     return commands_by_entity_id
 
 
-def get_entities(session: mwapi.Session, entity_ids: Iterable[str]) -> dict:
+def entity_spec(property_ids: Optional[Iterable[str]] = None,
+                statement_ids: Optional[Container[str]] = None) \
+        -> Dict[str, jsonstream.Spec]:
+    """A jsonstream spec for the data of an entity, selecting its info
+    and only the given statement groups and statements (default all),
+    so that the rest of large entities is never held in memory."""
+    statements: jsonstream.Spec = True
+    if statement_ids is not None:
+        statements = jsonstream.Items(
+            lambda statement_id: statement_id in statement_ids, key='id')
+    statement_groups: jsonstream.Spec
+    if property_ids is None:
+        statement_groups = {'*': statements}
+    else:
+        statement_groups = {property_id: statements
+                            for property_id in property_ids}
+    return {
+        'type': True,
+        'id': True,
+        'missing': True,
+        'lastrevid': True,
+        'claims': statement_groups,
+        'statements': statement_groups,  # MediaInfo
+    }
+
+
+def all_statement_ids(by_entity_id: Mapping[str, Iterable[str]]) -> Set[str]:
+    """Collect the statement IDs (or commands) of all entities in a batch."""
+    return {statement_id
+            for statement_ids in by_entity_id.values()
+            for statement_id in statement_ids}
+
+
+def get_entities(session: mwapi.Session,
+                 entity_ids: Iterable[str],
+                 statement_ids: Optional[Container[str]] = None) -> dict:
+    """Get the info and statements of the given entities.
+
+    If statement_ids is given, only those statements are kept
+    (the responses are parsed incrementally and other statements skipped)."""
     entity_ids = list(set(entity_ids))
     entities = {}
-    for chunk in [entity_ids[i:i+50] for i in range(0, len(entity_ids), 50)]:
-        response = session.get(action='wbgetentities',
-                               ids=chunk,
-                               props=['info', 'claims'],
-                               formatversion=2)
-        entities.update(response['entities'])
+    spec = {'entities': {'*': entity_spec(statement_ids=statement_ids)}}
+    with tracing.span('get_entities', entities=len(entity_ids)):
+        for chunk in [entity_ids[i:i+50]
+                      for i in range(0, len(entity_ids), 50)]:
+            response = session.get_filtered(spec,
+                                            action='wbgetentities',
+                                            ids=chunk,
+                                            props=['info', 'claims'],
+                                            formatversion=2)
+            entities.update(response['entities'])
     return entities
 
 
+def get_property_entity(session: mwapi.Session,
+                        entity_id: str,
+                        property_id: str) -> dict:
+    """Get the page info (e.g. lastrevid, or missing) of the given entity
+    and its current statements for the given property, in one request.
+
+    The response is parsed incrementally,
+    skipping the statements of other properties."""
+    with tracing.span('get_property_entity',
+                      entity=entity_id, property=property_id):
+        response = session.get_filtered(
+            {'entities': {entity_id: entity_spec(property_ids=[property_id])}},
+            action='wbgetentities',
+            ids=[entity_id],
+            props=['info', 'claims'],
+            formatversion=2,
+        )
+    return response['entities'][entity_id]
+
+
+def get_entity_data(wiki: str,
+                    entity_id: str,
+                    revision_id: int | str,
+                    property_id: str) -> dict:
+    """Get the data of the given entity as of the given revision,
+    with only the statements for the given property."""
+    with tracing.span('entity-data', 'client',
+                      wiki=wiki, entity=entity_id, revision=revision_id):
+        session = sessions.requests_session(wiki)
+        response = session.request('GET',
+                                   f'https://{wiki}/wiki/Special:EntityData/'
+                                   f'{entity_id}.json?revision={revision_id}',
+                                   stream=True,
+                                   read_body=False)
+        data = sessions.filtered_json(response, {'entities': {
+            entity_id: entity_spec(property_ids=[property_id]),
+        }})
+        return data['entities'][entity_id]
+
+
+def get_base_statements(wiki: str,
+                        entity_id: str,
+                        property_id: str,
+                        revision_id: int | str) -> List[dict]:
+    """Get the statements of the given entity for the given property
+    as of the given (base) revision.
+
+    The statements are usually cached already by the edit form.
+    Otherwise, the latest revision is fetched with them in one request,
+    and only if the entity was edited since the given revision,
+    the statements are fetched again as of that revision."""
+    statements = entitycache.entity_cache.get(wiki,
+                                              entity_id,
+                                              revision_id,
+                                              property_id)
+    if statements is not None:
+        return statements
+    session = anonymous_session(wiki)
+    entity = get_property_entity(session, entity_id, property_id)
+    if str(entity.get('lastrevid')) != str(revision_id):
+        entity = get_entity_data(wiki, entity_id, revision_id, property_id)
+    statements = entity_statements(entity).get(property_id, [])
+    entitycache.entity_cache.put(wiki, entity_id, revision_id,
+                                 property_id, statements)
+    return statements
+
+
 def entity_statements(entity: dict) -> Dict[str, List[dict]]:
     if entity.get('type') == 'mediainfo':  # optional due to T272804
         statements = entity['statements']
-        if statements == []:
-            statements = {}  # work around T222159
     else:
         statements = entity['claims']
+    if statements == []:
+        statements = {}  # work around T222159
     return statements
 
 
+def statements_values(statements: List[dict]) -> List[Tuple[str, dict]]:
+    """Get the (property ID, data value) pairs of the main snaks
+    and qualifiers of the given statements, for formatting."""
+    values = []
+    for statement in statements:
+        snaks = [statement['mainsnak']]
+        for qualifier_snaks in statement.get('qualifiers', {}).values():
+            snaks.extend(qualifier_snaks)
+        for snak in snaks:
+            if snak['snaktype'] == 'value':
+                values.append((snak['property'], snak['datavalue']))
+    return values
+
+
+StatementIndex = Dict[str, Tuple[int, str, int]]
+
+
+def statement_index(statements: Dict[str, List[dict]]) -> StatementIndex:
+    """Map the ID of each statement to its position among all statements,
+    its property ID and its position in that statement group,
+    so that statements can be found without scanning the whole entity."""
+    index: StatementIndex = {}
+    for property_id, statement_group in statements.items():
+        for position, statement in enumerate(statement_group):
+            index[statement['id']] = (len(index), property_id, position)
+    return index
+
+
+def indexed_statements(statement_ids: Iterable[str],
+                       statements: Dict[str, List[dict]],
+                       index: Optional[StatementIndex]) \
+        -> List[Tuple[str, dict]]:
+    """Get the (property ID, statement) pairs of the given statement IDs,
+    in the order of the statements and each statement only once,
+    skipping IDs that are not among the statements.
+
+    index is the statement_index() of the statements, which makes this
+    independent of the size of the entity; if it is None, the statements
+    are scanned instead (cheaper than building the index for one lookup,
+    so only build it where one entity serves many lookups)."""
+    if index is None:
+        statement_ids = set(statement_ids)
+        return [(property_id, statement)
+                for property_id, statement_group in statements.items()
+                for statement in statement_group
+                if statement['id'] in statement_ids]
+    positions = sorted({index[statement_id]
+                        for statement_id in statement_ids
+                        if statement_id in index})
+    return [(property_id, statements[property_id][position])
+            for _ordinal, property_id, position in positions]
+
+
 def increment_rank(rank: str) -> str:
     return {
         'deprecated': 'normal',
@@ -842,79 +1215,85 @@ def increment_rank(rank: str) -> str:
     }[rank]
 
 
-def statements_set_rank_to(statement_ids: Container[str],
+def statements_set_rank_to(statement_ids: Iterable[str],
                            rank: str,
                            statements: Dict[str, List[dict]],
                            wiki: str,
-                           reason: Optional[str]) \
+                           reason: Optional[str],
+                           index: Optional[StatementIndex] = None) \
         -> Tuple[Dict[str, List[dict]], int]:
     """Set the rank of certain statements to a constant value.
 
-    statement_ids is a container (e.g. a set) of statement IDs,
+    statement_ids is an iterable (e.g. a set) of statement IDs,
     controlling which of the given statements are actually edited.
     rank is the target rank,
     and statements is a mapping from property IDs to statement groups.
     wiki specifies the wiki the statements belong to,
     and reason is an optional reason for preferred or deprecated rank
     (an exception is raised if a reason is given for normal rank).
+    index is the statement_index() of the statements, if already built.
 
     Returns a dict of statement groups of edited statements
     (though the lists in the statements parameter are also edited in-place),
     and the number of edited statements."""
     edited_statement_groups: Dict[str, List[dict]] = {}
     edited_statements = 0
-    for property_id, statement_group in statements.items():
-        for statement in statement_group:
-            if statement['id'] in statement_ids and statement['rank'] != rank:
-                statement['rank'] = rank
-                statement_remove_reasons(statement, wiki)
-                statement_set_reason(statement, rank, wiki, reason)
-                edited_statement_groups.setdefault(property_id, [])\
-                                       .append(statement)
-                edited_statements += 1
+    for property_id, statement in indexed_statements(statement_ids,
+                                                     statements,
+                                                     index):
+        if statement['rank'] != rank:
+            statement['rank'] = rank
+            statement_remove_reasons(statement, wiki)
+            statement_set_reason(statement, rank, wiki, reason)
+            edited_statement_groups.setdefault(property_id, [])\
+                                   .append(statement)
+            edited_statements += 1
     return edited_statement_groups, edited_statements
 
 
-def statements_increment_rank(statement_ids: Container[str],
+def statements_increment_rank(statement_ids: Iterable[str],
                               statements: Dict[str, List[dict]],
                               wiki: str,
-                              reason: Optional[str]) \
+                              reason: Optional[str],
+                              index: Optional[StatementIndex] = None) \
         -> Tuple[Dict[str, List[dict]], int]:
     """Increment the rank of certain statements.
 
-    statement_ids is a container (e.g. a set) of statement IDs,
+    statement_ids is an iterable (e.g. a set) of statement IDs,
     controlling which of the given statements are actually edited.
     statements is a mapping from property IDs to statement groups.
     wiki specifies the wiki the statements belong to.
     reason is mainly included for consistency with statements_set_rank_to,
     an exception is raised whenever it is specified.
+    index is the statement_index() of the statements, if already built.
 
     Returns a dict of statement groups of edited statements
     (though the lists in the statements parameter are also edited in-place),
     and the number of edited statements."""
     edited_statement_groups: Dict[str, List[dict]] = {}
     edited_statements = 0
-    for property_id, statement_group in statements.items():
-        for statement in statement_group:
-            if statement['id'] in statement_ids:
-                rank = statement['rank']
-                incremented_rank = increment_rank(rank)
-                if incremented_rank != rank:
-                    statement['rank'] = incremented_rank
-                    statement_remove_reasons(statement, wiki)
-                    if reason:
-                        description = ('Specifying a reason when incrementing '
-                                       'rank is not supported')
-                        flask.abort(400, description=description)
-                    edited_statement_groups.setdefault(property_id, [])\
-                                           .append(statement)
-                    edited_statements += 1
+    for property_id, statement in indexed_statements(statement_ids,
+                                                     statements,
+                                                     index):
+        rank = statement['rank']
+        incremented_rank = increment_rank(rank)
+        if incremented_rank != rank:
+            statement['rank'] = incremented_rank
+            statement_remove_reasons(statement, wiki)
+            if reason:
+                description = ('Specifying a reason when incrementing '
+                               'rank is not supported')
+                flask.abort(400, description=description)
+            edited_statement_groups.setdefault(property_id, [])\
+                                   .append(statement)
+            edited_statements += 1
     return edited_statement_groups, edited_statements
 
 
 def statements_edit_rank(commands: Dict[str, Tuple[str, str]],
                          statements: Dict[str, List[dict]],
-                         wiki: str) \
+                         wiki: str,
+                         index: Optional[StatementIndex] = None) \
         -> Tuple[Dict[str, List[dict]], int]:
     """Edit the rank of certain statements.
 
@@ -922,22 +1301,25 @@ def statements_edit_rank(commands: Dict[str, Tuple[str, str]],
     the rank they should have and the reason for it (optional, may be empty).
     statements is a mapping from property IDs to statement groups.
     wiki specifies the wiki the statements belong to.
+    index is the statement_index() of the statements, if already built.
 
-    Returns the edited statements in the same format
-    (in fact, it returns unedited statements too,
-    though I don’t remember if this is intentional or not),
+    Returns a dict of statement groups of edited statements
+    (though the lists in the statements parameter are also edited in-place),
     and the number of edited statements."""
+    edited_statement_groups: Dict[str, List[dict]] = {}
     edited_statements = 0
-    for statement_group in statements.values():
-        for statement in statement_group:
-            if statement['id'] in commands:
-                rank, reason = commands[statement['id']]
-                if rank != statement['rank']:
-                    statement['rank'] = rank
-                    statement_remove_reasons(statement, wiki)
-                    statement_set_reason(statement, rank, wiki, reason)
-                    edited_statements += 1
-    return statements, edited_statements
+    for property_id, statement in indexed_statements(commands,
+                                                     statements,
+                                                     index):
+        rank, reason = commands[statement['id']]
+        if rank != statement['rank']:
+            statement['rank'] = rank
+            statement_remove_reasons(statement, wiki)
+            statement_set_reason(statement, rank, wiki, reason)
+            edited_statement_groups.setdefault(property_id, [])\
+                                   .append(statement)
+            edited_statements += 1
+    return edited_statement_groups, edited_statements
 
 
 def statement_remove_reasons(statement: dict, wiki: str):
@@ -1053,22 +1435,47 @@ def wiki_reason_summary_prefix(wiki: str) -> str:
         return ''
 
 
-def edit_token(session: mwapi.Session) -> str:
+edit_token_cache = cachetools.TTLCache(maxsize=1000,  # type: ignore
+                                       ttl=30 * 60)
+edit_token_cache_lock = threading.RLock()
+
+
+def edit_token_key(session: mwapi.Session) -> Tuple[str, str]:
+    return (session.host, flask.session['oauth_access_token']['key'])
+
+
+def edit_token(session: mwapi.Session, refresh: bool = False) -> str:
     """Get an edit token / CSRF token for the MediaWiki API.
 
     Not to be confused with csrf_token,
-    which gets a token for use within the tool."""
+    which gets a token for use within the tool.
+
+    Tokens are cached per user and wiki across requests;
+    specify refresh=True to discard the cached token
+    (e.g. after the API rejected it as a badtoken)."""
+
+    key = edit_token_key(session)
+    with edit_token_cache_lock:
+        if refresh:
+            edit_token_cache.pop(key, None)
+        elif key in edit_token_cache:
+            return edit_token_cache[key]
+
+    with tracing.span('edit_token', refresh=refresh):
+        token = session.get(action='query',
+                            meta='tokens',
+                            type='csrf')['query']['tokens']['csrftoken']
+    with edit_token_cache_lock:
+        edit_token_cache[key] = token
+    return token
 
-    edit_tokens = flask.g.setdefault('edit_tokens', {})
-    key = session.host
-    if key in edit_tokens:
-        return edit_tokens[key]
 
-    token = session.get(action='query',
-                        meta='tokens',
-                        type='csrf')['query']['tokens']['csrftoken']
-    edit_tokens[key] = token
-    return token
+def discard_edit_tokens(access_token_key: str) -> None:
+    """Discard all cached edit tokens of the user with the given token."""
+    with edit_token_cache_lock:
+        for key in list(edit_token_cache.keys()):
+            if key[1] == access_token_key:
+                del edit_token_cache[key]
 
 
 def save_entity(entity_data: dict,
@@ -1076,15 +1483,24 @@ def save_entity(entity_data: dict,
                 base_revision_id: int | str,
                 session: mwapi.Session) -> int:
 
-    token = edit_token(session)
+    def post(token: str) -> dict:
+        return session.post(action='wbeditentity',
+                            id=entity_data['id'],
+                            data=json.dumps(entity_data),
+                            summary=summary,
+                            baserevid=base_revision_id,
+                            token=token,
+                            formatversion=2)
 
-    api_response = session.post(action='wbeditentity',
-                                id=entity_data['id'],
-                                data=json.dumps(entity_data),
-                                summary=summary,
-                                baserevid=base_revision_id,
-                                token=token,
-                                formatversion=2)
+    with tracing.span('save_entity', entity=entity_data['id']):
+        try:
+            api_response = post(edit_token(session))
+        except mwapi.errors.APIError as e:
+            if e.code != 'badtoken':
+                raise
+            # the cached token expired, retry once with a fresh one
+            tracing.set_attribute('retry', 'badtoken')
+            api_response = post(edit_token(session, refresh=True))
     if api_response['entity'].get('nochange', False):
         print('WARNING: The API returned that no change was made,',
               'so save_entity() should not have been called;',
@@ -1133,7 +1549,9 @@ def batch_set_rank_and_show_results(
         session: mwapi.Session,
         custom_summary: Optional[str],
 ) -> str:
-    entities = get_entities(session, statement_ids_by_entity_id.keys())
+    entities = get_entities(session,
+                            statement_ids_by_entity_id.keys(),
+                            all_statement_ids(statement_ids_by_entity_id))
     edits = {}
     noops = {}
     errors = {}
@@ -1142,7 +1560,7 @@ def batch_set_rank_and_show_results(
         entity = entities[entity_id]
         base_revision_id = entity['lastrevid']
         statements = entity_statements(entity)
-        statements, edited_statements = statements_set_rank_to(
+        statement_groups, edited_statements = statements_set_rank_to(
             statement_ids,
             rank,
             statements,
@@ -1152,7 +1570,7 @@ def batch_set_rank_and_show_results(
         if not edited_statements:
             noops[entity_id] = base_revision_id
             continue
-        edited_entity = build_entity(entity_id, statements)
+        edited_entity = build_entity(entity_id, statement_groups)
         summary = get_summary_set_rank(edited_statements,
                                        rank,
                                        wiki,
@@ -1185,7 +1603,9 @@ def batch_increment_rank_and_show_results(
         session: mwapi.Session,
         custom_summary: Optional[str],
 ) -> str:
-    entities = get_entities(session, statement_ids_by_entity_id.keys())
+    entities = get_entities(session,
+                            statement_ids_by_entity_id.keys(),
+                            all_statement_ids(statement_ids_by_entity_id))
     edits = {}
     noops = {}
     errors = {}
@@ -1194,7 +1614,7 @@ def batch_increment_rank_and_show_results(
         entity = entities[entity_id]
         base_revision_id = entity['lastrevid']
         statements = entity_statements(entity)
-        statements, edited_statements = statements_increment_rank(
+        statement_groups, edited_statements = statements_increment_rank(
             statement_ids,
             statements,
             wiki,
@@ -1203,7 +1623,7 @@ def batch_increment_rank_and_show_results(
         if not edited_statements:
             noops[entity_id] = base_revision_id
             continue
-        edited_entity = build_entity(entity_id, statements)
+        edited_entity = build_entity(entity_id, statement_groups)
         summary = get_summary_increment_rank(edited_statements,
                                              custom_summary)
         try:
@@ -1232,7 +1652,9 @@ def batch_edit_rank_and_show_results(
         session: mwapi.Session,
         custom_summary: Optional[str],
 ) -> str:
-    entities = get_entities(session, commands_by_entity_id.keys())
+    entities = get_entities(session,
+                            commands_by_entity_id.keys(),
+                            all_statement_ids(commands_by_entity_id))
     edits = {}
     noops = {}
     errors = {}
@@ -1241,7 +1663,7 @@ def batch_edit_rank_and_show_results(
         entity = entities[entity_id]
         base_revision_id = entity['lastrevid']
         statements = entity_statements(entity)
-        statements, edited_statements = statements_edit_rank(
+        statement_groups, edited_statements = statements_edit_rank(
             commands,
             statements,
             wiki,
@@ -1249,7 +1671,7 @@ def batch_edit_rank_and_show_results(
         if not edited_statements:
             noops[entity_id] = base_revision_id
             continue
-        edited_entity = build_entity(entity_id, statements)
+        edited_entity = build_entity(entity_id, statement_groups)
         summary = get_summary_edit_rank(edited_statements,
                                         custom_summary)
         try:
@@ -1270,3 +1692,17 @@ def batch_edit_rank_and_show_results(
                                  edits=edits,
                                  noops=noops,
                                  errors=errors)
+
+
+if 'PREWARM_LANGUAGES' in app.config:
+    # no gunicorn --preload, so this runs in each worker after forking
+    threading.Thread(target=prewarm_format_caches_forever,
+                     args=(app.config['PREWARM_LANGUAGES'],),
+                     name='prewarm',
+                     daemon=True).start()
+
+if 'METRICS_DIR' in app.config:
+    threading.Thread(target=write_metrics_forever,
+                     args=(app.config['METRICS_DIR'],),
+                     name='metrics',
+                     daemon=True).start()
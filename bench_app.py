@@ -0,0 +1,389 @@
+"""Benchmarks of the tool’s hot paths against replayed traffic.
+
+Run with `python bench_app.py` to benchmark the edit form,
+the three batch pipelines and the rendering of batch results
+against synthetic fixtures of realistic size (an item with 2000
+statements, batches of 10,000 statements on 500 items),
+replayed from a cassette (see cassette.py) without network access,
+and the statement lookup of the rank edits by entity size.
+Use --latency to inject a delay into each replayed request,
+and --write-cassette to save the fixtures for inspection.
+
+With --cassette, the edit form of --edit ENTITY_ID PROPERTY_ID
+is benchmarked against a cassette recorded with RECORD_CASSETTE instead."""
+
+import argparse
+import flask
+import json
+import statistics
+import time
+from typing import Callable, Dict, Iterator, List, Tuple
+import toolforge_i18n._language_info
+
+import app as ranker
+import cassette
+import wbformat
+
+
+wiki = 'www.wikidata.org'
+api_url = f'https://{wiki}/w/api.php'
+query_url = 'https://query.wikidata.org/sparql'
+
+edit_form_entity_id = 'Q1000000'
+edit_form_property_id = 'P9003'
+batch_entity_ids = [f'Q{3000000 + i}' for i in range(500)]
+batch_statements_per_entity = 20
+
+properties = {
+    'P9001': 'string',
+    'P9002': 'external-id',
+    'P9003': 'wikibase-item',
+    'P9004': 'quantity',
+    'P9005': 'time',
+    'P9006': 'monolingualtext',
+    'P9007': 'url',
+    'P7452': 'wikibase-item',
+    'P2241': 'wikibase-item',
+}
+
+
+def api_entry(method: str, params: Dict[str, str], body: dict) -> dict:
+    return {
+        'method': method,
+        'url': api_url,
+        'params': {**params, 'format': 'json'},
+        'status': 200,
+        'headers': {'Content-Type': 'application/json; charset=utf-8'},
+        'body': json.dumps(body),
+    }
+
+
+def datavalue(property_id: str, i: int) -> dict:
+    datatype = properties[property_id]
+    if datatype == 'wikibase-item':
+        return {'type': 'wikibase-entityid',
+                'value': {'entity-type': 'item',
+                          'numeric-id': 2000000 + i % 1000,
+                          'id': f'Q{2000000 + i % 1000}'}}
+    if datatype == 'quantity':
+        return {'type': 'quantity',
+                'value': {'amount': f'+{i}',
+                          'unit': 'http://www.wikidata.org/entity/Q11573'}}
+    if datatype == 'time':
+        return {'type': 'time',
+                'value': {'time': f'+{1500 + i % 500}-00-00T00:00:00Z',
+                          'timezone': 0, 'before': 0, 'after': 0,
+                          'precision': 9,
+                          'calendarmodel':
+                          'http://www.wikidata.org/entity/Q1985727'}}
+    if datatype == 'monolingualtext':
+        return {'type': 'monolingualtext',
+                'value': {'text': f'text {i}', 'language': 'en'}}
+    if datatype == 'url':
+        return {'type': 'string', 'value': f'https://example.com/{i}'}
+    return {'type': 'string', 'value': f'value {i}'}
+
+
+def snak(property_id: str, i: int) -> dict:
+    return {'snaktype': 'value',
+            'property': property_id,
+            'datatype': properties[property_id],
+            'datavalue': datavalue(property_id, i)}
+
+
+def statement(entity_id: str, property_id: str, i: int) -> dict:
+    return {
+        'id': f'{entity_id}$00000000-0000-0000-0000-{i:012d}',
+        'type': 'statement',
+        'rank': ['normal', 'preferred', 'deprecated'][i % 3],
+        'mainsnak': snak(property_id, i),
+        'qualifiers': {
+            'P9005': [snak('P9005', i)],
+            'P9001': [snak('P9001', i)],
+        },
+        'qualifiers-order': ['P9005', 'P9001'],
+        'references': [],
+    }
+
+
+def item(entity_id: str, statements: List[Tuple[str, int]]) -> dict:
+    claims: Dict[str, List[dict]] = {}
+    for property_id, i in statements:
+        claims.setdefault(property_id, []).append(
+            statement(entity_id, property_id, i))
+    return {'type': 'item',
+            'id': entity_id,
+            'lastrevid': 1000,
+            'claims': claims}
+
+
+def edit_form_item() -> dict:
+    """An item with 2000 statements, 1000 of them on the edited property."""
+    statements = [(edit_form_property_id, i) for i in range(1000)]
+    other_property_ids = [property_id for property_id in properties
+                          if property_id.startswith('P900')
+                          and property_id != edit_form_property_id]
+    statements += [(other_property_ids[i % len(other_property_ids)], i)
+                   for i in range(1000)]
+    return item(edit_form_entity_id, statements)
+
+
+def batch_items() -> List[dict]:
+    """500 items with 40 statements each, half of them in the batches."""
+    return [item(entity_id, [('P9003', i) for i in range(40)])
+            for entity_id in batch_entity_ids]
+
+
+def batch_statement_ids() -> Dict[str, List[str]]:
+    return {entity_id: [f'{entity_id}$00000000-0000-0000-0000-{i:012d}'
+                        for i in range(batch_statements_per_entity)]
+            for entity_id in batch_entity_ids}
+
+
+def chunks(entity_ids: List[str]) -> Iterator[List[str]]:
+    for i in range(0, len(entity_ids), 50):
+        yield entity_ids[i:i+50]
+
+
+def fixtures() -> List[dict]:
+    """Generate the cassette entries of all benchmarks."""
+    entries = []
+    items = [edit_form_item(), *batch_items()]
+    for chunk in chunks([entity['id'] for entity in items]):
+        entries.append(api_entry('GET', {
+            'action': 'wbgetentities',
+            'ids': '|'.join(chunk),
+            'props': 'info|claims',
+            'formatversion': '2',
+        }, {'entities': {entity['id']: entity for entity in items
+                         if entity['id'] in chunk}}))
+
+    edit_form_entity = items[0]
+    entries.append(api_entry('GET', {
+        'action': 'wbgetentities',
+        'ids': edit_form_entity_id,
+        'props': 'info|claims',
+        'formatversion': '2',
+    }, {'entities': {edit_form_entity_id: edit_form_entity}}))
+
+    labelled_ids = [*properties,
+                    *[f'Q{2000000 + i}' for i in range(1000)],
+                    *batch_entity_ids,
+                    edit_form_entity_id,
+                    *ranker.wiki_reasons_preferred(wiki),
+                    *ranker.wiki_reasons_deprecated(wiki)]
+    for chunk in chunks(labelled_ids):
+        entries.append(api_entry('GET', {
+            'action': 'wbgetentities',
+            'ids': '|'.join(chunk),
+            'props': 'labels',
+            'formatversion': '2',
+        }, {'entities': {entity_id: {
+            'id': entity_id,
+            'labels': {'en': {'language': 'en',
+                              'value': f'label of {entity_id}'}},
+        } for entity_id in chunk}}))
+    for chunk in chunks(list(properties)):
+        entries.append(api_entry('GET', {
+            'action': 'wbgetentities',
+            'ids': '|'.join(chunk),
+            'props': 'datatype|claims',
+            'formatversion': '2',
+        }, {'entities': {property_id: {'id': property_id,
+                                       'datatype': properties[property_id],
+                                       'claims': []}
+                         for property_id in chunk}}))
+
+    for property_id in ['P9004', 'P9005']:
+        for i in range(1000):
+            value = datavalue(property_id, i)
+            if property_id == 'P9004':
+                result = (f'{i} <a href="https://{wiki}/wiki/Q11573" '
+                          f'title="Q11573">metre</a>')
+            else:
+                result = str(1500 + i % 500)
+            entries.append(api_entry('GET', {
+                'action': 'wbformatvalue',
+                'datavalue': json.dumps(value),
+                'property': property_id,
+                'generate': 'text/html',
+                'uselang': 'en',
+            }, {'result': result}))
+
+    entries.append(api_entry('GET', {
+        'action': 'query',
+        'meta': 'tokens',
+        'type': 'csrf',
+    }, {'query': {'tokens': {'csrftoken': 'bench+\\'}}}))
+    for entity_id in batch_entity_ids:
+        entries.append(api_entry('POST', {
+            'action': 'wbeditentity',
+            'id': entity_id,
+            'formatversion': '2',
+        }, {'entity': {'id': entity_id, 'lastrevid': 1001}, 'success': 1}))
+
+    entries.append({
+        'method': 'SPARQL',
+        'url': query_url,
+        'params': {'query': 'SELECT ?statement WHERE { }'},
+        'status': 200,
+        'headers': {},
+        'body': json.dumps({
+            'head': {'vars': ['statement']},
+            'results': {'bindings': [
+                {'statement': {
+                    'type': 'uri',
+                    'value': 'http://www.wikidata.org/entity/statement/'
+                    + statement_id.replace('$', '-'),
+                }}
+                for statement_ids in batch_statement_ids().values()
+                for statement_id in statement_ids
+            ]},
+        }),
+    })
+    return entries
+
+
+def clear_caches() -> None:
+    """Forget everything fetched by previous runs,
+    so that each run starts cold (like a freshly started worker)."""
+    for format_cache in [wbformat.format_value_cache,
+                         wbformat.format_entity_cache]:
+        with format_cache.lock:
+            format_cache.caches.clear()
+    with wbformat.label_store.lock:
+        wbformat.label_store.caches.clear()
+    with wbformat.property_datatypes_lock:
+        wbformat.property_datatypes.clear()
+    with ranker.edit_token_cache_lock:
+        ranker.edit_token_cache.clear()
+
+
+def bench(name: str, run: Callable[[], object], repeat: int,
+          cold: bool = True) -> None:
+    durations = []
+    for _ in range(repeat):
+        if cold:
+            clear_caches()
+        with ranker.app.test_request_context('/?uselang=en'):
+            flask.session['oauth_access_token'] = {'key': 'bench',
+                                                   'secret': 'bench'}
+            ranker.app.preprocess_request()
+            start = time.perf_counter()
+            run()
+            durations.append(time.perf_counter() - start)
+    print(f'{name}: min {min(durations) * 1000:.1f} ms, '
+          f'median {statistics.median(durations) * 1000:.1f} ms')
+
+
+def bench_fixtures(repeat: int) -> None:
+    def session():
+        return ranker.anonymous_session(wiki)
+
+    bench('edit form (2000 statements, 1000 shown), cold',
+          lambda: ranker.show_edit_form(wiki, edit_form_entity_id,
+                                        edit_form_property_id),
+          repeat)
+    bench('edit form (2000 statements, 1000 shown), warm',
+          lambda: ranker.show_edit_form(wiki, edit_form_entity_id,
+                                        edit_form_property_id),
+          repeat, cold=False)
+    bench('batch set rank (10000 statements)',
+          lambda: ranker.batch_set_rank_and_show_results(
+              wiki, batch_statement_ids(), 'preferred', 'Q71533355',
+              session(), None),
+          repeat)
+    bench('batch increment rank (10000 statements)',
+          lambda: ranker.batch_increment_rank_and_show_results(
+              wiki, batch_statement_ids(), None, session(), None),
+          repeat)
+    bench('batch edit rank (10000 statements)',
+          lambda: ranker.batch_edit_rank_and_show_results(
+              wiki,
+              {entity_id: {statement_id: ('deprecated', 'Q41755623')
+                           for statement_id in statement_ids}
+               for entity_id, statement_ids
+               in batch_statement_ids().items()},
+              session(), None),
+          repeat)
+    bench('batch query statement IDs (10000 results)',
+          lambda: ranker.query_statement_ids(wiki,
+                                             'SELECT ?statement WHERE { }'),
+          repeat)
+    bench('batch results rendering (500 entities), warm',
+          lambda: flask.render_template(
+              'batch-results.html',
+              wiki=wiki,
+              edits={entity_id: 1001 for entity_id in batch_entity_ids},
+              noops={},
+              errors={}),
+          repeat, cold=False)
+
+
+def bench_statement_index(repeat: int) -> None:
+    """Edit 2 statements of entities of growing size, 1000 times each,
+    by scanning the statements or with a prebuilt statement index."""
+    for size in [50, 500, 5000]:
+        statements = ranker.entity_statements(item(
+            'Q1', [(f'P900{i % 5 + 1}', i) for i in range(size)]))
+        statement_ids = [statements['P9003'][0]['id'],
+                         statements['P9005'][-1]['id']]
+        index = ranker.statement_index(statements)
+        for name, statement_index in [('scan', None),
+                                      ('index', index)]:
+            bench(f'set rank of 2 of {size} statements by {name} '
+                  '(1000 times)',
+                  lambda: [ranker.statements_set_rank_to(
+                      statement_ids, 'preferred', statements, wiki, None,
+                      statement_index) for _ in range(1000)],
+                  repeat, cold=False)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=0,
+                        help='delay of each replayed request, in seconds')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--write-cassette', metavar='PATH')
+    parser.add_argument('--cassette', metavar='PATH',
+                        help='replay this recorded cassette instead')
+    parser.add_argument('--edit', nargs=2,
+                        metavar=('ENTITY_ID', 'PROPERTY_ID'),
+                        help='the edit form in the recorded cassette')
+    args = parser.parse_args()
+
+    # toolforge_i18n looks up language information on meta.wikimedia.org
+    # (outside of our sessions); provide it so that nothing is fetched
+    toolforge_i18n._language_info._language_info = {
+        'en': {'bcp47': 'en', 'dir': 'ltr', 'autonym': 'English',
+               'fallbacks': []},
+    }
+    toolforge_i18n._language_info._by_bcp47 = {'en': 'en'}
+
+    if args.cassette:
+        if not args.edit:
+            parser.error('--cassette requires --edit')
+        entity_id, property_id = args.edit
+        cassette.install(cassette.Player(args.cassette, latency=args.latency))
+        bench(f'edit form ({entity_id}, {property_id}), cold',
+              lambda: ranker.show_edit_form(wiki, entity_id, property_id),
+              args.repeat)
+        return
+
+    entries = fixtures()
+    if args.write_cassette:
+        with open(args.write_cassette, 'w') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+    cassette.install(cassette.Player(
+        entries,
+        latency=args.latency,
+        # the edits differ between the pipelines, but their results don’t
+        ignored_params=['token', 'data', 'summary', 'baserevid'],
+    ))
+    bench_fixtures(args.repeat)
+    bench_statement_index(args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""Micro-benchmarks for the wbformat module.
+
+Run with `python bench_wbformat.py`."""
+
+from bs4 import BeautifulSoup, MarkupResemblesLocatorWarning
+from markupsafe import Markup
+import timeit
+import warnings
+
+import wbformat
+
+from test_wbformat import formatted_values_corpus
+
+
+def links_to_spans_beautifulsoup(html: str) -> Markup:
+    """The previous implementation of wbformat.links_to_spans."""
+    soup = BeautifulSoup(html, features='html.parser')
+    for link in soup.find_all('a'):
+        link.name = 'span'
+        del link['href']
+    return Markup(soup)
+
+
+def bench_links_to_spans(number: int = 200) -> None:
+    for name, links_to_spans in [
+            ('beautifulsoup', links_to_spans_beautifulsoup),
+            ('html.parser', wbformat.links_to_spans),
+    ]:
+        seconds = min(timeit.repeat(
+            lambda: [links_to_spans(html) for html in formatted_values_corpus],
+            number=number,
+            repeat=5,
+        ))
+        per_value = seconds / number / len(formatted_values_corpus)
+        print(f'links_to_spans ({name}): {per_value * 1e6:.1f} µs per value')
+
+
+if __name__ == '__main__':
+    warnings.filterwarnings('ignore', category=MarkupResemblesLocatorWarning)
+    bench_links_to_spans()
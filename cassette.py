@@ -0,0 +1,254 @@
+"""Record and replay the tool’s traffic to wikis and query services.
+
+A cassette is a JSONL file with one request/response pair per line.
+A Recorder wraps the pooled adapters of the sessions module
+and the SPARQL queries of the query_service module,
+passing requests through and appending each exchange to the file.
+A Player serves the recorded responses instead, without any network
+access and optionally with an injected latency per request,
+e.g. to benchmark the tool offline (see bench_app.py).
+
+Use install() to make new sessions and queries use a recorder or player."""
+
+import io
+import json
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+import requests.adapters
+import requests.structures
+
+import query_service
+import sessions
+
+
+Key = Tuple[str, str, Tuple[Tuple[str, str], ...]]
+
+batched_actions = {
+    'wbgetentities': 'entities',
+    'wbformatentities': 'wbformatentities',
+}
+"""The API actions that take several ids, by the key of their result.
+
+For these actions, a player can also assemble a response
+from several recorded responses that returned the requested entities,
+so that replay does not depend on how the entity IDs were chunked."""
+
+recorded_headers = ['Content-Type', 'Retry-After', 'MediaWiki-API-Error']
+
+
+class UnrecordedRequest(requests.exceptions.ConnectionError):
+    """A request for which the cassette has no recorded response."""
+
+
+def request_params(request: requests.PreparedRequest) -> Dict[str, str]:
+    """The parameters of the request, from both the URL and the body."""
+    params = dict(parse_qsl(urlsplit(request.url or '').query,
+                            keep_blank_values=True))
+    body = request.body
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    content_type = request.headers.get('Content-Type', '')
+    if body and content_type.startswith('application/x-www-form-urlencoded'):
+        params.update(parse_qsl(body, keep_blank_values=True))
+    return params
+
+
+def request_url(request: requests.PreparedRequest) -> str:
+    """The URL of the request, without the query string."""
+    url = urlsplit(request.url or '')
+    return f'{url.scheme}://{url.netloc}{url.path}'
+
+
+class Recorder:
+    """Record all traffic to the cassette at path (appending to it)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record(self, entry: dict) -> None:
+        line = json.dumps(entry) + '\n'
+        with self.lock, open(self.path, 'a') as f:
+            f.write(line)
+
+    def adapter(self, adapter: requests.adapters.BaseAdapter) \
+            -> requests.adapters.BaseAdapter:
+        return _RecordingAdapter(self, adapter)
+
+    def query(self, url: str, query: str, send) -> dict:
+        results = send()
+        self.record({
+            'method': 'SPARQL',
+            'url': url,
+            'params': {'query': query},
+            'status': 200,
+            'headers': {'Content-Type': 'application/sparql-results+json'},
+            'body': json.dumps(results),
+        })
+        return results
+
+
+class _RecordingAdapter(requests.adapters.BaseAdapter):
+
+    def __init__(self, recorder: Recorder,
+                 adapter: requests.adapters.BaseAdapter):
+        super().__init__()
+        self.recorder = recorder
+        self.adapter = adapter
+
+    def send(self, request, *args, **kwargs):
+        response = self.adapter.send(request, *args, **kwargs)
+        self.recorder.record({
+            'method': request.method,
+            'url': request_url(request),
+            'params': request_params(request),
+            'status': response.status_code,
+            'headers': {name: response.headers[name]
+                        for name in recorded_headers
+                        if name in response.headers},
+            'body': response.text,
+        })
+        return response
+
+    def close(self):
+        pass  # the wrapped adapter is shared with other sessions
+
+
+class Player:
+    """Replay the traffic recorded in a cassette.
+
+    cassette is the path of a cassette file, or its entries.
+    latency is the delay (in seconds) injected before each response.
+    Parameters in ignored_params are not used to match requests
+    to recorded responses; by default, only the edit token is ignored
+    (e.g. ignore 'data' and 'summary' to serve any edit of an entity
+    with the same recorded response).
+
+    If the same request was recorded several times, the responses
+    are replayed in the recorded order, repeating the last one."""
+
+    def __init__(self,
+                 cassette: Union[str, Iterable[dict]],
+                 latency: float = 0,
+                 ignored_params: Iterable[str] = ('token',)):
+        self.latency = latency
+        self.ignored_params = frozenset(ignored_params)
+        self.lock = threading.Lock()
+        self.entries: Dict[Key, List[dict]] = {}
+        self.replayed: Dict[Key, int] = {}
+        self.batched: Dict[Key, Dict[str, dict]] = {}
+        if isinstance(cassette, str):
+            with open(cassette) as f:
+                entries: Iterable[dict] = [json.loads(line) for line in f
+                                           if line.strip()]
+        else:
+            entries = cassette
+        for entry in entries:
+            self.add(entry)
+
+    def key(self, method: str, url: str, params: Dict[str, str]) -> Key:
+        return (method, url, tuple(sorted(
+            # sort list values, whose order does not matter to the API
+            (name, '|'.join(sorted(value.split('|'))))
+            for name, value in params.items()
+            if name not in self.ignored_params
+        )))
+
+    def add(self, entry: dict) -> None:
+        params = entry['params']
+        self.entries.setdefault(self.key(entry['method'],
+                                         entry['url'],
+                                         params), []).append(entry)
+        result_key = batched_actions.get(params.get('action', ''))
+        if result_key is None or 'ids' not in params:
+            return
+        results = json.loads(entry['body']).get(result_key, {})
+        batched = self.batched.setdefault(self.key(
+            entry['method'],
+            entry['url'],
+            {name: value for name, value in params.items() if name != 'ids'},
+        ), {})
+        for entity_id, result in results.items():
+            batched[entity_id] = {**entry, 'result': result}
+
+    def lookup(self, method: str, url: str,
+               params: Dict[str, str]) -> dict:
+        """Find the recorded response to the given request."""
+        key = self.key(method, url, params)
+        with self.lock:
+            entries = self.entries.get(key)
+            if entries:
+                index = self.replayed.get(key, 0)
+                self.replayed[key] = index + 1
+                return entries[min(index, len(entries) - 1)]
+        result_key = batched_actions.get(params.get('action', ''))
+        if result_key is not None and 'ids' in params:
+            batched = self.batched.get(self.key(method, url, {
+                name: value for name, value in params.items() if name != 'ids'
+            }), {})
+            entity_ids = params['ids'].split('|')
+            if all(entity_id in batched for entity_id in entity_ids):
+                first = batched[entity_ids[0]]
+                return {**first, 'body': json.dumps({
+                    result_key: {entity_id: batched[entity_id]['result']
+                                 for entity_id in entity_ids},
+                })}
+        raise UnrecordedRequest(f'no recorded response to {method} {url} '
+                                f'with {params}')
+
+    def adapter(self, adapter: requests.adapters.BaseAdapter) \
+            -> requests.adapters.BaseAdapter:
+        return _ReplayAdapter(self)
+
+    def query(self, url: str, query: str, send) -> dict:
+        time.sleep(self.latency)
+        entry = self.lookup('SPARQL', url, {'query': query})
+        return json.loads(entry['body'])
+
+
+class _ReplayAdapter(requests.adapters.BaseAdapter):
+
+    def __init__(self, player: Player):
+        super().__init__()
+        self.player = player
+
+    def send(self, request, *args, **kwargs):
+        time.sleep(self.player.latency)
+        entry = self.player.lookup(request.method,
+                                   request_url(request),
+                                   request_params(request))
+        body = entry['body'].encode('utf-8')
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.headers = requests.structures.CaseInsensitiveDict(
+            entry['headers'])
+        response.raw = io.BytesIO(body)
+        response._content = body
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def install(cassette: Optional[Union[Recorder, Player]]) -> None:
+    """Make all new sessions and queries use the given recorder or player
+    (or, if None, the network again).
+
+    Existing sessions are discarded, since they already use other adapters."""
+    if cassette is None:
+        sessions.transport = None
+        query_service.transport = None
+    else:
+        sessions.transport = cassette.adapter
+        query_service.transport = cassette.query
+    with sessions._lock:
+        sessions._anonymous_sessions.clear()
+    with sessions.authenticated_sessions_lock:
+        sessions.authenticated_sessions.clear()
@@ -0,0 +1,38 @@
+import pytest
+import toolforge_i18n._language_info
+
+
+language_info = {
+    'de': {'bcp47': 'de', 'dir': 'ltr', 'autonym': 'Deutsch',
+           'fallbacks': []},
+    'de-at': {'bcp47': 'de-AT', 'dir': 'ltr',
+              'autonym': 'Österreichisches Deutsch', 'fallbacks': ['de']},
+    'de-ch': {'bcp47': 'de-CH', 'dir': 'ltr',
+              'autonym': 'Schweizer Hochdeutsch', 'fallbacks': ['de']},
+    'de-formal': {'bcp47': 'de-x-formal', 'dir': 'ltr',
+                  'autonym': 'Deutsch (Sie-Form)', 'fallbacks': ['de']},
+    'en': {'bcp47': 'en', 'dir': 'ltr', 'autonym': 'English',
+           'fallbacks': []},
+    'en-gb': {'bcp47': 'en-GB', 'dir': 'ltr', 'autonym': 'British English',
+              'fallbacks': ['en']},
+    'gsw': {'bcp47': 'gsw', 'dir': 'ltr', 'autonym': 'Alemannisch',
+            'fallbacks': ['de']},
+    'lb': {'bcp47': 'lb', 'dir': 'ltr', 'autonym': 'Lëtzebuergesch',
+           'fallbacks': ['de']},
+    'sr-cyrl': {'bcp47': 'sr-Cyrl', 'dir': 'ltr',
+                'autonym': 'српски (ћирилица)', 'fallbacks': []},
+    'sr-ec': {'bcp47': 'sr-Cyrl', 'dir': 'ltr', 'autonym': 'српски (ћирилица)',
+              'fallbacks': ['sr-cyrl']},
+}
+"""An excerpt of MediaWiki’s language information (meta=languageinfo)."""
+
+
+@pytest.fixture(autouse=True)
+def offline_language_info(monkeypatch):
+    """Provide the language information that toolforge_i18n would
+    otherwise look up on meta.wikimedia.org, so that tests run offline."""
+    monkeypatch.setattr(toolforge_i18n._language_info, '_language_info',
+                        language_info)
+    monkeypatch.setattr(toolforge_i18n._language_info, '_by_bcp47', {
+        info['bcp47']: code for code, info in language_info.items()
+    })
@@ -0,0 +1,122 @@
+"""A cache of statements by wiki, entity ID, revision ID and property ID.
+
+The content of a revision never changes, so entries never become stale:
+they are only evicted when the cache exceeds its memory budget
+(least recently used first), or expire from the shared cache.
+
+The edit form stores the statements it shows, under the latest revision
+of the entity, and the rank edits submitted from that form read the
+statements as of the same (base) revision through the cache,
+so that they usually do not need to fetch them again."""
+
+import cachetools
+import json
+import sys
+import threading
+from typing import List, Optional, Tuple
+
+import metrics
+import servertiming
+import sharedcache
+
+
+Key = Tuple[str, str, str, str]
+
+_entry_overhead = 200
+"""Approximate size in bytes of a cache entry apart from its JSON value
+(key tuple, cache bookkeeping)."""
+
+cache_hits = metrics.Counter(
+    'ranker_entity_cache_hits_total',
+    'Entity revision cache lookups that found the statements, '
+    'by tier (local or shared).',
+    ['tier'],
+)
+cache_misses = metrics.Counter(
+    'ranker_entity_cache_misses_total',
+    'Entity revision cache lookups that had to fetch the statements.',
+)
+
+
+class EntityCache:
+    """Statement groups by (wiki, entity ID, revision ID, property ID),
+    shared by all threads.
+
+    Statements are stored as JSON and every lookup returns a fresh copy,
+    since callers edit the statements in place.
+    The cache is bounded by the approximate size of its entries in bytes;
+    if a shared cache is configured (see the sharedcache module),
+    it is used as a second tier, for statement groups of up to
+    max_shared_size bytes of JSON
+    (memcached rejects items above 1 MiB by default)."""
+
+    def __init__(self, maxbytes: int, ttl: float):
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.max_shared_size = 512 * 1024
+        self.cache: Optional[cachetools.LRUCache] = None
+        self.lock = threading.Lock()
+        self.shared_cache: Optional[sharedcache.SharedCache] = None
+
+    def _cache(self) -> cachetools.LRUCache:
+        """Get the cache, creating it on first use.
+
+        The caller must hold the lock."""
+        if self.cache is None:
+            self.cache = cachetools.LRUCache(
+                maxsize=self.maxbytes,
+                getsizeof=lambda value: _entry_overhead + sys.getsizeof(value),
+            )
+        return self.cache
+
+    def _store(self, key: Key, value: str) -> None:
+        with self.lock:
+            try:
+                self._cache()[key] = value
+            except ValueError:
+                pass  # larger than the whole cache, don’t cache it
+
+    def _shared_key(self, key: Key) -> str:
+        return json.dumps(['statements', *key])
+
+    def get(self, wiki: str, entity_id: str, revision_id: int | str,
+            property_id: str) -> Optional[List[dict]]:
+        """Get the statements of the entity for the property
+        as of the given revision, if they are cached."""
+        key = (wiki, entity_id, str(revision_id), property_id)
+        with self.lock:
+            value = self._cache().get(key)
+        if value is not None:
+            cache_hits.inc('local')
+            servertiming.record('entity-cache-hit', None)
+            return json.loads(value)
+        if self.shared_cache is not None:
+            shared_key = self._shared_key(key)
+            shared_value = self.shared_cache.get_many([shared_key])\
+                .get(shared_key)
+            if shared_value is not None:
+                # entries never become stale, the expiry time doesn’t matter
+                value, _expires = shared_value
+                self._store(key, value)
+                cache_hits.inc('shared')
+                servertiming.record('entity-cache-hit', None)
+                return json.loads(value)
+        cache_misses.inc()
+        servertiming.record('entity-cache-miss', None)
+        return None
+
+    def put(self, wiki: str, entity_id: str, revision_id: int | str,
+            property_id: str, statements: List[dict]) -> None:
+        """Store the statements of the entity for the property
+        as of the given revision."""
+        key = (wiki, entity_id, str(revision_id), property_id)
+        value = json.dumps(statements)
+        self._store(key, value)
+        if self.shared_cache is not None \
+                and len(value) <= self.max_shared_size:
+            self.shared_cache.set_many([(self._shared_key(key), value)],
+                                       self.ttl)
+
+
+entity_cache = EntityCache(maxbytes=16 * 1024 * 1024,
+                           ttl=60 * 60)
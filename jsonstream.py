@@ -0,0 +1,333 @@
+"""Incremental parsing of large JSON documents.
+
+A Reader scans a JSON document from an iterable of text chunks
+(e.g. a streamed HTTP response), and filter_value() materializes
+only the parts of it selected by a spec, skipping everything else
+without building any Python objects for it.
+Apart from the selected values, only about one chunk is held in memory,
+however large the document is.
+
+A spec is one of:
+- True, to select the whole value;
+- a dict, to select some members of an object: each member is filtered
+  with the spec of its key, or else with the spec of the key '*' (if any),
+  and skipped if there is no spec for it;
+- Items(keep), to select the elements of an array for which keep returns
+  true (each element is materialized, one at a time, to call keep);
+- Items(keep, key), to select the elements of an array for which keep
+  returns true when called with the element’s member with that key
+  (e.g. a statement ID), without materializing the other elements.
+Values that are not objects or arrays as the spec expects
+(e.g. [] instead of an empty object) are selected as a whole.
+
+Skipping is done with regular expressions and is about as fast as
+json.loads() (which the selected values are parsed with);
+selecting many large values costs up to twice the CPU time
+of json.loads() on the whole document, for the bounded memory."""
+
+import codecs
+import json
+import re
+from typing import Any, Callable, Dict, Iterable, Iterator, List, \
+    Optional, Tuple, Union
+
+
+_whitespace = re.compile(r'[ \t\n\r]*')
+_string = re.compile(r'"(?:[^"\\]++|\\.)*+"', re.DOTALL)
+_simple_string = re.compile(r'"([^"\\\x00-\x1f]*+)"')
+# a string or a run of anything but strings and brackets
+_atom = r'[^"\[\]{}]++|"(?:[^"\\]++|\\.)*+"'
+# a container nested up to eight levels deep (e.g. a whole statement)
+_container = rf'[\[{{](?:{_atom})*+[\]}}]'
+for _ in range(7):
+    _container = rf'[\[{{](?:{_atom}|{_container})*+[\]}}]'
+# anything up to the next bracket that does not close
+# such a container (or up to an unterminated string)
+_skip = re.compile(rf'(?:{_atom}|{_container})*+', re.DOTALL)
+_scalar = re.compile(r'[^,:\[\]{}" \t\n\r]*')
+
+
+_value = (rf'"(?:[^"\\]++|\\.)*+"|{_container}'
+          r'|[^,:\[\]{}" \t\n\r]++')
+_object_member = re.compile(rf'[ \t\n\r]*+"([^"\\\x00-\x1f]*+)"'
+                            rf'[ \t\n\r]*+:[ \t\n\r]*+({_value})'
+                            r'[ \t\n\r]*+([,}])')
+
+
+def _member(text: str, key: str) -> Any:
+    """Get the member with the given key of the JSON value in text
+    (None if it is not an object or has no such member),
+    materializing only that member where possible."""
+    if not text.startswith('{'):
+        return None
+    pos = 1
+    while True:
+        match = _object_member.match(text, pos)
+        if match is None:
+            # empty object, escaped key or deeply nested value
+            value = json.loads(text)
+            return value.get(key) if isinstance(value, dict) else None
+        if match.group(1) == key:
+            return json.loads(match.group(2))
+        if match.group(3) == '}':
+            return None
+        pos = match.end()
+
+
+class Items:
+    """Select the elements of an array for which keep returns true,
+    called with the element or (if key is given) its member with that key
+    (None if the element is not an object or has no such member)."""
+
+    def __init__(self, keep: Callable[[Any], bool],
+                 key: Optional[str] = None):
+        self.keep = keep
+        self.key = key
+
+
+Spec = Union[bool, Dict[str, Any], Items]
+
+
+class Reader:
+    """A scanner over a JSON document in chunks of text."""
+
+    def __init__(self, chunks: Iterable[str]):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+        self.pos = 0
+        # position of the buffer in the document
+        self.offset = 0
+        # document positions where the values being read start
+        # (nested, e.g. a key within an object), and the text
+        # from the first of them up to the buffer, in earlier chunks
+        self.marks: List[int] = []
+        self.kept: List[str] = []
+
+    def _fill(self) -> bool:
+        """Append the next chunk to the unconsumed rest of the buffer.
+
+        Returns False if there are no more chunks."""
+        for chunk in self.chunks:
+            if chunk:
+                break
+        else:
+            return False
+        if self.marks:
+            start = max(self.marks[0] - self.offset, 0)
+            self.kept.append(self.buffer[start:self.pos])
+        self.offset += self.pos
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _text_from(self, mark: int) -> str:
+        """Get the text from the given document position
+        (at or after the first mark) up to the current position."""
+        if mark >= self.offset:
+            return self.buffer[mark - self.offset:self.pos]
+        kept = ''.join(self.kept)
+        return (kept + self.buffer[:self.pos])[
+            mark - (self.offset - len(kept)):]
+
+    def _unmark(self) -> None:
+        self.marks.pop()
+        if not self.marks:
+            self.kept = []
+
+    def peek(self) -> str:
+        """Skip whitespace and return the next character."""
+        if self.pos < len(self.buffer):
+            char = self.buffer[self.pos]
+            if char not in ' \t\n\r':
+                return char
+        while True:
+            match = _whitespace.match(self.buffer, self.pos)
+            assert match is not None  # the pattern also matches ''
+            self.pos = match.end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError('unexpected end of JSON document')
+
+    def _expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise ValueError(f'expected {char!r} in JSON document, '
+                             f'got {self.buffer[self.pos]!r}')
+        self.pos += 1
+
+    def _scan_string(self) -> None:
+        while True:
+            match = _string.match(self.buffer, self.pos)
+            if match is not None:
+                self.pos = match.end()
+                return
+            if not self._fill():
+                raise ValueError('unterminated string in JSON document')
+
+    def _scan_scalar(self) -> None:
+        while True:
+            match = _scalar.match(self.buffer, self.pos)
+            assert match is not None  # the pattern also matches ''
+            # a scalar at the end of the buffer may continue in the next chunk
+            if match.end() < len(self.buffer) or not self._fill():
+                break
+        if match.end() == self.pos:
+            raise ValueError('expected a value in JSON document')
+        self.pos = match.end()
+
+    def _scan_container(self) -> None:
+        # the regex skips strings and nested containers in one go,
+        # so this loop only runs for deeper nesting and chunk boundaries
+        # (the opening bracket is consumed first, lest the regex skip
+        # the whole container and what follows it)
+        self.pos += 1
+        depth = 1
+        while True:
+            match = _skip.match(self.buffer, self.pos)
+            assert match is not None  # the pattern also matches ''
+            self.pos = match.end()
+            if self.pos == len(self.buffer) or self.buffer[self.pos] == '"':
+                # a string continues in the next chunk
+                if not self._fill():
+                    raise ValueError('unexpected end of JSON document')
+                continue
+            char = self.buffer[self.pos]
+            self.pos += 1
+            if char in '[{':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def skip_value(self) -> None:
+        """Skip the next value without materializing it."""
+        char = self.peek()
+        if char == '"':
+            self._scan_string()
+        elif char in '[{':
+            self._scan_container()
+        else:
+            self._scan_scalar()
+
+    def _read_text(self) -> str:
+        """Skip the next value and return its text."""
+        self.peek()
+        self.marks.append(self.offset + self.pos)
+        try:
+            self.skip_value()
+            return self._text_from(self.marks[-1])
+        finally:
+            self._unmark()
+
+    def read_value(self) -> Any:
+        """Read and materialize the next value."""
+        return json.loads(self._read_text())
+
+    def read_value_if(self, key: str, keep: Callable[[Any], bool]) \
+            -> Tuple[bool, Any]:
+        """Read and materialize the next value if keep returns true
+        for its member with the given key (None if it is not an object
+        or has no such member), else only skip it.
+
+        Returns whether the value was kept, and the value (or None)."""
+        text = self._read_text()
+        if not keep(_member(text, key)):
+            return False, None
+        return True, json.loads(text)
+
+    def iter_object(self) -> Iterator[str]:
+        """Iterate over the keys of the next value, an object.
+
+        The caller must read or skip each member’s value
+        before advancing to the next key."""
+        self._expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            if self.peek() != '"':
+                raise ValueError('expected a key in JSON document')
+            match = _simple_string.match(self.buffer, self.pos)
+            if match is not None:  # common case, no need for json.loads
+                key = match.group(1)
+                self.pos = match.end()
+            else:
+                key = self.read_value()
+            self._expect(':')
+            yield key
+            char = self.peek()
+            self.pos += 1
+            if char == '}':
+                return
+            if char != ',':
+                raise ValueError(f'expected "," or "}}" in JSON document, '
+                                 f'got {char!r}')
+
+    def iter_array(self) -> Iterator[None]:
+        """Iterate over the next value, an array.
+
+        The caller must read or skip each element
+        before advancing to the next one."""
+        self._expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            char = self.peek()
+            self.pos += 1
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError(f'expected "," or "]" in JSON document, '
+                                 f'got {char!r}')
+
+    def end(self) -> None:
+        """Check that only whitespace follows, consuming all chunks."""
+        try:
+            char = self.peek()
+        except ValueError:
+            return
+        raise ValueError(f'unexpected {char!r} after JSON document')
+
+
+def filter_value(reader: Reader, spec: Spec) -> Any:
+    """Read the parts of the next value selected by spec."""
+    if isinstance(spec, dict) and reader.peek() == '{':
+        value = {}
+        for key in reader.iter_object():
+            member_spec = spec.get(key, spec.get('*'))
+            if member_spec is None or member_spec is False:
+                reader.skip_value()
+            else:
+                value[key] = filter_value(reader, member_spec)
+        return value
+    if isinstance(spec, Items) and reader.peek() == '[':
+        elements = []
+        for _ in reader.iter_array():
+            if spec.key is None:
+                element = reader.read_value()
+                kept = spec.keep(element)
+            else:
+                kept, element = reader.read_value_if(spec.key, spec.keep)
+            if kept:
+                elements.append(element)
+        return elements
+    return reader.read_value()
+
+
+def loads(chunks: Iterable[str], spec: Spec) -> Any:
+    """Parse the parts of the JSON document selected by spec."""
+    reader = Reader(chunks)
+    value = filter_value(reader, spec)
+    reader.end()
+    return value
+
+
+def decode(chunks: Iterable[bytes]) -> Iterator[str]:
+    """Decode chunks of UTF-8 (e.g. of a response body) incrementally."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for chunk in chunks:
+        yield decoder.decode(chunk)
+    yield decoder.decode(b'', final=True)
@@ -0,0 +1,216 @@
+"""Minimal metrics in the Prometheus text exposition format.
+
+Each (gunicorn) worker process collects its own metrics.
+To aggregate them across workers, each worker periodically writes
+a snapshot to a directory shared by all workers (see write_snapshot),
+and the snapshots are summed up (see read_snapshots and merge)."""
+
+import json
+import math
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+
+Labels = Tuple[Tuple[str, str], ...]
+Samples = Dict[Tuple[str, Labels], float]
+"""Sample values by (metric name with suffix, sorted label pairs)."""
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def _labels(self, labelvalues: Sequence[str]) -> Labels:
+        assert len(labelvalues) == len(self.labelnames), \
+            f'{self.name} needs labels {self.labelnames}'
+        return tuple(zip(self.labelnames, labelvalues))
+
+    def samples(self) -> Samples:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """A counter, which only ever increases (until the process restarts)."""
+
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, *labelvalues: str, amount: float = 1) -> None:
+        labels = self._labels(labelvalues)
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> Samples:
+        with self.lock:
+            return {(self.name, labels): value
+                    for labels, value in self.values.items()}
+
+
+class Histogram(Metric):
+    """A histogram of observed values (e.g. durations in seconds)."""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = (0.005, 0.01, 0.025, 0.05,
+                                             0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = [*buckets, math.inf]
+        self.counts: Dict[Labels, List[int]] = {}
+        self.sums: Dict[Labels, float] = {}
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        labels = self._labels(labelvalues)
+        with self.lock:
+            counts = self.counts.setdefault(labels, [0] * len(self.buckets))
+            for i, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    counts[i] += 1
+            self.sums[labels] = self.sums.get(labels, 0) + value
+
+    def samples(self) -> Samples:
+        samples: Samples = {}
+        with self.lock:
+            for labels, counts in self.counts.items():
+                for bucket, count in zip(self.buckets, counts):
+                    le = '+Inf' if bucket == math.inf else str(bucket)
+                    samples[(f'{self.name}_bucket',
+                             (*labels, ('le', le)))] = count
+                samples[(f'{self.name}_count', labels)] = counts[-1]
+                samples[(f'{self.name}_sum', labels)] = self.sums[labels]
+        return samples
+
+
+class Gauge(Metric):
+    """A gauge whose values are collected by a function when needed.
+
+    The function returns the values by label values."""
+
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str],
+                 collect: Callable[[], Dict[Tuple[str, ...], float]]):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def samples(self) -> Samples:
+        return {(self.name, self._labels(labelvalues)): value
+                for labelvalues, value in self.collect().items()}
+
+
+class CollectedCounter(Gauge):
+    """A counter whose values are collected by a function when needed,
+    e.g. from statistics that another module already keeps."""
+
+    type = 'counter'
+
+
+registry: List[Metric] = []
+
+
+def snapshot() -> dict:
+    """Collect the current values of all metrics of this process,
+    in a JSON-serializable form."""
+    return {
+        metric.name: {
+            'type': metric.type,
+            'help': metric.documentation,
+            'samples': [[name, dict(labels), value]
+                        for (name, labels), value
+                        in metric.samples().items()],
+        }
+        for metric in registry
+    }
+
+
+def merge(snapshots: Iterable[dict]) -> dict:
+    """Sum up several snapshots (e.g. of different worker processes)."""
+    merged: Dict[str, dict] = {}
+    values: Dict[str, Dict[Tuple[str, Labels], float]] = {}
+    for snap in snapshots:
+        for metric_name, metric in snap.items():
+            merged.setdefault(metric_name, {'type': metric['type'],
+                                            'help': metric['help']})
+            metric_values = values.setdefault(metric_name, {})
+            for name, labels, value in metric['samples']:
+                key = (name, tuple(labels.items()))
+                metric_values[key] = metric_values.get(key, 0) + value
+    for metric_name, metric in merged.items():
+        metric['samples'] = [[name, dict(labels), value]
+                             for (name, labels), value
+                             in values[metric_name].items()]
+    return merged
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n') \
+        .replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def render(snap: dict) -> str:
+    """Render a snapshot in the Prometheus text exposition format."""
+    lines = []
+    for metric_name, metric in sorted(snap.items()):
+        lines.append(f'# HELP {metric_name} {metric["help"]}')
+        lines.append(f'# TYPE {metric_name} {metric["type"]}')
+        for name, labels, value in metric['samples']:
+            if labels:
+                label_pairs = ','.join(
+                    f'{label}="{_escape_label_value(label_value)}"'
+                    for label, label_value in labels.items()
+                )
+                name = f'{name}{{{label_pairs}}}'
+            lines.append(f'{name} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_snapshot(directory: str) -> None:
+    """Write a snapshot of this process’s metrics to the given directory."""
+    path = os.path.join(directory, f'{os.getpid()}.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(snapshot(), f)
+    os.replace(path + '.tmp', path)
+
+
+def read_snapshots(directory: str, max_age: float) -> List[dict]:
+    """Read the snapshots of all processes from the given directory,
+    ignoring (and removing) snapshots older than max_age seconds,
+    i.e. of processes that are probably no longer running."""
+    snapshots = []
+    now = time.time()
+    for file_name in os.listdir(directory):
+        if not file_name.endswith('.json'):
+            continue
+        path = os.path.join(directory, file_name)
+        try:
+            if os.path.getmtime(path) < now - max_age:
+                os.remove(path)
+                continue
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue  # removed or being replaced concurrently
+    return snapshots
@@ -1,6 +1,9 @@
-from typing import Collection, cast
+from typing import Callable, Collection, Optional, cast
 from SPARQLWrapper import SPARQLWrapper, JSON  # type: ignore
 
+import servertiming
+import tracing
+
 
 _query_services = {
     'www.wikidata.org': (
@@ -9,13 +12,32 @@ _query_services = {
     ),
 }
 
+transport: Optional[Callable[[str, str, Callable[[], dict]], dict]] = None
+"""If set, called with the query service URL, the query and a function
+that sends the query, e.g. to record or replay the traffic
+(see cassette.py)."""
+
 
 def query_wiki(wiki: str, query: str, user_agent: str) -> dict:
     query_service = _query_services[wiki][0]
-    sparql = SPARQLWrapper(f'https://{query_service}/sparql', agent=user_agent)
+    url = f'https://{query_service}/sparql'
+    sparql = SPARQLWrapper(url, agent=user_agent)
     sparql.setQuery(query)
     sparql.setReturnFormat(JSON)
-    return cast(dict, sparql.query().convert())
+
+    def send() -> dict:
+        return cast(dict, sparql.query().convert())
+
+    with servertiming.timed('sparql'), \
+            tracing.span('sparql', 'client', wiki=wiki):
+        if transport is None:
+            results = send()
+        else:
+            results = transport(url, query, send)
+        tracing.set_attribute('results',
+                              len(results.get('results', {})
+                                  .get('bindings', [])))
+        return results
 
 
 def wikis_with_query_service() -> Collection[str]:
@@ -0,0 +1,83 @@
+"""Per-request timing breakdown for the Server-Timing header.
+
+The timings of the current request are kept in a context variable,
+so that code running on behalf of the request (including in the
+wbformat prefetch thread pool, see wbformat._submit) can record into
+them without knowing about Flask."""
+
+import contextlib
+import contextvars
+import threading
+import time
+from typing import Dict, Iterator, Optional
+
+
+class Timings:
+    """The accumulated durations and counts of one request."""
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.durations: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def record(self, name: str, duration: Optional[float], count: int = 1):
+        """Record count events named name, which took duration seconds
+        (None for events without a duration, e.g. cache hits)."""
+        with self.lock:
+            if duration is not None:
+                self.durations[name] = self.durations.get(name, 0) + duration
+            self.counts[name] = self.counts.get(name, 0) + count
+
+    def header(self) -> str:
+        """Format the timings as a Server-Timing header value.
+
+        Durations are in milliseconds, as the header requires;
+        nested timings (e.g. API calls during rendering) overlap."""
+        total = time.perf_counter() - self.start
+        metrics = []
+        with self.lock:
+            for name, count in sorted(self.counts.items()):
+                metric = f'{name};desc="{count}"'
+                if name in self.durations:
+                    metric += f';dur={self.durations[name] * 1000:.1f}'
+                metrics.append(metric)
+        metrics.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(metrics)
+
+
+_timings: contextvars.ContextVar[Optional[Timings]] = \
+    contextvars.ContextVar('timings', default=None)
+
+
+def start() -> contextvars.Token:
+    """Start collecting the timings of a new request.
+
+    Returns a token to pass to stop() at the end of the request."""
+    return _timings.set(Timings())
+
+
+def stop(token: contextvars.Token) -> None:
+    _timings.reset(token)
+
+
+def current() -> Optional[Timings]:
+    """Get the timings of the current request, if any."""
+    return _timings.get()
+
+
+def record(name: str, duration: Optional[float], count: int = 1) -> None:
+    """Record events in the timings of the current request, if any."""
+    timings = _timings.get()
+    if timings is not None:
+        timings.record(name, duration, count)
+
+
+@contextlib.contextmanager
+def timed(name: str) -> Iterator[None]:
+    """Record the duration of the with block in the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
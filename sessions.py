@@ -0,0 +1,332 @@
+import cachetools
+import contextlib
+import functools
+import mwapi  # type: ignore
+from mwapi.util import _normalize_params  # type: ignore
+import mwoauth  # type: ignore
+import requests
+import requests.adapters
+import requests_oauthlib  # type: ignore
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util import parse_url
+
+import jsonstream
+import metrics
+import servertiming
+import tracing
+
+
+pool_size = 10
+"""The maximum number of connections kept alive per wiki.
+
+This should be at least the number of threads that may talk to
+the same wiki concurrently within one (gunicorn) worker process."""
+
+Transport = Callable[[requests.adapters.BaseAdapter],
+                     requests.adapters.BaseAdapter]
+transport: Optional[Transport] = None
+"""If set, wraps or replaces the pooled adapter of each new session,
+e.g. to record or replay the traffic (see cassette.py)."""
+
+_stats: Dict[str, Dict[str, int]] = {}
+_stats_lock = threading.Lock()
+
+
+def _count(host: str, counter: str) -> None:
+    with _stats_lock:
+        host_stats = _stats.setdefault(host, {'requests': 0,
+                                              'connections': 0})
+        host_stats[counter] += 1
+
+
+def connection_stats() -> Dict[str, Dict[str, int]]:
+    """Get the connection statistics for each wiki.
+
+    For each host, 'requests' is the number of requests sent,
+    'connections' is the number of connections opened (handshakes),
+    and 'reuses' is the number of requests that reused a connection."""
+    with _stats_lock:
+        return {
+            host: {
+                **host_stats,
+                'reuses': host_stats['requests'] - host_stats['connections'],
+            }
+            for host, host_stats in _stats.items()
+        }
+
+
+def _collect_connection_stats(counter: str) -> Dict[Tuple[str, ...], float]:
+    return {(host,): host_stats[counter]
+            for host, host_stats in connection_stats().items()}
+
+
+for counter, documentation in [
+        ('requests', 'HTTP requests sent to each wiki.'),
+        ('connections', 'HTTP connections opened to each wiki.'),
+        ('reuses', 'HTTP requests to each wiki that reused a connection.'),
+]:
+    metrics.CollectedCounter(
+        f'ranker_http_{counter}_total',
+        documentation,
+        ['wiki'],
+        functools.partial(_collect_connection_stats, counter),
+    )
+
+api_requests = metrics.Histogram(
+    'ranker_api_request_duration_seconds',
+    'Duration of MediaWiki API requests, by wiki and action.',
+    ['wiki', 'action'],
+)
+
+
+class _CountingHTTPConnection(HTTPConnection):
+    def connect(self) -> None:
+        _count(self.host, 'connections')
+        super().connect()
+
+
+class _CountingHTTPSConnection(HTTPSConnection):
+    def connect(self) -> None:
+        _count(self.host, 'connections')
+        super().connect()
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _CountingHTTPConnection
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _CountingHTTPSConnection
+
+
+class _PooledAdapter(requests.adapters.HTTPAdapter):
+    """An HTTP adapter that keeps connections to one wiki alive
+    and counts requests and new connections."""
+
+    def __init__(self):
+        super().__init__(pool_connections=1,
+                         pool_maxsize=pool_size)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _CountingHTTPConnectionPool,
+            'https': _CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, *args, **kwargs):
+        _count(parse_url(request.url).host, 'requests')
+        return super().send(request, *args, **kwargs)
+
+
+_adapters: Dict[str, _PooledAdapter] = {}
+_anonymous_sessions: Dict[str, mwapi.Session] = {}
+_lock = threading.Lock()
+
+
+def _adapter(wiki: str) -> _PooledAdapter:
+    with _lock:
+        adapter = _adapters.get(wiki)
+        if adapter is None:
+            adapter = _PooledAdapter()
+            _adapters[wiki] = adapter
+        return adapter
+
+
+def recycle(wiki: str) -> None:
+    """Close all pooled connections to the given wiki.
+
+    Called after connection errors and timeouts,
+    so that later requests do not reuse a broken connection."""
+    with _lock:
+        adapter = _adapters.get(wiki)
+    if adapter is not None:
+        adapter.poolmanager.clear()
+
+
+class _TracingRequestsSession(requests.Session):
+    """A requests session adding response details to the current span."""
+
+    def request(self, *args, read_body: bool = True, **kwargs):
+        """Send a request like requests.Session.request().
+
+        Unless read_body is False (for responses parsed incrementally,
+        see filtered_json), the body is read right away to record its size,
+        even if stream=True (mwapi reads all of it afterwards anyway)."""
+        response = super().request(*args, **kwargs)
+        if tracing.current_span() is not None:
+            tracing.set_attribute('http.status_code', response.status_code)
+            if read_body:
+                tracing.set_attribute('response_bytes', len(response.content))
+            if 'Retry-After' in response.headers:
+                tracing.set_attribute('retry_after',
+                                      response.headers['Retry-After'])
+        return response
+
+
+def filtered_json(response: requests.Response,
+                  spec: jsonstream.Spec) -> Any:
+    """Parse the body of a streamed response incrementally,
+    keeping only the parts selected by spec (see jsonstream),
+    and record its size in the current span."""
+    size = 0
+
+    def chunks() -> Iterator[bytes]:
+        nonlocal size
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            size += len(chunk)
+            yield chunk
+
+    try:
+        return jsonstream.loads(jsonstream.decode(chunks()), spec)
+    finally:
+        response.close()
+        tracing.set_attribute('response_bytes', size)
+
+
+def requests_session(wiki: str) -> _TracingRequestsSession:
+    """Create a requests session that uses the pooled connections
+    for the given wiki (but has its own cookies and auth)."""
+    session = _TracingRequestsSession()
+    adapter: requests.adapters.BaseAdapter = _adapter(wiki)
+    if transport is not None:
+        adapter = transport(adapter)
+    session.mount(f'https://{wiki}/', adapter)
+    return session
+
+
+class Session(mwapi.Session):
+    """An mwapi.Session using the pooled connections for one wiki.
+
+    Connection errors and timeouts recycle the wiki’s connections."""
+
+    def __init__(self, wiki: str, **kwargs):
+        self.wiki = wiki
+        super().__init__(host='https://' + wiki,
+                         session=requests_session(wiki),
+                         **kwargs)
+
+    @contextlib.contextmanager
+    def _instrumented(self, params: dict) -> Iterator[None]:
+        """Record metrics and a tracing span for an API request."""
+        action = params.get('action', '')
+        attributes = {'wiki': self.wiki, 'action': action}
+        for name in ['ids', 'titles', 'pageids', 'revids']:
+            if name in params:
+                values = params[name]
+                if isinstance(values, str):
+                    values = values.split('|')
+                attributes['chunk_size'] = len(values)
+        if 'maxlag' in params:
+            attributes['maxlag'] = params['maxlag']
+        start = time.perf_counter()
+        token = tracing.start_span('mediawiki-api', 'client', **attributes)
+        error = None
+        try:
+            yield
+        except (mwapi.errors.ConnectionError, mwapi.errors.TimeoutError) as e:
+            error = e
+            recycle(self.wiki)
+            raise
+        except Exception as e:
+            error = e
+            if isinstance(e, mwapi.errors.APIError):
+                tracing.set_attribute('api_error', e.code)
+            raise
+        finally:
+            tracing.end_span(token, error)
+            duration = time.perf_counter() - start
+            api_requests.observe(duration, self.wiki, action)
+            servertiming.record(f'api-{action}', duration)
+
+    def _request(self, method, params=None, *args, **kwargs):
+        params = params or {}
+        with self._instrumented(params):
+            return super()._request(method, params, *args, **kwargs)
+
+    def get_filtered(self, spec: Dict[str, jsonstream.Spec],
+                     **params) -> dict:
+        """Like get(), but parse the response incrementally,
+        keeping only the parts selected by spec (see jsonstream),
+        for responses that may be too large to hold in memory at once.
+
+        Errors are raised like get() raises them,
+        but warnings are not logged."""
+        params = _normalize_params(params)
+        params['format'] = 'json'
+        if self.formatversion is not None:
+            params['formatversion'] = self.formatversion
+        with self._instrumented(params):
+            try:
+                response = self.session.request('GET',
+                                                self.api_url,
+                                                params=params,
+                                                timeout=self.timeout,
+                                                headers=self.headers,
+                                                stream=True,
+                                                read_body=False)
+                doc = filtered_json(response, {**spec, 'error': True})
+            except requests.exceptions.Timeout as e:
+                raise mwapi.errors.TimeoutError(str(e)) from e
+            except requests.exceptions.ConnectionError as e:
+                raise mwapi.errors.ConnectionError(str(e)) from e
+            if 'error' in doc:
+                raise mwapi.errors.APIError.from_doc(doc['error'])
+            return doc
+
+
+def anonymous_session(wiki: str, user_agent: str) -> mwapi.Session:
+    """Get the shared anonymous session for the given wiki."""
+    with _lock:
+        session = _anonymous_sessions.get(wiki)
+    if session is None:
+        session = Session(wiki, user_agent=user_agent)
+        with _lock:
+            session = _anonymous_sessions.setdefault(wiki, session)
+    return session
+
+
+authenticated_sessions = cachetools.TTLCache(maxsize=100,  # type: ignore
+                                             ttl=15 * 60)
+"""Authenticated sessions by (wiki, access token key).
+
+Sessions are evicted when they were not used for 15 minutes,
+or when there are too many of them (least recently used first)."""
+authenticated_sessions_lock = threading.Lock()
+
+
+def authenticated_session(wiki: str,
+                          user_agent: str,
+                          consumer_token: mwoauth.ConsumerToken,
+                          access_token: mwoauth.AccessToken) \
+        -> mwapi.Session:
+    """Get a session for the given wiki, authenticated with the access token.
+
+    The session (including its OAuth signer) is reused
+    for further requests by the same user to the same wiki."""
+    key = (wiki, access_token.key)
+    with authenticated_sessions_lock:
+        session = authenticated_sessions.get(key)
+        if session is None:
+            auth = requests_oauthlib.OAuth1(
+                client_key=consumer_token.key,
+                client_secret=consumer_token.secret,
+                resource_owner_key=access_token.key,
+                resource_owner_secret=access_token.secret,
+            )
+            session = Session(wiki, auth=auth, user_agent=user_agent)
+        # (re)insert to reset the idle timer
+        authenticated_sessions[key] = session
+    return session
+
+
+def discard_authenticated_sessions(access_token_key: str) -> None:
+    """Discard all cached sessions authenticated with the given token."""
+    with authenticated_sessions_lock:
+        for key in list(authenticated_sessions.keys()):
+            if key[1] == access_token_key:
+                del authenticated_sessions[key]
@@ -0,0 +1,173 @@
+"""Caches shared between processes (e.g. all gunicorn workers on a host).
+
+Both backends map string keys to string values with a TTL,
+and return the values with their absolute expiry time
+(so that a copy in a local cache can expire at the same time);
+they never raise errors on lookup or storage:
+a broken shared cache only makes the tool slower, not unusable."""
+
+import hashlib
+import io
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from typing import Dict, Iterable, Optional, Protocol, Tuple
+
+
+class SharedCache(Protocol):
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Tuple[str, float]]:
+        """Get the (value, expiry time) pairs of the given keys,
+        where the expiry time is a time.time() timestamp."""
+        ...
+
+    def set_many(self, items: Iterable[Tuple[str, str]], ttl: float):
+        ...
+
+
+class SQLiteCache:
+    """A shared cache in an SQLite database file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        self.sets = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=1)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS cache ('
+                               'key TEXT PRIMARY KEY, '
+                               'value TEXT NOT NULL, '
+                               'expires REAL NOT NULL)')
+            self.local.connection = connection
+        return connection
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Tuple[str, float]]:
+        keys = list(keys)
+        values: Dict[str, Tuple[str, float]] = {}
+        try:
+            connection = self._connection()
+            # stay well below SQLITE_MAX_VARIABLE_NUMBER
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i+500]
+                placeholders = ', '.join('?' * len(chunk))
+                rows = connection.execute(
+                    'SELECT key, value, expires FROM cache '
+                    f'WHERE key IN ({placeholders}) AND expires > ?',
+                    [*chunk, time.time()],
+                )
+                values.update((key, (value, expires))
+                              for key, value, expires in rows)
+        except sqlite3.Error as e:
+            print('shared cache error:', e, file=sys.stderr)
+        return values
+
+    def set_many(self, items: Iterable[Tuple[str, str]], ttl: float):
+        expires = time.time() + ttl
+        try:
+            connection = self._connection()
+            with connection:
+                connection.executemany(
+                    'INSERT OR REPLACE INTO cache (key, value, expires) '
+                    'VALUES (?, ?, ?)',
+                    [(key, value, expires) for key, value in items],
+                )
+                self.sets += 1
+                if self.sets % 1000 == 0:
+                    connection.execute('DELETE FROM cache WHERE expires <= ?',
+                                       (time.time(),))
+        except sqlite3.Error as e:
+            print('shared cache error:', e, file=sys.stderr)
+
+
+class MemcachedCache:
+    """A shared cache in a memcached server (text protocol).
+
+    Keys are hashed, since memcached restricts their length and syntax.
+    memcached does not return the expiry time of an item,
+    so it is stored (in whole seconds) in the item’s flags."""
+
+    def __init__(self, address: str):
+        host, _, port = address.rpartition(':')
+        self.address = (host, int(port))
+        self.local = threading.local()
+        self.retry_after = 0.0
+
+    def _hash(self, key: str) -> str:
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _connection(self) -> Tuple[socket.socket, io.BufferedReader]:
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            if time.time() < self.retry_after:
+                raise OSError('not retrying memcached connection yet')
+            sock = socket.create_connection(self.address, timeout=1)
+            connection = sock, sock.makefile('rb')
+            self.local.connection = connection
+        return connection
+
+    def _reset(self):
+        """Drop the connection after an error,
+        and don't try to connect again for a minute."""
+        self.retry_after = time.time() + 60
+        connection = getattr(self.local, 'connection', None)
+        self.local.connection = None
+        if connection is not None:
+            connection[1].close()
+            connection[0].close()
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Tuple[str, float]]:
+        keys_by_hash = {self._hash(key): key for key in keys}
+        if not keys_by_hash:
+            return {}
+        values: Dict[str, Tuple[str, float]] = {}
+        now = time.time()
+        try:
+            sock, reader = self._connection()
+            sock.sendall(b'get ' + ' '.join(keys_by_hash).encode('ascii')
+                         + b'\r\n')
+            while True:
+                line = reader.readline()
+                if line == b'END\r\n':
+                    break
+                _value, hash, flags, length = line.split()
+                if _value != b'VALUE':
+                    raise OSError(f'unexpected response: {line!r}')
+                data = reader.read(int(length) + 2)[:-2]
+                expires = float(flags)
+                if expires > now:  # else e.g. stored without expiry time
+                    values[keys_by_hash[hash.decode('ascii')]] = \
+                        data.decode('utf-8'), expires
+        except (OSError, ValueError, KeyError) as e:
+            print('shared cache error:', e, file=sys.stderr)
+            self._reset()
+        return values
+
+    def set_many(self, items: Iterable[Tuple[str, str]], ttl: float):
+        expires = int(time.time() + ttl)
+        try:
+            sock, reader = self._connection()
+            for key, value in items:
+                data = value.encode('utf-8')
+                sock.sendall(f'set {self._hash(key)} {expires} {int(ttl)} '
+                             f'{len(data)}\r\n'.encode('ascii')
+                             + data + b'\r\n')
+                line = reader.readline()
+                if line != b'STORED\r\n':
+                    raise OSError(f'unexpected response: {line!r}')
+        except OSError as e:
+            print('shared cache error:', e, file=sys.stderr)
+            self._reset()
+
+
+def from_config(config: dict) -> Optional[SharedCache]:
+    """Create the shared cache configured in the given app config, if any."""
+    if 'FORMAT_CACHE_SQLITE' in config:
+        return SQLiteCache(config['FORMAT_CACHE_SQLITE'])
+    if 'FORMAT_CACHE_MEMCACHED' in config:
+        return MemcachedCache(config['FORMAT_CACHE_MEMCACHED'])
+    return None
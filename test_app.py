@@ -43,6 +43,43 @@ def test_csrf_token_load():
         assert ranker.csrf_token() == 'test token'
 
 
+def test_logged_in_user_name_cached(monkeypatch):
+    class FakeSession:
+        get_calls = 0
+
+        def get(self, **kwargs):
+            assert kwargs == {'action': 'query', 'meta': 'userinfo'}
+            self.get_calls += 1
+            return {'query': {'userinfo': {'name': 'Test User'}}}
+    session = FakeSession()
+    monkeypatch.setattr(ranker, 'authenticated_session', lambda wiki: session)
+
+    with ranker.app.test_request_context() as context:
+        context.session['oauth_access_token'] = {'key': 'k', 'secret': 's'}
+        assert ranker.logged_in_user_name() == 'Test User'
+        assert ranker.logged_in_user_name() == 'Test User'
+        assert session.get_calls == 1
+        assert context.session['user_name'] == 'Test User'
+
+
+def test_logged_in_user_name_logged_out(monkeypatch):
+    monkeypatch.setattr(ranker, 'authenticated_session', lambda wiki: None)
+
+    with ranker.app.test_request_context() as context:
+        context.session['user_name'] = 'Stale User'
+        assert ranker.logged_in_user_name() is None
+
+
+def test_logout_forgets_user_name(client):
+    with client.session_transaction() as session:
+        session['oauth_access_token'] = {'key': 'k', 'secret': 's'}
+        session['user_name'] = 'Test User'
+    client.get('/logout')
+    with client.session_transaction() as session:
+        assert 'oauth_access_token' not in session
+        assert 'user_name' not in session
+
+
 @pytest.mark.parametrize('wiki, has_query_service', [
     ('www.wikidata.org', True),
     ('commons.wikimedia.org', False),
@@ -116,6 +153,67 @@ def test_wiki_reason_deprecated_property(wiki: str, property_id: Optional[str]):
     assert ranker.wiki_reason_deprecated_property(wiki) == property_id
 
 
+def test_prewarm_format_caches(monkeypatch):
+    class FakeSession:
+        host = 'https://prewarm.wikidata.org'
+
+        def __init__(self):
+            self.calls = []
+
+        def get(self, **kwargs):
+            assert kwargs['action'] == 'wbformatentities'
+            self.calls.append((kwargs['uselang'], kwargs['ids']))
+            return {'wbformatentities': {
+                entity_id: f'{entity_id} ({kwargs["uselang"]})'
+                for entity_id in kwargs['ids']
+            }}
+    session = FakeSession()
+    wikis = []
+
+    def anonymous_session(wiki):
+        wikis.append(wiki)
+        return session
+    monkeypatch.setattr(ranker, 'anonymous_session', anonymous_session)
+
+    ranker.prewarm_format_caches(['en', 'de'])
+
+    # test.wikidata.org has no reasons, so only Wikidata is prewarmed
+    assert wikis == ['www.wikidata.org']
+    entity_ids = ranker.wiki_reasons_preferred('www.wikidata.org') + \
+        ranker.wiki_reasons_deprecated('www.wikidata.org') + \
+        ['P7452', 'P2241']
+    assert session.calls == [('en', entity_ids), ('de', entity_ids)]
+    for language in ['en', 'de']:
+        key = ranker.wbformat.format_entity_key(session, language, 'P2241')
+        assert ranker.wbformat.format_entity_cache[key] == \
+            Markup(f'P2241 ({language})')
+
+    # prewarming again refreshes the already cached entities
+    ranker.prewarm_format_caches(['en'])
+    assert len(session.calls) == 3
+
+
+def test_prewarm_format_caches_forever_survives_errors(monkeypatch):
+    class StopPrewarming(BaseException):
+        pass
+    calls = []
+
+    def prewarm_format_caches(languages):
+        calls.append(languages)
+        if len(calls) == 1:
+            raise mwapi.errors.ConnectionError('timeout')
+
+    def sleep(seconds):
+        if len(calls) == 2:
+            raise StopPrewarming()
+    monkeypatch.setattr(ranker, 'prewarm_format_caches', prewarm_format_caches)
+    monkeypatch.setattr(ranker.time, 'sleep', sleep)
+
+    with pytest.raises(StopPrewarming):
+        ranker.prewarm_format_caches_forever(['en'])
+    assert calls == [['en'], ['en']]
+
+
 def test_index_redirect(client):
     response = client.post('/',
                            data={'wiki': 'www.wikidata.org',
@@ -134,7 +232,6 @@ def test_index_redirect_mediainfo(client):
     assert response.headers['location'] == expected_redirect
 
 
-@pytest.mark.filterwarnings('ignore::bs4.MarkupResemblesLocatorWarning')
 def test_format_value_escapes_html():
     value = {'value': '<script>alert("!Mediengruppe Bitnik");</script>',
              'type': 'string'}
@@ -414,7 +511,7 @@ ORDER BY ?num
 
 def test_get_entities():
     class FakeSession:
-        def get(self, ids, **kwargs):
+        def get_filtered(self, spec, ids, **kwargs):
             assert len(ids) <= 50
             return {'entities': {id: f'entity {id}' for id in ids}}
 
@@ -423,6 +520,63 @@ def test_get_entities():
     assert entities == {id: f'entity {id}' for id in entity_ids}
 
 
+def test_all_statement_ids():
+    assert ranker.all_statement_ids({
+        'Q1': ['Q1$a', 'Q1$b'],
+        'Q2': {'Q2$c': ('normal', '')},
+    }) == {'Q1$a', 'Q1$b', 'Q2$c'}
+
+
+class FakeEditSession:
+    host = 'https://test.wikidata.org'
+
+    def __init__(self, bad_tokens=()):
+        self.bad_tokens = set(bad_tokens)
+        self.token_calls = 0
+        self.posted_tokens = []
+
+    def get(self, **kwargs):
+        assert kwargs == {'action': 'query', 'meta': 'tokens', 'type': 'csrf'}
+        self.token_calls += 1
+        return {'query': {'tokens': {'csrftoken': f'token{self.token_calls}'}}}
+
+    def post(self, token, **kwargs):
+        self.posted_tokens.append(token)
+        if token in self.bad_tokens:
+            raise mwapi.errors.APIError('badtoken', 'Invalid CSRF token.', '')
+        return {'entity': {'lastrevid': 123}}
+
+
+def test_edit_token_cached_across_requests():
+    session = FakeEditSession()
+    for _ in range(2):
+        with ranker.app.test_request_context() as context:
+            context.session['oauth_access_token'] = {'key': 'token cache',
+                                                     'secret': 's'}
+            assert ranker.edit_token(session) == 'token1'
+    assert session.token_calls == 1
+
+
+def test_save_entity_badtoken_retry():
+    session = FakeEditSession(bad_tokens={'token1'})
+    with ranker.app.test_request_context() as context:
+        context.session['oauth_access_token'] = {'key': 'badtoken',
+                                                 'secret': 's'}
+        revision_id = ranker.save_entity({'id': 'Q1'}, 'summary', 1, session)
+    assert revision_id == 123
+    assert session.posted_tokens == ['token1', 'token2']
+
+
+def test_save_entity_badtoken_retry_once():
+    session = FakeEditSession(bad_tokens={'token1', 'token2'})
+    with ranker.app.test_request_context() as context:
+        context.session['oauth_access_token'] = {'key': 'badtoken twice',
+                                                 'secret': 's'}
+        with pytest.raises(mwapi.errors.APIError, match='badtoken'):
+            ranker.save_entity({'id': 'Q1'}, 'summary', 1, session)
+    assert session.posted_tokens == ['token1', 'token2']
+
+
 @pytest.mark.parametrize('entity, expected_statements', [
     pytest.param({'type': 'item', 'claims': 'X'}, 'X', id='item'),
     pytest.param({'type': 'property', 'claims': 'X'}, 'X', id='property'),
@@ -432,12 +586,31 @@ def test_get_entities():
     pytest.param({'claims': 'X'}, 'X', id='sense or form (T272804)'),
     pytest.param({'type': 'mediainfo', 'statements': ''}, '', id='mediainfo'),
     pytest.param({'type': 'mediainfo', 'statements': []}, {}, id='T222159'),
+    pytest.param({'type': 'item', 'claims': []}, {}, id='item without claims'),
 ])
 def test_entity_statements(entity: dict, expected_statements):
     statements = ranker.entity_statements(entity)
     assert expected_statements == statements
 
 
+def test_statements_values():
+    def snak(property_id, value):
+        return {'snaktype': 'value', 'property': property_id,
+                'datavalue': value}
+    statements = [
+        {'mainsnak': snak('P1', 'A'), 'qualifiers': {
+            'P2': [snak('P2', 'B'), {'snaktype': 'novalue', 'property': 'P2'}],
+            'P3': [snak('P3', 'C')],
+        }},
+        {'mainsnak': {'snaktype': 'somevalue', 'property': 'P1'}},
+    ]
+    assert ranker.statements_values(statements) == [
+        ('P1', 'A'),
+        ('P2', 'B'),
+        ('P3', 'C'),
+    ]
+
+
 @pytest.mark.parametrize('rank, expected', [
     ('deprecated', 'normal'),
     ('normal', 'preferred'),
@@ -497,6 +670,34 @@ def test_statements_set_rank_to():
     assert statements == {property_id: [edited_statement]}
 
 
+def test_indexed_statements():
+    statements = {
+        'P9': [{'id': 'a'}, {'id': 'b'}],
+        'P10': [{'id': 'c'}],
+    }
+    index = ranker.statement_index(statements)
+    assert index == {'a': (0, 'P9', 0), 'b': (1, 'P9', 1), 'c': (2, 'P10', 0)}
+    expected = [('P9', {'id': 'b'}), ('P10', {'id': 'c'})]
+    assert ranker.indexed_statements(['c', 'x', 'b', 'c'],
+                                     statements,
+                                     index) == expected
+    assert ranker.indexed_statements(['c', 'x', 'b', 'c'],
+                                     statements,
+                                     None) == expected
+
+
+def test_statements_increment_rank_duplicate_ids():
+    statement = {'id': 'a', 'rank': 'deprecated'}
+    statements, edited_statements = ranker.statements_increment_rank(
+        ['a', 'a'],
+        {'P1': [statement]},
+        'www.wikidata.org',
+        None,
+    )
+    assert edited_statements == 1
+    assert statement['rank'] == 'normal'
+
+
 @pytest.mark.parametrize('empty_reason', [None, ''])
 def test_statements_increment_rank(empty_reason):
     def reason():
@@ -591,6 +792,7 @@ def test_statements_edit_rank():
     assert unselected_statement['rank'] == 'normal'
     assert unselected_statement['qualifiers']['P2241']
     assert 'P7452' not in unselected_statement['qualifiers']
+    assert statements == {'P1': [edited_statement]}
 
 
 @pytest.mark.parametrize('statement, wiki, expected', [
@@ -794,3 +996,176 @@ def test_get_summary_edit_rank(edited_statements: int,
                                expected: str):
     assert expected == ranker.get_summary_edit_rank(edited_statements,
                                                     custom_summary)
+
+
+@pytest.fixture
+def metrics_token(monkeypatch):
+    monkeypatch.setitem(ranker.app.config, 'METRICS_TOKEN', 'metrics token')
+    return {'Authorization': 'Bearer metrics token'}
+
+
+def test_metrics(metrics_token):
+    with ranker.app.test_request_context(headers=metrics_token):
+        response = ranker.show_metrics()
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    assert '# TYPE ranker_format_cache_hits_total counter' in text
+    assert '# TYPE ranker_api_request_duration_seconds histogram' in text
+    assert '# TYPE ranker_http_reuses_total counter' in text
+
+
+def test_metrics_aggregated(metrics_token, monkeypatch, tmp_path):
+    monkeypatch.setitem(ranker.app.config, 'METRICS_DIR', str(tmp_path))
+    (tmp_path / '1.json').write_text('''{"ranker_test_total": {
+        "type": "counter",
+        "help": "A test counter from another worker.",
+        "samples": [["ranker_test_total", {}, 3]]
+    }}''')
+    with ranker.app.test_request_context(headers=metrics_token):
+        response = ranker.show_metrics()
+    text = response.get_data(as_text=True)
+    assert 'ranker_test_total 3' in text
+    assert '# TYPE ranker_format_cache_hits_total counter' in text
+
+
+@pytest.mark.parametrize('path', ['/metrics', '/metrics/worker'])
+def test_metrics_disabled_by_default(monkeypatch, path):
+    monkeypatch.delitem(ranker.app.config, 'METRICS_TOKEN', raising=False)
+    response = ranker.app.test_client().get(path)
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize('path', ['/metrics', '/metrics/worker'])
+@pytest.mark.parametrize('headers', [
+    {},
+    {'Authorization': 'Bearer wrong token'},
+    {'Authorization': 'metrics token'},
+])
+def test_metrics_require_token(metrics_token, path, headers):
+    response = ranker.app.test_client().get(path, headers=headers)
+    assert response.status_code == 401
+
+
+def test_worker_metrics(metrics_token):
+    response = ranker.app.test_client().get('/metrics/worker',
+                                            headers=metrics_token)
+    assert response.status_code == 200
+    assert '# TYPE ranker_format_cache_hits_total counter' \
+        in response.get_data(as_text=True)
+
+
+def test_server_timing(monkeypatch):
+    monkeypatch.setitem(ranker.app.config, 'SERVER_TIMING_FOOTER', True)
+    with ranker.app.test_request_context():
+        ranker.start_server_timing()
+        ranker.servertiming.record('api-wbgetentities', 0.25)
+        response = ranker.add_server_timing(flask.Response(
+            '<html><body><main></main></body></html>',
+            mimetype='text/html',
+        ))
+        ranker.stop_server_timing(None)
+    server_timing = response.headers['Server-Timing']
+    assert server_timing.startswith('api-wbgetentities;desc="1";dur=250.0, '
+                                    'total;dur=')
+    assert response.get_data(as_text=True).endswith(
+        '<main></main><footer class="container mt-3 text-muted small">'
+        f'<code>Server-Timing: {Markup.escape(server_timing)}</code>'
+        '</footer></body></html>')
+
+
+class FakeEntitySession:
+    """A fake session serving the current revision of one entity."""
+
+    def __init__(self, lastrevid: int, statements: list[dict]):
+        self.lastrevid = lastrevid
+        self.statements = statements
+        self.requests: list[str] = []
+
+    def get_filtered(self, spec, action, **kwargs):
+        self.requests.append(action)
+        assert action == 'wbgetentities'
+        assert kwargs['ids'] == ['Q1']
+        assert kwargs['props'] == ['info', 'claims']
+        # like wbgetentities, an entity without statements has claims: []
+        claims = {'P1': self.statements} if self.statements else []
+        return {'entities': {'Q1': {'type': 'item',
+                                    'id': 'Q1',
+                                    'lastrevid': self.lastrevid,
+                                    'claims': claims}}}
+
+
+@pytest.fixture
+def entity_cache(monkeypatch):
+    entity_cache = ranker.entitycache.EntityCache(maxbytes=1024 * 1024,
+                                                  ttl=60)
+    monkeypatch.setattr(ranker.entitycache, 'entity_cache', entity_cache)
+    return entity_cache
+
+
+def test_get_base_statements_cached(entity_cache, monkeypatch):
+    statements = [{'id': 'Q1$1', 'rank': 'normal'}]
+    entity_cache.put('test.wikidata.org', 'Q1', 123, 'P1', statements)
+    monkeypatch.setattr(ranker, 'anonymous_session',
+                        lambda wiki: pytest.fail('no requests expected'))
+
+    assert ranker.get_base_statements('test.wikidata.org', 'Q1', 'P1',
+                                      '123') == statements
+
+
+@pytest.mark.parametrize('statements', [
+    [{'id': 'Q1$1', 'rank': 'normal'}],
+    [],
+])
+def test_get_base_statements_latest_revision(entity_cache, monkeypatch,
+                                             statements):
+    session = FakeEntitySession(123, statements)
+    monkeypatch.setattr(ranker, 'anonymous_session', lambda wiki: session)
+
+    assert ranker.get_base_statements('test.wikidata.org', 'Q1', 'P1',
+                                      '123') == statements
+    assert session.requests == ['wbgetentities']
+    assert entity_cache.get('test.wikidata.org', 'Q1', 123,
+                            'P1') == statements
+
+
+@pytest.mark.parametrize('statements', [
+    [{'id': 'Q1$1', 'rank': 'normal',
+      'mainsnak': {'snaktype': 'novalue', 'property': 'P1'}}],
+    [],
+])
+def test_show_edit_form_caches_statements(entity_cache, monkeypatch,
+                                          statements):
+    session = FakeEntitySession(123, statements)
+    monkeypatch.setattr(ranker, 'anonymous_session', lambda wiki: session)
+    monkeypatch.setattr(ranker.wbformat, 'prefetch_entities',
+                        lambda *args: None)
+    monkeypatch.setattr(ranker.wbformat, 'prefetch_values',
+                        lambda *args: None)
+    monkeypatch.setattr(ranker.flask, 'render_template',
+                        lambda template, **kwargs: kwargs)
+
+    with ranker.app.test_request_context():
+        flask.g.interface_language_code = 'en'
+        rendered = ranker.show_edit_form('test.wikidata.org', 'Q1', 'P1')
+    assert rendered['base_revision_id'] == 123
+    assert rendered['statements'] == statements
+    assert session.requests == ['wbgetentities']
+    assert entity_cache.get('test.wikidata.org', 'Q1', 123,
+                            'P1') == statements
+
+
+def test_get_base_statements_old_revision(entity_cache, monkeypatch):
+    statements = [{'id': 'Q1$1', 'rank': 'normal'}]
+    session = FakeEntitySession(124, [])
+    monkeypatch.setattr(ranker, 'anonymous_session', lambda wiki: session)
+
+    def get_entity_data(wiki, entity_id, revision_id, property_id):
+        assert (wiki, entity_id, revision_id, property_id) == \
+            ('test.wikidata.org', 'Q1', '123', 'P1')
+        return {'id': 'Q1', 'claims': {'P1': statements, 'P2': []}}
+    monkeypatch.setattr(ranker, 'get_entity_data', get_entity_data)
+
+    assert ranker.get_base_statements('test.wikidata.org', 'Q1', 'P1',
+                                      '123') == statements
+    assert session.requests == ['wbgetentities']
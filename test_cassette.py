@@ -0,0 +1,176 @@
+import json
+import mwapi  # type: ignore
+import pytest
+import requests
+import time
+
+import cassette
+import query_service
+import sessions
+
+from test_sessions import server  # noqa: F401
+
+
+api_url = 'https://cassette.example/w/api.php'
+
+
+def api_entry(params: dict, body: dict) -> dict:
+    return {
+        'method': 'GET',
+        'url': api_url,
+        'params': {**params, 'format': 'json'},
+        'status': 200,
+        'headers': {'Content-Type': 'application/json'},
+        'body': json.dumps(body),
+    }
+
+
+@pytest.fixture
+def installed():
+    def install(player):
+        cassette.install(player)
+        return sessions.anonymous_session('cassette.example',
+                                          user_agent='test')
+    yield install
+    cassette.install(None)
+
+
+def test_record_and_replay(server, tmp_path):  # noqa: F811
+    path = str(tmp_path / 'cassette.jsonl')
+    host = f'127.0.0.1:{server.server_address[1]}'
+    url = f'http://{host}/w/api.php?action=query&meta=siteinfo'
+
+    session = requests.Session()
+    session.mount(f'http://{host}/',
+                  cassette.Recorder(path).adapter(sessions._adapter(host)))
+    assert session.get(url).json() == {}
+
+    entry, = [json.loads(line) for line in open(path)]
+    assert entry['method'] == 'GET'
+    assert entry['url'] == f'http://{host}/w/api.php'
+    assert entry['params'] == {'action': 'query', 'meta': 'siteinfo'}
+    assert entry['headers'] == {'Content-Type': 'application/json'}
+
+    server.shutdown()
+    session = requests.Session()
+    session.mount(f'http://{host}/', cassette.Player(path).adapter(
+        sessions._adapter(host)))
+    response = session.get(url)
+    assert response.status_code == 200
+    assert response.json() == {}
+
+
+def test_replay_through_mwapi(installed):
+    session = installed(cassette.Player([
+        api_entry({'action': 'query', 'meta': 'tokens', 'type': 'csrf'},
+                  {'query': {'tokens': {'csrftoken': 'token+\\'}}}),
+    ]))
+    response = session.get(action='query', meta='tokens', type='csrf')
+    assert response['query']['tokens']['csrftoken'] == 'token+\\'
+
+
+def test_replay_post_ignores_token(installed):
+    edit = {
+        'method': 'POST',
+        'url': api_url,
+        'params': {'action': 'wbeditentity', 'id': 'Q1', 'data': '{}',
+                   'token': 'recorded token', 'format': 'json'},
+        'status': 200,
+        'headers': {'Content-Type': 'application/json'},
+        'body': json.dumps({'entity': {'lastrevid': 123}}),
+    }
+    session = installed(cassette.Player([edit]))
+    response = session.post(action='wbeditentity', id='Q1', data='{}',
+                            token='other token')
+    assert response['entity']['lastrevid'] == 123
+    with pytest.raises(Exception):
+        session.post(action='wbeditentity', id='Q1', data='{"claims":{}}',
+                     token='other token')
+
+    session = installed(cassette.Player([edit],
+                                        ignored_params=['token', 'data']))
+    response = session.post(action='wbeditentity', id='Q1',
+                            data='{"claims":{}}', token='other token')
+    assert response['entity']['lastrevid'] == 123
+
+
+def test_replay_repeated_requests_in_order(installed):
+    params = {'action': 'query', 'meta': 'tokens'}
+    session = installed(cassette.Player([
+        api_entry(params, {'n': 1}),
+        api_entry(params, {'n': 2}),
+    ]))
+    assert [session.get(**params)['n'] for _ in range(3)] == [1, 2, 2]
+
+
+def test_replay_assembles_batched_entities(installed):
+    params = {'action': 'wbgetentities', 'props': 'labels|info'}
+    session = installed(cassette.Player([
+        api_entry({**params, 'ids': 'Q1|Q2'},
+                  {'entities': {'Q1': {'id': 'Q1'}, 'Q2': {'id': 'Q2'}}}),
+        api_entry({**params, 'ids': 'Q3'},
+                  {'entities': {'Q3': {'id': 'Q3'}}}),
+    ]))
+    # same chunk in a different order, props in a different order
+    response = session.get(action='wbgetentities', ids=['Q2', 'Q1'],
+                           props=['info', 'labels'])
+    assert response['entities'].keys() == {'Q1', 'Q2'}
+    # different chunk
+    response = session.get(action='wbgetentities', ids=['Q3', 'Q1'],
+                           props=['labels', 'info'])
+    assert list(response['entities']) == ['Q3', 'Q1']
+    # not recorded
+    with pytest.raises(Exception):
+        session.get(action='wbgetentities', ids=['Q1', 'Q4'],
+                    props=['labels', 'info'])
+
+
+def test_replay_unrecorded_request():
+    player = cassette.Player([])
+    with pytest.raises(cassette.UnrecordedRequest):
+        player.lookup('GET', api_url, {'action': 'query'})
+
+
+def test_replay_latency(installed):
+    params = {'action': 'query', 'meta': 'siteinfo'}
+    session = installed(cassette.Player([api_entry(params, {})],
+                                        latency=0.05))
+    start = time.perf_counter()
+    session.get(**params)
+    assert time.perf_counter() - start >= 0.05
+
+
+def test_record_and_replay_query(tmp_path):
+    path = str(tmp_path / 'cassette.jsonl')
+    results = {'head': {'vars': ['statement']},
+               'results': {'bindings': []}}
+    try:
+        cassette.install(cassette.Recorder(path))
+        assert query_service.transport is not None
+        assert query_service.transport('https://query.example/sparql',
+                                       'ASK {}',
+                                       lambda: results) == results
+        cassette.install(cassette.Player(path))
+        assert query_service.transport is not None
+        assert query_service.transport('https://query.example/sparql',
+                                       'ASK {}',
+                                       lambda: pytest.fail()) == results
+    finally:
+        cassette.install(None)
+
+
+def test_replay_filtered(installed):
+    params = {'action': 'wbgetentities', 'ids': 'Q1'}
+    session = installed(cassette.Player([
+        api_entry(params, {'entities': {'Q1': {
+            'id': 'Q1',
+            'labels': {'en': {'language': 'en', 'value': 'label'}},
+        }}}),
+        api_entry({'action': 'wbgetentities', 'ids': 'Q2'},
+                  {'error': {'code': 'no-such-entity', 'info': 'Q2'}}),
+    ]))
+    assert session.get_filtered({'entities': {'*': {'id': True}}},
+                                **params) == {'entities': {'Q1': {'id': 'Q1'}}}
+    with pytest.raises(mwapi.errors.APIError):
+        session.get_filtered({'entities': True},
+                             action='wbgetentities', ids=['Q2'])
@@ -0,0 +1,57 @@
+import json
+
+import entitycache
+import sharedcache
+
+
+statements = [{'id': 'Q1$1', 'rank': 'normal'}]
+
+
+def test_entity_cache_get_put():
+    cache = entitycache.EntityCache(maxbytes=1024 * 1024, ttl=60)
+    assert cache.get('test.wikidata.org', 'Q1', 123, 'P1') is None
+    cache.put('test.wikidata.org', 'Q1', 123, 'P1', statements)
+    assert cache.get('test.wikidata.org', 'Q1', 123, 'P1') == statements
+    assert cache.get('test.wikidata.org', 'Q1', '123', 'P1') == statements
+    assert cache.get('test.wikidata.org', 'Q1', 124, 'P1') is None
+    assert cache.get('www.wikidata.org', 'Q1', 123, 'P1') is None
+    assert cache.get('test.wikidata.org', 'Q1', 123, 'P2') is None
+
+
+def test_entity_cache_returns_copies():
+    cache = entitycache.EntityCache(maxbytes=1024 * 1024, ttl=60)
+    cache.put('test.wikidata.org', 'Q1', 123, 'P1', statements)
+    cached_statements = cache.get('test.wikidata.org', 'Q1', 123, 'P1')
+    assert cached_statements is not None
+    cached_statements[0]['rank'] = 'preferred'
+    assert cache.get('test.wikidata.org', 'Q1', 123, 'P1') == statements
+
+
+def test_entity_cache_bounded_by_bytes():
+    size = entitycache._entry_overhead + len(json.dumps(statements)) + 100
+    cache = entitycache.EntityCache(maxbytes=2 * size, ttl=60)
+    for revision_id in [1, 2, 3]:
+        cache.put('test.wikidata.org', 'Q1', revision_id, 'P1', statements)
+    assert cache.get('test.wikidata.org', 'Q1', 1, 'P1') is None
+    assert cache.get('test.wikidata.org', 'Q1', 3, 'P1') == statements
+
+    # too large for the whole cache: not cached, but no error either
+    cache.put('test.wikidata.org', 'Q2', 1, 'P1',
+              [{'id': 'Q2$1', 'rank': 'normal', 'padding': 'x' * 3 * size}])
+    assert cache.get('test.wikidata.org', 'Q2', 1, 'P1') is None
+
+
+def test_entity_cache_shared_between_workers(tmp_path):
+    shared_cache = sharedcache.SQLiteCache(str(tmp_path / 'cache.sqlite3'))
+    cache = entitycache.EntityCache(maxbytes=1024 * 1024, ttl=60)
+    other_cache = entitycache.EntityCache(maxbytes=1024 * 1024, ttl=60)
+    cache.shared_cache = other_cache.shared_cache = shared_cache
+
+    cache.put('test.wikidata.org', 'Q1', 123, 'P1', statements)
+    assert other_cache.get('test.wikidata.org', 'Q1', 123, 'P1') == statements
+    assert other_cache.cache is not None
+    assert len(other_cache.cache) == 1
+
+    cache.max_shared_size = 10
+    cache.put('test.wikidata.org', 'Q1', 124, 'P1', statements)
+    assert other_cache.get('test.wikidata.org', 'Q1', 124, 'P1') is None
@@ -0,0 +1,136 @@
+import json
+import pytest
+
+import jsonstream
+
+
+documents = [
+    {},
+    [],
+    {'a': 1, 'b': [True, False, None], 'c': {'d': -1.5e-3}},
+    ['string with "quotes", \\backslashes\\ and ]}brackets{[', 'äöü 😀'],
+    {'': '', 'nested': [[[{}]]], 'number': 12345678901234567890},
+]
+
+
+def chunked(text: str, size: int) -> list[str]:
+    return [text[i:i+size] for i in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize('document', documents)
+@pytest.mark.parametrize('size', [1, 2, 3, 1000])
+@pytest.mark.parametrize('indent', [None, 2])
+def test_loads_whole_document(document, size, indent):
+    text = json.dumps(document, indent=indent, ensure_ascii=False)
+    assert jsonstream.loads(chunked(text, size), True) == document
+
+
+@pytest.mark.parametrize('size', [1, 7, 1000])
+def test_loads_filtered(size):
+    entity = {
+        'entities': {
+            'Q1': {
+                'type': 'item',
+                'id': 'Q1',
+                'lastrevid': 123,
+                'labels': {'en': {'language': 'en', 'value': 'label'}},
+                'claims': {
+                    'P1': [{'id': 'Q1$1', 'rank': 'normal'},
+                           {'id': 'Q1$2', 'rank': 'preferred'}],
+                    'P2': [{'id': 'Q1$3', 'rank': 'normal'}],
+                },
+            },
+            'M2': {
+                'type': 'mediainfo',
+                'id': 'M2',
+                'statements': [],
+            },
+        },
+        'success': 1,
+    }
+    statements = jsonstream.Items(
+        lambda statement: statement['id'] in {'Q1$2', 'Q1$3'})
+    spec = {'entities': {'*': {
+        'id': True,
+        'lastrevid': True,
+        'claims': {'P1': statements},
+        'statements': {'*': statements},
+    }}}
+    text = json.dumps(entity, indent=1)
+    assert jsonstream.loads(chunked(text, size), spec) == {
+        'entities': {
+            'Q1': {
+                'id': 'Q1',
+                'lastrevid': 123,
+                'claims': {'P1': [{'id': 'Q1$2', 'rank': 'preferred'}]},
+            },
+            'M2': {
+                'id': 'M2',
+                'statements': [],  # not an object, selected as a whole
+            },
+        },
+    }
+
+
+@pytest.mark.parametrize('text', [
+    '',
+    '{"a": 1',
+    '{"a" 1}',
+    '{1: 1}',
+    '[1 2]',
+    '"unterminated',
+    '{"a": 1} trailing',
+    '[nonsense]',
+])
+def test_loads_invalid(text):
+    with pytest.raises(ValueError):
+        jsonstream.loads(chunked(text, 2), True)
+
+
+@pytest.mark.parametrize('size', [1, 5, 1000])
+def test_loads_items_by_key(size):
+    deep = {'id': 'c'}
+    for _ in range(20):  # deeper than the skipping regex handles at once
+        deep = {'nested': [deep]}
+    elements = [
+        {'mainsnak': {'id': 'not the statement ID'}, 'id': 'a'},
+        {'id': 'b', 'qualifiers': {'P1': [{'value': '{"id": "x"} ]'}]}},
+        {'nested': deep, 'id': 'c'},
+        {'i\u0064': 'd'},  # escaped key
+        {'rank': 'normal'},  # no ID
+        {},
+        'e',
+        [{'id': 'f'}],
+    ]
+    keys = []
+
+    def keep(key):
+        keys.append(key)
+        return key in {'a', 'c', 'd', 'e', 'f'}
+    text = json.dumps(elements, indent=1)
+    assert jsonstream.loads(chunked(text, size),
+                            jsonstream.Items(keep, key='id')) \
+        == [elements[0], elements[2], elements[3]]
+    assert keys == ['a', 'b', 'c', 'd', None, None, None, None]
+
+
+def test_skip_holds_only_one_chunk():
+    reader = jsonstream.Reader(chunked(json.dumps({
+        'skipped': ['x' * 100] * 1000,
+        'kept': 'value',
+    }), 100))
+    max_buffer = 0
+    for key in reader.iter_object():
+        if key == 'skipped':
+            reader.skip_value()
+        else:
+            assert reader.read_value() == 'value'
+        max_buffer = max(max_buffer, len(reader.buffer))
+    assert max_buffer <= 200
+
+
+def test_decode_split_characters():
+    data = 'äöü 😀'.encode('utf-8')
+    assert ''.join(jsonstream.decode([data[i:i+1]
+                                      for i in range(len(data))])) \
+        == 'äöü 😀'
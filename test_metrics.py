@@ -0,0 +1,83 @@
+import os
+import pytest
+import time
+
+import metrics
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    registry = []
+    monkeypatch.setattr(metrics, 'registry', registry)
+    return registry
+
+
+def test_counter():
+    counter = metrics.Counter('test_total', 'A test counter.', ['action'])
+    counter.inc('query')
+    counter.inc('query')
+    counter.inc('wbformatentities', amount=3)
+    assert metrics.render(metrics.snapshot()) == '''\
+# HELP test_total A test counter.
+# TYPE test_total counter
+test_total{action="query"} 2
+test_total{action="wbformatentities"} 3
+'''
+
+
+def test_histogram():
+    histogram = metrics.Histogram('test_seconds', 'A test histogram.',
+                                  buckets=[0.1, 1])
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+    assert metrics.render(metrics.snapshot()) == '''\
+# HELP test_seconds A test histogram.
+# TYPE test_seconds histogram
+test_seconds_bucket{le="0.1"} 1
+test_seconds_bucket{le="1"} 2
+test_seconds_bucket{le="+Inf"} 3
+test_seconds_count 3
+test_seconds_sum 5.55
+'''
+
+
+def test_gauge():
+    metrics.Gauge('test_bytes', 'A test gauge.', ['wiki'],
+                  lambda: {('www.wikidata.org',): 1024})
+    assert metrics.render(metrics.snapshot()).splitlines()[-1] == \
+        'test_bytes{wiki="www.wikidata.org"} 1024'
+
+
+def test_render_escapes_label_values():
+    counter = metrics.Counter('test_total', 'A test counter.', ['label'])
+    counter.inc('a "quoted"\\nvalue')
+    assert metrics.render(metrics.snapshot()).splitlines()[-1] == \
+        r'test_total{label="a \"quoted\"\\nvalue"} 1'
+
+
+def test_merge():
+    counter = metrics.Counter('test_total', 'A test counter.', ['wiki'])
+    counter.inc('a')
+    snapshot_1 = metrics.snapshot()
+    counter.inc('a')
+    counter.inc('b')
+    snapshot_2 = metrics.snapshot()
+    merged = metrics.merge([snapshot_1, snapshot_2])
+    assert metrics.render(merged).splitlines()[2:] == [
+        'test_total{wiki="a"} 3',
+        'test_total{wiki="b"} 1',
+    ]
+
+
+def test_snapshots(tmp_path):
+    counter = metrics.Counter('test_total', 'A test counter.')
+    counter.inc()
+    metrics.write_snapshot(str(tmp_path))
+    stale_path = tmp_path / '1.json'
+    stale_path.write_text('{}')
+    an_hour_ago = time.time() - 60 * 60
+    os.utime(stale_path, (an_hour_ago, an_hour_ago))
+    snapshots = metrics.read_snapshots(str(tmp_path), max_age=60)
+    assert snapshots == [metrics.snapshot()]
+    assert not stale_path.exists()
@@ -0,0 +1,46 @@
+import threading
+
+import servertiming
+import wbformat
+
+
+def test_timings_header():
+    timings = servertiming.Timings()
+    timings.record('api-wbgetentities', 0.1)
+    timings.record('api-wbgetentities', 0.05)
+    timings.record('entity-cache-hit', None, 3)
+    header = timings.header()
+    metrics = header.split(', ')
+    assert metrics[:2] == [
+        'api-wbgetentities;desc="2";dur=150.0',
+        'entity-cache-hit;desc="3"',
+    ]
+    assert metrics[2].startswith('total;dur=')
+
+
+def test_record_without_request():
+    assert servertiming.current() is None
+    servertiming.record('api-query', 0.1)  # does nothing
+
+
+def test_record_in_thread_pool():
+    token = servertiming.start()
+    try:
+        with servertiming.timed('sparql'):
+            pass
+        future = wbformat._submit('servertiming host',
+                                  servertiming.record,
+                                  'api-wbformatvalue',
+                                  0.01)
+        future.result()
+        # plain threads do not inherit the context
+        thread = threading.Thread(target=servertiming.record,
+                                  args=('api-query', 0.01))
+        thread.start()
+        thread.join()
+        timings = servertiming.current()
+        assert timings is not None
+        assert timings.counts == {'sparql': 1, 'api-wbformatvalue': 1}
+    finally:
+        servertiming.stop(token)
+    assert servertiming.current() is None
@@ -0,0 +1,126 @@
+import http.server
+import mwoauth  # type: ignore
+import pytest
+import requests
+import threading
+
+import sessions
+
+
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'{}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                             KeepAliveHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def pooled_session(server) -> tuple[str, requests.Session]:
+    host = f'127.0.0.1:{server.server_address[1]}'
+    session = requests.Session()
+    session.mount(f'http://{host}/', sessions._adapter(host))
+    return host, session
+
+
+def local_stats() -> dict[str, int]:
+    return sessions.connection_stats().get('127.0.0.1', {
+        'requests': 0,
+        'connections': 0,
+        'reuses': 0,
+    })
+
+
+def test_connections_reused(server):
+    host, session = pooled_session(server)
+    before = local_stats()
+    for _ in range(3):
+        session.get(f'http://{host}/').raise_for_status()
+    after = local_stats()
+    assert after['requests'] == before['requests'] + 3
+    assert after['connections'] == before['connections'] + 1
+    assert after['reuses'] == before['reuses'] + 2
+
+
+def test_connections_shared_between_sessions(server):
+    host, session1 = pooled_session(server)
+    _, session2 = pooled_session(server)
+    session1.get(f'http://{host}/').raise_for_status()
+    connections = local_stats()['connections']
+    session2.get(f'http://{host}/').raise_for_status()
+    assert local_stats()['connections'] == connections
+
+
+def test_recycle(server):
+    host, session = pooled_session(server)
+    session.get(f'http://{host}/').raise_for_status()
+    connections = local_stats()['connections']
+    sessions.recycle(host)
+    session.get(f'http://{host}/').raise_for_status()
+    assert local_stats()['connections'] == connections + 1
+
+
+def test_anonymous_session_shared():
+    session1 = sessions.anonymous_session('test.wikidata.org', 'test')
+    session2 = sessions.anonymous_session('test.wikidata.org', 'test')
+    other_session = sessions.anonymous_session('www.wikidata.org', 'test')
+    assert session1 is session2
+    assert session1 is not other_session
+    assert session1.host == 'https://test.wikidata.org'
+
+
+def test_authenticated_session_cached():
+    consumer_token = mwoauth.ConsumerToken('consumer key', 'consumer secret')
+    access_token_1 = mwoauth.AccessToken('key 1', 'secret 1')
+    access_token_2 = mwoauth.AccessToken('key 2', 'secret 2')
+    session_1 = sessions.authenticated_session('test.wikidata.org',
+                                               'test',
+                                               consumer_token,
+                                               access_token_1)
+    session_1_again = sessions.authenticated_session('test.wikidata.org',
+                                                     'test',
+                                                     consumer_token,
+                                                     access_token_1)
+    session_2 = sessions.authenticated_session('test.wikidata.org',
+                                               'test',
+                                               consumer_token,
+                                               access_token_2)
+    assert session_1 is session_1_again
+    assert session_1 is not session_2
+    assert session_1.session.auth.client.resource_owner_key == 'key 1'
+    assert session_2.session.auth.client.resource_owner_key == 'key 2'
+    assert session_1.session.get_adapter('https://test.wikidata.org/') \
+        is session_2.session.get_adapter('https://test.wikidata.org/')
+
+
+def test_discard_authenticated_sessions():
+    consumer_token = mwoauth.ConsumerToken('consumer key', 'consumer secret')
+    access_token = mwoauth.AccessToken('key 3', 'secret 3')
+    session = sessions.authenticated_session('test.wikidata.org',
+                                             'test',
+                                             consumer_token,
+                                             access_token)
+    sessions.discard_authenticated_sessions('key 3')
+    assert ('test.wikidata.org', 'key 3') \
+        not in sessions.authenticated_sessions
+    assert session is not sessions.authenticated_session('test.wikidata.org',
+                                                         'test',
+                                                         consumer_token,
+                                                         access_token)
@@ -0,0 +1,95 @@
+import pytest
+import socketserver
+import threading
+import time
+
+import sharedcache
+
+
+class FakeMemcachedHandler(socketserver.StreamRequestHandler):
+    """A tiny stand-in for memcached, supporting just get and set."""
+
+    def handle(self):
+        data = self.server.data  # type: ignore
+        while line := self.rfile.readline():
+            command, *args = line.split()
+            if command == b'get':
+                for key in args:
+                    if key in data:
+                        flags, value = data[key]
+                        self.wfile.write(b'VALUE %s %s %d\r\n%s\r\n'
+                                         % (key, flags, len(value), value))
+                self.wfile.write(b'END\r\n')
+            elif command == b'set':
+                key, flags, _exptime, length = args
+                data[key] = flags, self.rfile.read(int(length) + 2)[:-2]
+                self.wfile.write(b'STORED\r\n')
+
+
+@pytest.fixture
+def memcached():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0),
+                                             FakeMemcachedHandler)
+    server.daemon_threads = True
+    server.data = {}  # type: ignore
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def test_sqlite_cache(tmp_path):
+    path = str(tmp_path / 'cache.sqlite3')
+    cache = sharedcache.SQLiteCache(path)
+    other_cache = sharedcache.SQLiteCache(path)
+    cache.set_many([('a', 'A'), ('b', 'Bé')], ttl=60)
+    values = other_cache.get_many(['a', 'b', 'c'])
+    assert {key: value for key, (value, expires) in values.items()} \
+        == {'a': 'A', 'b': 'Bé'}
+    for value, expires in values.values():
+        assert time.time() + 59 < expires <= time.time() + 60
+
+
+def test_sqlite_cache_expired(tmp_path):
+    cache = sharedcache.SQLiteCache(str(tmp_path / 'cache.sqlite3'))
+    cache.set_many([('a', 'A')], ttl=0.01)
+    time.sleep(0.02)
+    assert cache.get_many(['a']) == {}
+
+
+def test_memcached_cache(memcached):
+    cache = sharedcache.MemcachedCache(memcached)
+    other_cache = sharedcache.MemcachedCache(memcached)
+    cache.set_many([('a key with spaces', 'A'), ('b', 'Bé\r\nB')], ttl=60)
+    values = other_cache.get_many(['a key with spaces', 'b', 'c'])
+    assert {key: value for key, (value, expires) in values.items()} == {
+        'a key with spaces': 'A',
+        'b': 'Bé\r\nB',
+    }
+    for value, expires in values.values():
+        assert time.time() + 58 < expires <= time.time() + 60
+
+
+def test_memcached_cache_expired(memcached):
+    cache = sharedcache.MemcachedCache(memcached)
+    cache.set_many([('a', 'A')], ttl=60)
+    # the fake memcached ignores exptime, the expiry in the flags still works
+    cache.set_many([('b', 'B')], ttl=-60)
+    assert list(cache.get_many(['a', 'b'])) == ['a']
+
+
+def test_memcached_cache_unavailable():
+    cache = sharedcache.MemcachedCache('127.0.0.1:1')
+    cache.set_many([('a', 'A')], ttl=60)
+    assert cache.get_many(['a']) == {}
+
+
+@pytest.mark.parametrize('config, expected_type', [
+    ({}, type(None)),
+    ({'FORMAT_CACHE_SQLITE': ':memory:'}, sharedcache.SQLiteCache),
+    ({'FORMAT_CACHE_MEMCACHED': '127.0.0.1:11211'},
+     sharedcache.MemcachedCache),
+])
+def test_from_config(config, expected_type):
+    assert isinstance(sharedcache.from_config(config), expected_type)
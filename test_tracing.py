@@ -0,0 +1,128 @@
+import http.server
+import json
+import pytest
+import threading
+
+import sessions
+import tracing
+import wbformat
+
+from test_sessions import server  # noqa: F401
+
+
+class ListExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+@pytest.fixture
+def exporter(monkeypatch):
+    exporter = ListExporter()
+    monkeypatch.setattr(tracing, 'exporter', exporter)
+    return exporter
+
+
+def test_no_spans_without_exporter():
+    assert tracing.exporter is None
+    with tracing.span('test'):
+        assert tracing.current_span() is None
+        tracing.set_attribute('ignored', True)
+
+
+def test_nested_spans(exporter):
+    with tracing.span('root', 'server'):
+        with tracing.span('child', 'client', wiki='test.wikidata.org'):
+            tracing.set_attribute('chunk_size', 50)
+        with pytest.raises(ValueError):
+            with tracing.span('failing'):
+                raise ValueError('oops')
+    child, failing, root = exporter.spans
+    assert root.parent_id is None
+    assert child.parent_id == root.span_id
+    assert failing.parent_id == root.span_id
+    assert child.trace_id == failing.trace_id == root.trace_id
+    assert child.attributes == {'wiki': 'test.wikidata.org',
+                                'chunk_size': 50}
+    assert failing.error == 'ValueError: oops'
+    assert root.error is None
+    assert root.start_time_ns <= child.start_time_ns
+    assert child.end_time_ns <= root.end_time_ns
+    assert tracing.current_span() is None
+
+
+def test_spans_nest_across_thread_pool(exporter):
+    with tracing.span('root'):
+        wbformat._submit('tracing host',
+                         tracing.traced('pooled')(lambda: None)).result()
+    pooled, root = exporter.spans
+    assert pooled.name == 'pooled'
+    assert pooled.parent_id == root.span_id
+
+
+def test_response_attributes(exporter, server):  # noqa: F811
+    session = sessions._TracingRequestsSession()
+    with tracing.span('request'):
+        session.get(f'http://127.0.0.1:{server.server_address[1]}/')
+    span, = exporter.spans
+    assert span.attributes == {'http.status_code': 200,
+                               'response_bytes': 2}
+
+
+def test_jsonl_exporter(monkeypatch, tmp_path):
+    path = tmp_path / 'spans.jsonl'
+    monkeypatch.setattr(tracing, 'exporter',
+                        tracing.from_config({'TRACING_JSONL': str(path)}))
+    with tracing.span('root'):
+        with tracing.span('child', action='wbgetentities'):
+            pass
+    child, root = [json.loads(line)
+                   for line in path.read_text().splitlines()]
+    assert child['name'] == 'child'
+    assert child['parent_id'] == root['span_id']
+    assert child['attributes'] == {'action': 'wbgetentities'}
+    assert child['duration_ms'] >= 0
+
+
+def test_otlp_exporter(monkeypatch):
+    requests = []
+
+    class CollectorHandler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers['Content-Length'])
+            requests.append((self.path, json.loads(self.rfile.read(length))))
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    collector = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                CollectorHandler)
+    thread = threading.Thread(target=collector.serve_forever, daemon=True)
+    thread.start()
+    try:
+        endpoint = f'http://127.0.0.1:{collector.server_address[1]}/v1/traces'
+        exporter = tracing.OTLPExporter(endpoint, interval=60)
+        monkeypatch.setattr(tracing, 'exporter', exporter)
+        with tracing.span('root', 'server'):
+            with tracing.span('child', 'client', chunk_size=50):
+                pass
+        exporter.flush()
+    finally:
+        collector.shutdown()
+        collector.server_close()
+    (path, body), = requests
+    assert path == '/v1/traces'
+    child, root = body['resourceSpans'][0]['scopeSpans'][0]['spans']
+    assert root['kind'] == 2
+    assert 'parentSpanId' not in root
+    assert child['kind'] == 3
+    assert child['parentSpanId'] == root['spanId']
+    assert child['traceId'] == root['traceId']
+    assert child['attributes'] == [{'key': 'chunk_size',
+                                    'value': {'intValue': '50'}}]
+    assert child['status'] == {'code': 1}
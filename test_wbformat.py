@@ -1,10 +1,16 @@
+from bs4 import BeautifulSoup
+import concurrent.futures
 from markupsafe import Markup
 import mwapi  # type: ignore
 import pytest
+import sys
+import threading
+import time
+
+import sharedcache
 import wbformat
 
 
-@pytest.mark.filterwarnings('ignore::bs4.MarkupResemblesLocatorWarning')
 def test_format_value_escapes_html():
     session = mwapi.Session('https://test.wikidata.org',
                             user_agent='Ranker unit tests')
@@ -28,9 +34,11 @@ def test_prefetch_entities():
     class FakeSession:
         host = 'host'
         get_calls = 0
+        lock = threading.Lock()
 
         def get(self, ids, **kwargs):
-            self.get_calls += 1
+            with self.lock:
+                self.get_calls += 1
             return {'wbformatentities': {
                 entity_id: f'label of {entity_id}' for entity_id in ids
             }}
@@ -43,3 +51,667 @@ def test_prefetch_entities():
         for entity_id in [f'P{id}', f'Q{id}']:
             key = ('host', 'en', entity_id)
         assert wbformat.format_entity_cache[key] == f'label of {entity_id}'
+
+
+def test_prefetch_values_entities():
+    class FakeSession:
+        host = 'prefetch values host'
+        get_calls = 0
+
+        def get_filtered(self, spec, action, **kwargs):
+            assert action == 'wbgetentities'
+            return {'entities': {}}  # unknown data type
+
+        def get(self, action, ids, **kwargs):
+            assert action == 'wbformatentities'
+            self.get_calls += 1
+            return {'wbformatentities': {
+                entity_id: f'<a href="/wiki/{entity_id}">label</a>'
+                for entity_id in ids
+            }}
+    session = FakeSession()
+    values = [
+        ('P527', {'type': 'wikibase-entityid',
+                  'value': {'entity-type': 'item', 'id': f'Q{id}'}})
+        for id in range(1, 120)
+    ]
+    string_value = ('P1476', {'type': 'string', 'value': 'abc'})
+    wbformat.prefetch_values(session, 'en', values + [string_value])
+    assert session.get_calls == 3
+    for property_id, value in values:
+        key = wbformat.format_value_key(session, 'en', property_id, value)
+        assert wbformat.format_value_cache[key] == \
+            Markup('<span>label</span>')
+    key = wbformat.format_value_key(session, 'en', *string_value)
+    assert key not in wbformat.format_value_cache
+
+
+def test_prefetch_values_stale_entity(monkeypatch):
+    class FakeSession:
+        host = 'stale entity host'
+        format_calls = 0
+
+        def get(self, action, ids, **kwargs):
+            assert action == 'wbformatentities'
+            self.format_calls += 1
+            return {'wbformatentities': {
+                entity_id: f'<a>label v{self.format_calls}</a>'
+                for entity_id in ids
+            }}
+    for cache in [wbformat.format_entity_cache, wbformat.format_value_cache]:
+        monkeypatch.setattr(cache, 'ttl', 0.05)
+        monkeypatch.setattr(cache, 'max_stale', 10)
+    session = FakeSession()
+    value = {'type': 'wikibase-entityid',
+             'value': {'entity-type': 'item', 'id': 'Q1'}}
+    key = wbformat.format_value_key(session, 'en', 'P1', value)
+    wbformat.prefetch_values(session, 'en', [('P1', value)])
+    formatted, ttl = wbformat.format_value_cache.get_with_ttl(key)
+    assert formatted == Markup('<span>label v1</span>')
+    assert ttl <= 0.05  # not longer than the entity it was formatted from
+    time.sleep(0.06)
+    # the stale entity is fetched again instead of copied with a fresh TTL
+    wbformat.prefetch_values(session, 'en', [('P1', value)])
+    assert session.format_calls == 2
+    assert wbformat.format_value(session, 'en', 'P1', value) == \
+        Markup('<span>label v2</span>')
+
+
+@pytest.mark.parametrize('value, expected', [
+    ({'type': 'wikibase-entityid',
+      'value': {'entity-type': 'item', 'numeric-id': 1, 'id': 'Q1'}},
+     'Q1'),
+    ({'type': 'wikibase-entityid',
+      'value': {'entity-type': 'property', 'numeric-id': 2, 'id': 'P2'}},
+     'P2'),
+    ({'type': 'wikibase-entityid',
+      'value': {'entity-type': 'lexeme', 'numeric-id': 3, 'id': 'L3'}},
+     'L3'),
+    ({'type': 'wikibase-entityid',
+      'value': {'entity-type': 'form', 'id': 'L3-F1'}},
+     None),
+    ({'type': 'string', 'value': 'Q1'}, None),
+])
+def test_value_entity_id(value, expected):
+    assert wbformat.value_entity_id(value) == expected
+
+
+def test_prefetch_values_concurrent():
+    class FakeSession:
+        host = 'concurrent host'
+        active = 0
+        max_active = 0
+        lock = threading.Lock()
+
+        def get_filtered(self, spec, action, **kwargs):
+            assert action == 'wbgetentities'
+            return {'entities': {'P1': {'datatype': 'commonsMedia'}}}
+
+        def get(self, action, datavalue=None, **kwargs):
+            assert action == 'wbformatvalue'
+            with self.lock:
+                self.active += 1
+                self.max_active = max(self.max_active, self.active)
+            time.sleep(0.05)
+            with self.lock:
+                self.active -= 1
+            return {'result': f'formatted {datavalue}'}
+    session = FakeSession()
+    values = [('P1', {'type': 'string', 'value': f'v{i}'}) for i in range(10)]
+    wbformat.prefetch_values(session, 'en', values)
+    assert 1 < session.max_active <= wbformat.max_requests_per_host
+    for property_id, value in values:
+        key = wbformat.format_value_key(session, 'en', property_id, value)
+        assert key in wbformat.format_value_cache
+
+
+def test_submit_slow_host_does_not_block_others():
+    blocked = threading.Event()
+    slow_futures = [wbformat._submit('slow host', blocked.wait, 5)
+                    for _ in range(2 * wbformat.max_requests_per_host)]
+    try:
+        future = wbformat._submit('fast host', lambda: 'done')
+        assert future.result(timeout=1) == 'done'
+    finally:
+        blocked.set()
+    concurrent.futures.wait(slow_futures)
+
+
+def test_prefetch_entities_failed_chunk():
+    class FakeSession:
+        host = 'failed chunk host'
+
+        def get(self, ids, **kwargs):
+            if 'Q1' in ids:
+                raise mwapi.errors.APIError('internal_api_error', '', '')
+            return {'wbformatentities': {
+                entity_id: f'label of {entity_id}' for entity_id in ids
+            }}
+    session = FakeSession()
+    entity_ids = [f'Q{id}' for id in range(1, 101)]
+    wbformat.prefetch_entities(session, 'en', entity_ids)
+    for id in range(1, 51):
+        key = ('failed chunk host', 'en', f'Q{id}')
+        assert key not in wbformat.format_entity_cache
+    for id in range(51, 101):
+        key = ('failed chunk host', 'en', f'Q{id}')
+        assert wbformat.format_entity_cache[key] == f'label of Q{id}'
+
+
+class SlowEntitySession:
+    host = 'slow host'
+
+    def __init__(self):
+        self.get_calls = 0
+        self.lock = threading.Lock()
+
+    def get(self, ids, **kwargs):
+        with self.lock:
+            self.get_calls += 1
+        time.sleep(0.1)
+        return {'wbformatentities': {
+            entity_id: f'label of {entity_id}' for entity_id in ids
+        }}
+
+
+def test_format_entity_single_flight():
+    session = SlowEntitySession()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        wbformat.format_entity(session, 'single-flight', 'Q1')))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert session.get_calls == 1
+    assert results == ['label of Q1'] * 5
+
+
+def test_prefetch_entities_single_flight_with_format_entity():
+    session = SlowEntitySession()
+    prefetch = threading.Thread(target=wbformat.prefetch_entities,
+                                args=(session, 'prefetch-flight', ['Q1']))
+    prefetch.start()
+    time.sleep(0.02)  # let the prefetch claim Q1
+    assert wbformat.format_entity(session, 'prefetch-flight', 'Q1') \
+        == 'label of Q1'
+    prefetch.join()
+    assert session.get_calls == 1
+
+
+def test_format_cache_shared_between_workers(tmp_path):
+    shared_cache = sharedcache.SQLiteCache(str(tmp_path / 'cache.sqlite3'))
+    calls = []
+
+    def worker_format_entity():
+        # each worker process has its own FormatCache and format function
+        cache = wbformat.FormatCache('test', maxbytes=10000, ttl=60)
+        cache.shared_cache = shared_cache
+
+        @cache.cached(key=lambda entity_id: ('host', entity_id))
+        def format_entity(entity_id):
+            calls.append(entity_id)
+            return Markup(f'label of {entity_id}')
+        return format_entity
+
+    assert worker_format_entity()('Q1') == Markup('label of Q1')
+    assert worker_format_entity()('Q1') == Markup('label of Q1')
+    assert calls == ['Q1']
+
+
+def test_format_cache_claim_shared(tmp_path):
+    shared_cache = sharedcache.SQLiteCache(str(tmp_path / 'cache.sqlite3'))
+    cache = wbformat.FormatCache('test', maxbytes=10000, ttl=60)
+    cache.shared_cache = shared_cache
+    cache.update({('host', 'a'): Markup('A')})
+    other_cache = wbformat.FormatCache('test', maxbytes=10000, ttl=60)
+    other_cache.shared_cache = shared_cache
+    claimed, pending = other_cache.claim([('host', 'a'), ('host', 'b')])
+    assert claimed == [('host', 'b')]
+    assert pending == []
+    assert other_cache[('host', 'a')] == Markup('A')
+    other_cache.release(claimed)
+
+
+def test_format_cache_shared_keeps_expiry(tmp_path):
+    shared_cache = sharedcache.SQLiteCache(str(tmp_path / 'cache.sqlite3'))
+    cache = wbformat.FormatCache('test', maxbytes=10000, ttl=60)
+    cache.shared_cache = shared_cache
+    # stored by another worker almost a TTL ago
+    shared_cache.set_many([(cache._shared_key(('host', 'a')), 'A')],
+                          ttl=0.05)
+    claimed, pending = cache.claim([('host', 'a')])
+    assert claimed == []
+    assert cache[('host', 'a')] == Markup('A')
+    time.sleep(0.06)
+    assert ('host', 'a') not in cache
+
+
+def test_label_store_shared_keeps_expiry(tmp_path):
+    shared_cache = sharedcache.SQLiteCache(str(tmp_path / 'cache.sqlite3'))
+    store = wbformat.LabelStore(maxbytes=10000, ttl=60)
+    store.shared_cache = shared_cache
+    shared_cache.set_many([(store._shared_key('host', 'Q1'),
+                            '{"en": "label"}')],
+                          ttl=0.05)
+    assert store.missing('host', ['Q1']) == []
+    assert store.get('host', 'Q1') == {'en': 'label'}
+    time.sleep(0.06)
+    assert store.get('host', 'Q1') is None
+
+
+def stale_cache_and_function(max_stale: float):
+    cache = wbformat.FormatCache('stale', maxbytes=10000, ttl=0.05)
+    cache.max_stale = max_stale
+    calls = []
+    lock = threading.Lock()
+
+    @cache.cached(key=lambda entity_id: ('host', entity_id))
+    def format_entity(entity_id):
+        time.sleep(0.01)
+        with lock:
+            calls.append(entity_id)
+            return Markup(f'{entity_id} v{len(calls)}')
+    return format_entity, calls
+
+
+def test_format_cache_stale_while_revalidate():
+    format_entity, calls = stale_cache_and_function(max_stale=10)
+    assert format_entity('Q1') == 'Q1 v1'
+    time.sleep(0.06)
+    # expired: the stale value is returned, refreshed in the background
+    results = [format_entity('Q1') for _ in range(5)]
+    assert results == ['Q1 v1'] * 5
+    time.sleep(0.04)
+    assert format_entity('Q1') == 'Q1 v2'
+    assert len(calls) == 2
+
+
+def test_format_cache_max_stale():
+    format_entity, calls = stale_cache_and_function(max_stale=0.05)
+    assert format_entity('Q1') == 'Q1 v1'
+    time.sleep(0.11)
+    # too stale: fetched again synchronously
+    assert format_entity('Q1') == 'Q1 v2'
+    assert len(calls) == 2
+
+
+def test_format_cache_no_stale_by_default():
+    format_entity, calls = stale_cache_and_function(max_stale=0)
+    assert format_entity('Q1') == 'Q1 v1'
+    time.sleep(0.06)
+    assert format_entity('Q1') == 'Q1 v2'
+
+
+def test_format_cache_bytes_bounded():
+    small = Markup('x')
+    large = Markup('x' * 2000)
+    small_size = wbformat._entry_size(('host', 'Q1'), small)
+    large_size = wbformat._entry_size(('host', 'Q0'), large)
+    maxbytes = large_size + 3 * small_size
+    cache = wbformat.FormatCache('bounded', maxbytes=maxbytes, ttl=60)
+    cache.update({('host', 'Q0'): large})
+    cache.update({('host', f'Q{id}'): small for id in range(1, 4)})
+    assert cache.occupancy()['host'] == {
+        'entries': 4,
+        'bytes': maxbytes,
+        'maxbytes': maxbytes,
+    }
+    # one more small entry evicts the least recently used (large) one
+    cache.update({('host', 'Q4'): small})
+    assert ('host', 'Q0') not in cache
+    assert cache.occupancy()['host']['entries'] == 4
+
+
+def test_format_cache_wiki_maxbytes():
+    cache = wbformat.FormatCache('per wiki', maxbytes=10000, ttl=60)
+    cache.wiki_maxbytes = {'small.example': 100}
+    value = Markup('x' * 200)
+    cache.update({('https://small.example', 'Q1'): value,
+                  ('https://large.example', 'Q1'): value})
+    assert ('https://small.example', 'Q1') not in cache
+    assert cache[('https://large.example', 'Q1')] == value
+    assert cache.occupancy()['https://small.example']['maxbytes'] == 100
+
+
+def test_format_value_key_compact():
+    class FakeSession:
+        host = 'host'
+    value = {'type': 'string', 'value': 'x' * 10000}
+    key = wbformat.format_value_key(FakeSession(), 'en', 'P1', value)
+    assert key[:3] == ('host', 'en', 'P1')
+    assert len(key[3]) == 32
+    reordered_value = {'value': 'x' * 10000, 'type': 'string'}
+    assert wbformat.format_value_key(FakeSession(), 'en', 'P1',
+                                     reordered_value) == key
+
+
+@pytest.mark.parametrize('lang, expected', [
+    ('en', []),
+    ('en-gb', ['en']),
+    ('de', ['en']),
+    ('de-formal', ['de', 'en']),
+    ('gsw', ['de', 'en']),
+    ('lb', ['de', 'en']),
+    ('sr-ec', ['sr-cyrl', 'en']),
+    ('xyz-unknown', ['en']),
+])
+def test_fallback_languages(lang, expected):
+    assert wbformat.fallback_languages(lang) == expected
+
+
+def test_format_cache_aliases_fallback_language():
+    cache = wbformat.FormatCache('aliases', maxbytes=100000, ttl=60)
+    value = Markup('<a>Berlin</a>' * 100)
+    cache.update({('host', 'de', 'Q64'): value})
+    size = cache.occupancy()['host']['bytes']
+    cache.update({('host', 'de-at', 'Q64'): Markup(str(value)),
+                  ('host', 'de-formal', 'Q64'): Markup(str(value)),
+                  ('host', 'de-ch', 'Q64'): Markup('<a>Bärlin</a>')})
+    assert cache[('host', 'de-at', 'Q64')] is value
+    assert cache[('host', 'de-formal', 'Q64')] is value
+    assert cache[('host', 'de-ch', 'Q64')] == Markup('<a>Bärlin</a>')
+    deduplication = cache.deduplication()['host']
+    assert deduplication['aliases'] == 2
+    assert deduplication['bytes_saved'] == 2 * sys.getsizeof(value)
+    assert cache.occupancy()['host']['bytes'] < 2 * size
+
+
+def test_format_cache_aliases_removed_with_target():
+    cache = wbformat.FormatCache('aliases', maxbytes=100000, ttl=60)
+    value = Markup('<a>Berlin</a>' * 100)
+    cache.update({('host', 'de', 'Q64'): value})
+    cache.update({('host', 'de-at', 'Q64'): Markup(str(value))})
+    with cache.lock:
+        del cache.caches['host'][('host', 'de', 'Q64')]
+    assert ('host', 'de-at', 'Q64') not in cache
+    assert cache.occupancy()['host'] == {'entries': 0, 'bytes': 0,
+                                         'maxbytes': 100000}
+
+    # replacing the target’s value also removes its aliases
+    cache.update({('host', 'de', 'Q64'): value})
+    cache.update({('host', 'de-at', 'Q64'): Markup(str(value))})
+    cache.update({('host', 'de', 'Q64'): Markup('<a>Berlin!</a>')})
+    assert ('host', 'de-at', 'Q64') not in cache
+
+
+def test_format_cache_aliases_evicted_with_target():
+    value = Markup('<a>Berlin</a>' * 100)
+    entry_size = wbformat._entry_size(('host', 'de', 'Q64'), value)
+    cache = wbformat.FormatCache('aliases', maxbytes=2 * entry_size, ttl=60)
+    cache.update({('host', 'de', 'Q64'): value})
+    cache.update({('host', 'de-at', 'Q64'): Markup(str(value))})
+    # evicts the least recently used entry, the target
+    cache.update({('host', 'de', 'Q1'): Markup(str(value).upper())})
+    assert ('host', 'de', 'Q64') not in cache
+    assert ('host', 'de-at', 'Q64') not in cache
+    assert ('host', 'de', 'Q1') in cache
+
+
+def test_format_cache_aliases_expire_with_target():
+    cache = wbformat.FormatCache('aliases', maxbytes=100000, ttl=0.05)
+    value = Markup('<a>Berlin</a>' * 100)
+    cache.update({('host', 'de', 'Q64'): value})
+    time.sleep(0.03)
+    cache.update({('host', 'de-at', 'Q64'): Markup(str(value))})
+    time.sleep(0.03)
+    cache.update({('host', 'de', 'Q1'): Markup('<a>Earth</a>')})  # expires
+    assert ('host', 'de-at', 'Q64') not in cache
+    assert cache.occupancy()['host']['entries'] == 1
+
+
+# typical wbformatvalue outputs, one per data type (plus some edge cases)
+formatted_values_corpus = [
+    '<a title="Q64" href="/wiki/Q64">Berlin</a>',
+    '<a title="Property:P31" href="/wiki/Property:P31">instance of</a>',
+    '<a title="Lexeme:L1" href="/wiki/Lexeme:L1">'
+    '<span class="mw-content-ltr" lang="sv" dir="ltr">ord</span></a>',
+    '&lt;script&gt;alert("!Mediengruppe Bitnik");&lt;/script&gt;',
+    '<a class="wb-external-id external" '
+    'href="https://viaf.org/viaf/122203256/?a=1&amp;b=2" '
+    'rel="nofollow">122203256</a>',
+    '<a rel="nofollow" class="external free" '
+    'href="https://example.org/?q=a&amp;b=c">'
+    'https://example.org/?q=a&amp;b=c</a>',
+    '<span lang="de" class="wb-monolingualtext-value">Berlin</span> '
+    '<span class="wb-monolingualtext-language-name" dir="auto">'
+    '(German)</span>',
+    '3,677,472<span class="wb-unit"></span>',
+    '1,234±5 <a href="http://www.wikidata.org/entity/Q11573">metre</a>',
+    '1 January 2020<sup class="wb-calendar-name">Gregorian</sup>',
+    "52°31'N, 13°23'E",
+    '<a class="extiw" '
+    'href="//commons.wikimedia.org/wiki/File:Berlin_Montage_4.jpg">'
+    'Berlin Montage 4.jpg</a>',
+    '<span class="mwe-math-element"><span class="mwe-math-mathml-inline '
+    'mwe-math-mathml-a11y" style="display: none;"><math '
+    'xmlns="http://www.w3.org/1998/Math/MathML"><semantics><msup><mi>x'
+    '</mi><mn>2</mn></msup></semantics></math></span><img '
+    'src="https://wikimedia.org/api/rest_v1/media/math/render/svg/8a1" '
+    'class="mwe-math-fallback-image-inline" aria-hidden="true" '
+    'style="vertical-align: -0.338ex;" alt="x^{2}"></span>',
+    'Sch&ouml;neberg&nbsp;&#8211;&#x2014; &amp; &quot;quotes&quot;',
+    '<a title="It\'s &quot;quoted&quot;" href="/wiki/Q1">both</a>',
+    '<a title=\'say "hi"\' href=/wiki/Q2 data-empty>unquoted</a>',
+    '<a href="/wiki/Q3" href="/wiki/Q4" title="a" title="b">dupes</a>',
+    '<br><span/><!-- comment --><b>unclosed <i>nested',
+    'stray </b> end tag</i> <b><i>misnested</b></i>',
+]
+
+
+@pytest.mark.parametrize('html', formatted_values_corpus)
+def test_links_to_spans_same_as_beautifulsoup(html):
+    soup = BeautifulSoup(html, features='html.parser')
+    for link in soup.find_all('a'):
+        link.name = 'span'
+        del link['href']
+    assert wbformat.links_to_spans(html) == Markup(soup)
+
+
+def test_links_to_spans():
+    html = '<a title="Q64" href="/wiki/Q64">Berlin</a>'
+    expected = Markup('<span title="Q64">Berlin</span>')
+    assert wbformat.links_to_spans(html) == expected
+
+
+class FakeDatatypeSession:
+    host = 'datatype host'
+
+    def __init__(self):
+        self.actions = []
+
+    def get_filtered(self, spec, action, **kwargs):
+        self.actions.append(action)
+        assert action == 'wbgetentities'
+        assert kwargs['props'] == ['datatype', 'claims']
+        properties = {
+            'P1': ('string', []),
+            'P2': ('external-id', []),
+            'P3': ('url', []),
+            'P4': ('commonsMedia', []),
+            'P6': ('external-id', ['P1630']),
+        }
+        entities = {}
+        for property_id in kwargs['ids']:
+            datatype, claim_property_ids = properties[property_id]
+            # like wbgetentities, no statements are claims: []
+            claims = {claim_property_id: [{'rank': 'normal'}]
+                      for claim_property_id in claim_property_ids} or []
+            entities[property_id] = {'id': property_id,
+                                     'datatype': datatype,
+                                     'claims': claims}
+        return {'entities': entities}
+
+
+@pytest.fixture
+def formatter_url_property(monkeypatch):
+    monkeypatch.setattr(wbformat, 'formatter_url_properties',
+                        {FakeDatatypeSession.host: 'P1630'})
+
+
+@pytest.mark.parametrize('property_id, value, expected', [
+    ('P1', {'type': 'string', 'value': '<b>"a" & \'b\'</b>'},
+     Markup('&lt;b&gt;"a" &amp; \'b\'&lt;/b&gt;')),
+    ('P2', {'type': 'string', 'value': '0000-0002-1825-0097'},
+     Markup('<span class="wb-external-id">0000-0002-1825-0097</span>')),
+    ('P3', {'type': 'string', 'value': 'https://example.org/?a=1&b=2'},
+     Markup('<span class="external free" rel="nofollow">'
+            'https://example.org/?a=1&amp;b=2</span>')),
+])
+def test_format_value_locally(formatter_url_property,
+                              property_id, value, expected):
+    session = FakeDatatypeSession()
+    assert wbformat.format_value(session, 'en', property_id, value) \
+        == expected
+    assert set(session.actions) <= {'wbgetentities'}
+
+
+@pytest.mark.parametrize('property_id, value', [
+    ('P4', {'type': 'string', 'value': 'Berlin.jpg'}),
+    ('P5', {'type': 'monolingualtext',
+            'value': {'text': 'Berlin', 'language': 'de'}}),
+    ('P6', {'type': 'string', 'value': '0000-0002-1825-0097'}),
+])
+def test_format_value_locally_other_datatype(formatter_url_property,
+                                             property_id, value):
+    session = FakeDatatypeSession()
+    assert wbformat.format_value_locally(session, 'en', property_id, value) \
+        is None
+
+
+def test_format_value_locally_unknown_formatter_url():
+    class FakeSession:
+        host = 'no formatter URL host'
+
+        def get_filtered(self, spec, action, **kwargs):
+            assert kwargs['props'] == ['datatype']
+            return {'entities': {'P2': {'datatype': 'external-id'}}}
+    value = {'type': 'string', 'value': '0000-0002-1825-0097'}
+    assert wbformat.format_value_locally(FakeSession(), 'en', 'P2', value) \
+        is None
+
+
+def test_property_datatype_error_cached():
+    class FakeSession:
+        host = 'datatype error host'
+        calls = 0
+
+        def get_filtered(self, spec, action, **kwargs):
+            self.calls += 1
+            raise mwapi.errors.ConnectionError('timeout')
+    session = FakeSession()
+    assert wbformat.property_datatype(session, 'P1') is None
+    assert wbformat.property_datatype(session, 'P1') is None
+    assert session.calls == 1
+
+
+def test_prefetch_values_local(monkeypatch):
+    session = FakeDatatypeSession()
+    session.host = 'prefetch values local host'
+    monkeypatch.setattr(wbformat, 'formatter_url_properties',
+                        {session.host: 'P1630'})
+    values = [(f'P{id}', {'type': 'string', 'value': f'v{i}'})
+              for id in [1, 2, 3]
+              for i in range(20)]
+    wbformat.prefetch_values(session, 'en', values)
+    # one batched data type lookup, no wbformatvalue requests
+    assert session.actions == ['wbgetentities']
+
+
+@pytest.mark.parametrize('lang, expected', [
+    ('en', ['en', 'mul']),
+    ('de', ['de', 'mul', 'en']),
+    ('de-at', ['de-at', 'de', 'mul', 'en']),
+    ('en-gb', ['en-gb', 'mul', 'en']),
+    ('gsw', ['gsw', 'de', 'mul', 'en']),
+])
+def test_label_languages(lang, expected):
+    assert wbformat.label_languages(lang) == expected
+
+
+@pytest.mark.parametrize('lang, entity_id, labels, expected', [
+    ('en', 'Q64', {'en': 'Berlin', 'de': 'Berlin'},
+     '<a title="Q64" href="https://labels.example/wiki/Q64">Berlin</a>'),
+    ('de-at', 'Q64', {'en': 'Berlin', 'de': 'Berlin'},
+     '<a title="Q64" href="https://labels.example/wiki/Q64" lang="de">'
+     'Berlin</a>'),
+    ('en', 'P31', {'en': 'instance of'},
+     '<a title="Property:P31" href="https://labels.example/wiki/Property:P31">'
+     'instance of</a>'),
+    ('en', 'Q1', {'en': '<b>&</b>'},
+     '<a title="Q1" href="https://labels.example/wiki/Q1">'
+     '&lt;b&gt;&amp;&lt;/b&gt;</a>'),
+    ('en', 'Q2', {},
+     '<a title="Q2" href="https://labels.example/wiki/Q2">Q2</a>'),
+])
+def test_entity_link(lang, entity_id, labels, expected):
+    class FakeSession:
+        host = 'https://labels.example'
+    assert wbformat.entity_link(FakeSession(), lang, entity_id, labels) \
+        == Markup(expected)
+
+
+def test_format_entity_label_store(monkeypatch):
+    class FakeSession:
+        host = 'https://labels.example'
+
+        def __init__(self):
+            self.calls = []
+
+        def get(self, action, ids, **kwargs):
+            self.calls.append((action, ids))
+            if action == 'wbgetentities':
+                return {'entities': {
+                    'Q64': {'id': 'Q64', 'labels': {
+                        'en': {'language': 'en', 'value': 'Berlin'},
+                        'fr': {'language': 'fr', 'value': 'Berlin (fr)'},
+                    }},
+                    'Q404': {'id': 'Q404', 'missing': ''},
+                }}
+            assert action == 'wbformatentities'
+            return {'wbformatentities': {
+                entity_id: f'formatted {entity_id}' for entity_id in ids
+            }}
+    monkeypatch.setattr(wbformat, 'label_store_hosts', {FakeSession.host})
+    session = FakeSession()
+
+    wbformat.prefetch_entities(session, 'en', ['Q64', 'Q404', 'L1'])
+    assert session.calls == [
+        ('wbgetentities', ['Q64', 'Q404']),
+        ('wbformatentities', ['Q404', 'L1']),
+    ]
+    # the labels serve every interface language
+    assert wbformat.format_entity(session, 'en', 'Q64') == Markup(
+        '<a title="Q64" href="https://labels.example/wiki/Q64">Berlin</a>')
+    assert wbformat.format_entity(session, 'fr', 'Q64') == Markup(
+        '<a title="Q64" href="https://labels.example/wiki/Q64">'
+        'Berlin (fr)</a>')
+    assert wbformat.format_entity(session, 'en', 'Q404') == \
+        Markup('formatted Q404')
+    assert wbformat.format_entity(session, 'en', 'L1') == \
+        Markup('formatted L1')
+    assert len(session.calls) == 2
+
+
+def test_format_cache_metrics():
+    size = wbformat._entry_size(('host', 'en', 'a'), Markup('a'))
+    cache = wbformat.FormatCache('metrics', maxbytes=3 * size, ttl=60)
+
+    @cache.cached(key=lambda value: ('host', 'en', value))
+    def format(value):
+        return Markup(value)
+
+    def sample(metric, *labelvalues):
+        labels = metric._labels(labelvalues)
+        return metric.samples().get((metric.name, labels), 0)
+
+    format('a')
+    format('a')
+    format('b')
+    assert sample(wbformat.cache_hits, 'metrics', 'local') == 1
+    assert sample(wbformat.cache_misses, 'metrics') == 2
+    assert sample(wbformat.cache_evictions, 'metrics') == 0
+    for value in range(10):
+        format(str(value))
+    assert sample(wbformat.cache_evictions, 'metrics') > 0
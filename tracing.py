@@ -0,0 +1,247 @@
+"""Tracing spans for outbound calls, nested under a span per request.
+
+Spans are only recorded if an exporter is configured:
+JSONLExporter appends each finished span to a local file,
+OTLPExporter sends them to a collector using OTLP/HTTP with JSON
+encoding (any local stand-in that accepts such POST requests works).
+
+The current span is kept in a context variable, so spans started
+in the wbformat prefetch thread pool nest under the span that
+submitted the work (see wbformat._submit)."""
+
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from typing import Callable, Iterator, List, Optional, Protocol, TypeVar
+
+import requests
+
+
+F = TypeVar('F', bound=Callable)
+
+
+class Span:
+
+    def __init__(self,
+                 name: str,
+                 parent: Optional['Span'],
+                 kind: str,
+                 attributes: dict):
+        self.name = name
+        self.trace_id: str = \
+            parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id: str = os.urandom(8).hex()
+        self.parent_id: Optional[str] = parent.span_id if parent else None
+        self.kind = kind
+        self.attributes = attributes
+        self.start_time_ns = time.time_ns()
+        self._start = time.perf_counter_ns()
+        self.end_time_ns: Optional[int] = None
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def end(self) -> None:
+        self.end_time_ns = (self.start_time_ns
+                            + time.perf_counter_ns() - self._start)
+
+    def to_dict(self) -> dict:
+        assert self.end_time_ns is not None
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'kind': self.kind,
+            'start_time_ns': self.start_time_ns,
+            'end_time_ns': self.end_time_ns,
+            'duration_ms': (self.end_time_ns - self.start_time_ns) / 1e6,
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+class Exporter(Protocol):
+    def export(self, span: Span) -> None:
+        ...
+
+
+class JSONLExporter:
+    """Append each span as one line of JSON to a file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        line = json.dumps(span.to_dict()) + '\n'
+        try:
+            with self.lock, open(self.path, 'a') as f:
+                f.write(line)
+        except OSError as e:
+            print('caught error while exporting span:', e, file=sys.stderr)
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def _otlp_span(span: Span) -> dict:
+    otlp_span = {
+        'traceId': span.trace_id,
+        'spanId': span.span_id,
+        'name': span.name,
+        # SPAN_KIND_INTERNAL, SPAN_KIND_SERVER, SPAN_KIND_CLIENT
+        'kind': {'internal': 1, 'server': 2, 'client': 3}[span.kind],
+        'startTimeUnixNano': str(span.start_time_ns),
+        'endTimeUnixNano': str(span.end_time_ns),
+        'attributes': [{'key': key, 'value': _otlp_value(value)}
+                       for key, value in span.attributes.items()],
+        # STATUS_CODE_OK, STATUS_CODE_ERROR
+        'status': {'code': 2, 'message': span.error}
+        if span.error is not None else {'code': 1},
+    }
+    if span.parent_id is not None:
+        otlp_span['parentSpanId'] = span.parent_id
+    return otlp_span
+
+
+class OTLPExporter:
+    """Send spans to an OTLP/HTTP collector (JSON encoding),
+    in batches from a background thread.
+
+    endpoint is the full URL, e.g. http://localhost:4318/v1/traces."""
+
+    def __init__(self, endpoint: str, interval: float = 5):
+        self.endpoint = endpoint
+        self.interval = interval
+        self.spans: List[Span] = []
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        self.thread: Optional[threading.Thread] = None
+
+    def export(self, span: Span) -> None:
+        with self.lock:
+            self.spans.append(span)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._flush_forever,
+                                               name='tracing',
+                                               daemon=True)
+                self.thread.start()
+
+    def _flush_forever(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            spans, self.spans = self.spans, []
+        if not spans:
+            return
+        body = {'resourceSpans': [{
+            'resource': {'attributes': [
+                {'key': 'service.name', 'value': {'stringValue': 'ranker'}},
+            ]},
+            'scopeSpans': [{
+                'scope': {'name': 'ranker'},
+                'spans': [_otlp_span(span) for span in spans],
+            }],
+        }]}
+        try:
+            self.session.post(self.endpoint,
+                              json=body,
+                              timeout=5).raise_for_status()
+        except requests.RequestException as e:
+            print('caught error while exporting spans:', e, file=sys.stderr)
+
+
+exporter: Optional[Exporter] = None
+"""The configured exporter; if None, no spans are recorded."""
+
+_current_span: contextvars.ContextVar[Optional[Span]] = \
+    contextvars.ContextVar('current_span', default=None)
+
+
+def from_config(config: dict) -> Optional[Exporter]:
+    """Create the exporter configured in the given app config, if any."""
+    if 'TRACING_JSONL' in config:
+        return JSONLExporter(config['TRACING_JSONL'])
+    if 'TRACING_OTLP_ENDPOINT' in config:
+        return OTLPExporter(config['TRACING_OTLP_ENDPOINT'])
+    return None
+
+
+def start_span(name: str, kind: str = 'internal', **attributes) \
+        -> Optional[contextvars.Token]:
+    """Start a span as a child of the current span (if any)
+    and make it the current span.
+
+    Returns a token to pass to end_span(), or None if not tracing."""
+    if exporter is None:
+        return None
+    return _current_span.set(Span(name, _current_span.get(), kind,
+                                  attributes))
+
+
+def end_span(token: Optional[contextvars.Token],
+             error: Optional[BaseException] = None) -> None:
+    """End the span started by start_span() and export it."""
+    if token is None:
+        return
+    span = _current_span.get()
+    _current_span.reset(token)
+    if span is None:
+        return
+    if error is not None:
+        span.error = f'{type(error).__name__}: {error}'
+    span.end()
+    if exporter is not None:
+        exporter.export(span)
+
+
+@contextlib.contextmanager
+def span(name: str, kind: str = 'internal', **attributes) -> Iterator[None]:
+    """Record a span for the with block (if tracing)."""
+    token = start_span(name, kind, **attributes)
+    try:
+        yield
+    except BaseException as e:
+        end_span(token, e)
+        raise
+    else:
+        end_span(token)
+
+
+def traced(name: str) -> Callable[[F], F]:
+    """Decorate a function to record a span for each call (if tracing)."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def set_attribute(key: str, value) -> None:
+    """Set an attribute on the current span (if tracing)."""
+    span = _current_span.get()
+    if span is not None:
+        span.set_attribute(key, value)
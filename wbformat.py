@@ -1,32 +1,523 @@
-from bs4 import BeautifulSoup
 import cachetools
 from collections.abc import Collection
+import concurrent.futures
+import contextvars
+import functools
+import hashlib
+import html.parser
 import json
+import math
 from markupsafe import Markup
 import mwapi  # type: ignore
+import sys
 import threading
-from typing import List, Tuple
+import time
+from toolforge_i18n import lang_fallbacks
+from typing import Callable, Dict, Iterable, List, Mapping, NamedTuple, \
+    Optional, Set, Tuple, TypeVar
 
+import jsonstream
+import metrics
+import servertiming
+import sharedcache
+import tracing
 
-format_value_cache = cachetools.TTLCache(maxsize=1000,  # type: ignore
-                                         ttl=60 * 60)
-format_value_cache_lock = threading.RLock()
+
+K = TypeVar('K', bound=tuple)
+F = TypeVar('F', bound=Callable)
+
+max_requests_per_host = 4
+"""The maximum number of concurrent prefetch requests to one wiki."""
+
+_executors: Dict[str, concurrent.futures.ThreadPoolExecutor] = {}
+_executors_lock = threading.Lock()
+
+
+def _submit(host: str, fn: Callable, *args) -> concurrent.futures.Future:
+    """Run fn(*args) in the prefetch thread pool of the given host.
+
+    Each host has its own pool of max_requests_per_host threads,
+    so that a slow wiki cannot occupy the threads needed by others."""
+    with _executors_lock:
+        executor = _executors.get(host)
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_requests_per_host,
+                thread_name_prefix=f'wbformat-{host.removeprefix("https://")}',
+            )
+            _executors[host] = executor
+    # run in a copy of the current context, for servertiming
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+cache_hits = metrics.Counter(
+    'ranker_format_cache_hits_total',
+    'Format cache lookups that found a value, by cache and tier '
+    '(local, stale or shared).',
+    ['cache', 'tier'],
+)
+cache_misses = metrics.Counter(
+    'ranker_format_cache_misses_total',
+    'Format cache lookups that had to fetch the value, by cache.',
+    ['cache'],
+)
+cache_evictions = metrics.Counter(
+    'ranker_format_cache_evictions_total',
+    'Format cache entries evicted to make room for others, by cache.',
+    ['cache'],
+)
+cache_fetches = metrics.Histogram(
+    'ranker_format_cache_fetch_duration_seconds',
+    'Duration of fetching values missing from a format cache, by cache.',
+    ['cache'],
+)
+
+
+def _count_hits(cache: str, tier: str, amount: int = 1):
+    cache_hits.inc(cache, tier, amount=amount)
+    if amount:
+        servertiming.record(f'{cache}-cache-hit', None, amount)
+
+
+def _count_misses(cache: str, amount: int = 1):
+    cache_misses.inc(cache, amount=amount)
+    if amount:
+        servertiming.record(f'{cache}-cache-miss', None, amount)
+
+
+class _TLRUCache(cachetools.TLRUCache):
+    """A TLRUCache counting evictions in the cache_evictions metric."""
+
+    def __init__(self, name: str, **kwargs):
+        super().__init__(**kwargs)
+        self.name = name
+
+    def popitem(self):
+        item = super().popitem()
+        cache_evictions.inc(self.name)
+        return item
+
+
+class _AliasingTLRUCache(_TLRUCache):
+    """A _TLRUCache of format cache entries that removes aliases
+    together with the entry they alias.
+
+    An alias shares the value of its target and is only charged
+    the size of its key, so it must not outlive the target
+    (or the target’s value being replaced),
+    otherwise it would keep the value alive without counting it."""
+
+    def __init__(self, name: str, **kwargs):
+        super().__init__(name, **kwargs)
+        self.alias_targets: Dict[tuple, tuple] = {}
+        self.aliases: Dict[tuple, Set[tuple]] = {}
+
+    def _removed(self, key: tuple):
+        """Update the alias bookkeeping after the key was removed
+        (or is about to be replaced), and remove its aliases."""
+        target = self.alias_targets.pop(key, None)
+        if target is not None:
+            target_aliases = self.aliases[target]
+            target_aliases.discard(key)
+            if not target_aliases:
+                del self.aliases[target]
+        for alias in self.aliases.pop(key, ()):
+            del self.alias_targets[alias]
+            self.pop(alias, None)
+
+    def __setitem__(self, key, entry):
+        self._removed(key)
+        super().__setitem__(key, entry)
+        if entry.alias_of is None or key not in self:
+            return
+        if entry.alias_of not in self:
+            # the target was evicted to make room for the alias
+            self.pop(key, None)
+            return
+        self.alias_targets[key] = entry.alias_of
+        self.aliases.setdefault(entry.alias_of, set()).add(key)
+
+    def __delitem__(self, key):
+        try:
+            super().__delitem__(key)
+        finally:
+            self._removed(key)
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for key, entry in expired:
+            self._removed(key)
+        return expired
+
+
+class _Entry(NamedTuple):
+    value: Markup
+    fresh_until: float
+    size: int
+    alias_of: Optional[tuple] = None
+
+
+_entry_overhead = 300
+"""Approximate size in bytes of a cache entry apart from its key and value
+(entry tuple, float, cache bookkeeping)."""
+
+
+def _entry_size(key: tuple, value: Markup) -> int:
+    # the host (key[0]) is shared by all entries and not counted
+    return (_entry_overhead
+            + sys.getsizeof(key)
+            + sum(sys.getsizeof(part) for part in key[1:])
+            + sys.getsizeof(value))
+
+
+def fallback_languages(lang: str) -> List[str]:
+    """Get the language fallback chain of the given language
+    (excluding the language itself) according to MediaWiki,
+    ending in English, e.g. gsw → de → en."""
+    fallbacks = lang_fallbacks(lang)
+    if lang != 'en' and 'en' not in fallbacks:
+        fallbacks = [*fallbacks, 'en']
+    return fallbacks
+
+
+class FormatCache:
+    """A TTL cache of formatted values, shared by all threads.
+
+    Keys are tuples starting with the wiki host and the language.
+    Each wiki gets its own cache, bounded by the approximate size
+    of its entries in bytes (maxbytes, or wiki_maxbytes[domain]);
+    the least recently used entries are evicted first.
+
+    Lookups of missing keys are coalesced (“single-flight”):
+    while one thread is fetching the value for a key
+    (via a function decorated with cached(),
+    or after claiming the key with claim()),
+    other threads looking up the same key wait for its result
+    instead of sending an identical API request.
+
+    If max_stale is set (in seconds), entries are kept for that long
+    after their TTL has expired, and functions decorated with cached()
+    return such stale values immediately while refreshing them
+    in the background (at most one refresh per key at a time).
+
+    If a shared cache is configured (see the sharedcache module),
+    it is used as a second tier behind the per-process cache,
+    so that values fetched by one worker can be used by all of them.
+
+    If a value is identical to the cached value of the same key
+    in a fallback language (e.g. de-at and de without an Austrian label),
+    the entry is stored as an alias sharing the fallback’s value,
+    and only the key is counted towards the size of the cache;
+    aliases are removed together with the entry they alias."""
+
+    def __init__(self, name: str, maxbytes: int, ttl: float):
+        self.name = name
+        self.maxbytes = maxbytes
+        self.wiki_maxbytes: Dict[str, int] = {}
+        self.ttl = ttl
+        self.max_stale = 0.0
+        self.caches: Dict[str, cachetools.TLRUCache] = {}
+        self.lock = threading.RLock()
+        self.condition = threading.Condition(self.lock)
+        self.pending: Set[tuple] = set()
+        self.refreshing: Set[tuple] = set()
+        self.shared_cache: Optional[sharedcache.SharedCache] = None
+        self.aliases: Dict[str, Dict[str, int]] = {}
+
+    def _ttu(self, key: tuple, entry: _Entry, now: float) -> float:
+        return entry.fresh_until + self.max_stale
+
+    def _cache(self, key: tuple) -> cachetools.TLRUCache:
+        """Get the cache for the wiki of the given key.
+
+        The caller must hold the lock."""
+        host = key[0]
+        cache = self.caches.get(host)
+        if cache is None:
+            maxbytes = self.wiki_maxbytes.get(host.removeprefix('https://'),
+                                              self.maxbytes)
+            cache = _AliasingTLRUCache(self.name,
+                                       maxsize=maxbytes,
+                                       ttu=self._ttu,
+                                       timer=time.monotonic,
+                                       getsizeof=lambda entry: entry.size)
+            self.caches[host] = cache
+        return cache
+
+    def _get_entry(self, key: tuple) -> Optional[_Entry]:
+        """Get the entry for the given key, if any.
+
+        The caller must hold the lock."""
+        cache = self._cache(key)
+        entry = cache.get(key)
+        if entry is not None and entry.alias_of is not None:
+            # also mark the aliased entry as recently used,
+            # so that it is not evicted before its aliases
+            cache.get(entry.alias_of)
+        return entry
+
+    def _store(self, values: Iterable[Tuple[tuple, Markup, float]]):
+        """Store the given (key, value, TTL) triples in this cache.
+
+        The TTL is usually self.ttl, or less for values from the
+        shared cache, which expire locally when they expire there."""
+        now = time.monotonic()
+        with self.lock:
+            for key, value, ttl in values:
+                fresh_until = now + ttl
+                cache = self._cache(key)
+                size = _entry_size(key, value)
+                alias_of = None
+                for fallback_language in fallback_languages(key[1]):
+                    fallback_key = (key[0], fallback_language, *key[2:])
+                    fallback_entry = cache.get(fallback_key)
+                    if fallback_entry is not None \
+                            and fallback_entry.value == value:
+                        value = fallback_entry.value
+                        alias_of = fallback_key
+                        size -= sys.getsizeof(value)
+                        aliases = self.aliases.setdefault(key[0], {
+                            'aliases': 0,
+                            'bytes_saved': 0,
+                        })
+                        aliases['aliases'] += 1
+                        aliases['bytes_saved'] += sys.getsizeof(value)
+                        break
+                entry = _Entry(value, fresh_until, size, alias_of)
+                try:
+                    cache[key] = entry
+                except ValueError:
+                    pass  # larger than the whole cache, don’t cache it
+
+    def occupancy(self) -> Dict[str, Dict[str, int]]:
+        """Get the number of entries and their approximate total size
+        (and the maximum size) in bytes of the cache for each wiki."""
+        with self.lock:
+            return {
+                host: {
+                    'entries': len(cache),
+                    'bytes': int(cache.currsize),
+                    'maxbytes': int(cache.maxsize),
+                }
+                for host, cache in self.caches.items()
+            }
+
+    def deduplication(self) -> Dict[str, Dict[str, int]]:
+        """Get the number of entries stored as aliases of a fallback
+        language’s entry, and the approximate number of bytes saved
+        by not storing their values again, for each wiki (since startup)."""
+        with self.lock:
+            return {host: dict(aliases)
+                    for host, aliases in self.aliases.items()}
+
+    def _shared_key(self, key: tuple) -> str:
+        return json.dumps([self.name, key])
+
+    def _get_shared(self,
+                    keys: Collection[K]) -> Dict[K, Tuple[Markup, float]]:
+        """Get the values of the given keys from the shared cache,
+        with their remaining TTL."""
+        if self.shared_cache is None or not keys:
+            return {}
+        shared_keys = {self._shared_key(key): key for key in keys}
+        values = self.shared_cache.get_many(shared_keys)
+        now = time.time()
+        return {shared_keys[shared_key]: (Markup(value), expires - now)
+                for shared_key, (value, expires) in values.items()}
+
+    def __contains__(self, key: tuple) -> bool:
+        with self.lock:
+            return key in self._cache(key)
+
+    def __getitem__(self, key: tuple) -> Markup:
+        with self.lock:
+            entry = self._get_entry(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry.value
+
+    def __setitem__(self, key: tuple, value: Markup):
+        self.update({key: value})
+
+    def get(self, key: tuple) -> Optional[Markup]:
+        with self.lock:
+            entry = self._get_entry(key)
+        return entry.value if entry is not None else None
+
+    def get_with_ttl(self, key: tuple) -> Optional[Tuple[Markup, float]]:
+        """Get the value of the given key and its remaining TTL
+        (negative if the value is stale), if any."""
+        with self.lock:
+            entry = self._get_entry(key)
+        if entry is None:
+            return None
+        return entry.value, entry.fresh_until - time.monotonic()
+
+    def update(self, values: Mapping[tuple, Markup]):
+        """Store the given values in this cache and the shared cache."""
+        self.update_with_ttls({key: (value, self.ttl)
+                               for key, value in values.items()})
+
+    def update_with_ttls(self,
+                         values: Mapping[tuple, Tuple[Markup, float]]):
+        """Store the given values with their own TTLs
+        in this cache and the shared cache.
+
+        Values derived from other cached values should get the
+        remaining TTL of those, so that they do not outlive them.
+        Such TTLs are rounded down to whole seconds for the shared cache
+        (so that values with similar TTLs are stored together),
+        and values with less than a second left are not shared."""
+        self._store((key, value, ttl)
+                    for key, (value, ttl) in values.items())
+        if self.shared_cache is not None:
+            items_by_ttl: Dict[float, List[Tuple[str, str]]] = {}
+            for key, (value, ttl) in values.items():
+                if ttl != self.ttl:
+                    ttl = math.floor(ttl)
+                    if ttl < 1:
+                        continue
+                items_by_ttl.setdefault(ttl, []).append(
+                    (self._shared_key(key), str(value)))
+            for ttl, items in items_by_ttl.items():
+                self.shared_cache.set_many(items, ttl)
+
+    def claim(self, keys: Iterable[K]) -> Tuple[List[K], List[K]]:
+        """Claim the given keys for fetching.
+
+        Returns the keys that were neither cached (and fresh) nor pending,
+        which are now pending and must be released by the caller
+        (after storing the fetched values),
+        and the keys that were already pending in another thread,
+        which the caller may wait for.
+        Stale keys are claimed like missing ones, so that prefetching
+        never extends the life of a stale value."""
+        claimed: List[K] = []
+        pending: List[K] = []
+        hits = 0
+        now = time.monotonic()
+        with self.lock:
+            for key in keys:
+                if key in self.pending:
+                    pending.append(key)
+                    continue
+                entry = self._get_entry(key)
+                if entry is None or entry.fresh_until <= now:
+                    self.pending.add(key)
+                    claimed.append(key)
+                else:
+                    hits += 1
+        _count_hits(self.name, 'local', amount=hits)
+        shared_values = self._get_shared(claimed)
+        if shared_values:
+            _count_hits(self.name, 'shared', amount=len(shared_values))
+            self._store((key, value, ttl)
+                        for key, (value, ttl) in shared_values.items())
+            self.release(shared_values)
+            claimed = [key for key in claimed if key not in shared_values]
+        _count_misses(self.name, amount=len(claimed))
+        return claimed, pending
+
+    def release(self, keys: Iterable[tuple]):
+        """Release claimed keys, waking up any threads waiting for them."""
+        with self.condition:
+            self.pending.difference_update(keys)
+            self.condition.notify_all()
+
+    def wait(self, keys: Collection[tuple]):
+        """Wait until none of the given keys are pending anymore."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending.isdisjoint(keys))
+
+    def _refresh(self, key: tuple, func: Callable, args: tuple):
+        try:
+            self[key] = func(*args)
+        except Exception as e:
+            print('caught error while refreshing stale value:', e,
+                  file=sys.stderr)
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def cached(self, key: Callable[..., tuple]) -> Callable[[F], F]:
+        """Decorate a function to cache its results (cf. cachetools.cached),
+        coalescing concurrent calls with the same key."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args):
+                k = key(*args)
+                with self.condition:
+                    self.condition.wait_for(lambda: k not in self.pending)
+                    entry = self._get_entry(k)
+                    if entry is None:
+                        self.pending.add(k)
+                    elif entry.fresh_until > time.monotonic():
+                        _count_hits(self.name, 'local')
+                        return entry.value
+                    elif k in self.refreshing:
+                        _count_hits(self.name, 'stale')
+                        return entry.value
+                    else:
+                        self.refreshing.add(k)
+                if entry is not None:
+                    _count_hits(self.name, 'stale')
+                    _submit(k[0], self._refresh, k, func, args)
+                    return entry.value
+                try:
+                    shared_value = self._get_shared([k]).get(k)
+                    if shared_value is not None:
+                        _count_hits(self.name, 'shared')
+                        value, ttl = shared_value
+                        self._store([(k, value, ttl)])
+                        return value
+                    _count_misses(self.name)
+                    start = time.perf_counter()
+                    value = func(*args)
+                    cache_fetches.observe(time.perf_counter() - start,
+                                          self.name)
+                    self[k] = value
+                    return value
+                finally:
+                    self.release([k])
+            return wrapper
+        return decorator
+
+
+format_value_cache = FormatCache('value',
+                                 maxbytes=4 * 1024 * 1024,
+                                 ttl=60 * 60)
 
 
 def format_value_key(session: mwapi.Session,
                      lang: str,
                      property_id: str,
                      value: dict) -> Tuple[str, str, str, str]:
-    return (session.host, lang, property_id, json.dumps(value))
+    # a digest of the value is much smaller than its JSON serialization
+    value_digest = hashlib.blake2b(json.dumps(value, sort_keys=True)
+                                   .encode('utf-8'),
+                                   digest_size=16).hexdigest()
+    return (session.host, lang, property_id, value_digest)
 
 
-@cachetools.cached(cache=format_value_cache,
-                   key=format_value_key,
-                   lock=format_value_cache_lock)
 def format_value(session: mwapi.Session,
                  lang: str,
                  property_id: str,
                  value: dict) -> Markup:
+    """Format the given data value as HTML (with links turned into spans).
+
+    Values of simple data types are formatted locally,
+    all others with the wbformatvalue API (and cached)."""
+    formatted_value = format_value_locally(session, lang, property_id, value)
+    if formatted_value is not None:
+        return formatted_value
+    return _format_value_api(session, lang, property_id, value)
+
+
+@format_value_cache.cached(key=format_value_key)
+def _format_value_api(session: mwapi.Session,
+                      lang: str,
+                      property_id: str,
+                      value: dict) -> Markup:
     response = session.get(
         action='wbformatvalue',
         datavalue=json.dumps(value),
@@ -34,18 +525,470 @@ def format_value(session: mwapi.Session,
         generate='text/html',
         uselang=lang,
     )
-    html = BeautifulSoup(response['result'], features='html.parser')
+    return links_to_spans(response['result'])
+
+
+_void_elements = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link',
+    'meta', 'param', 'source', 'track', 'wbr',
+}
+
+_raw_text_elements = {'script', 'style'}
+
+
+def _escape_text(text: str) -> str:
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _quote_attribute_value(value: str) -> str:
+    value = _escape_text(value)
+    if '"' not in value:
+        return f'"{value}"'
+    if "'" not in value:
+        return f"'{value}'"
+    return '"' + value.replace('"', '&quot;') + '"'
+
+
+class _LinksToSpansParser(html.parser.HTMLParser):
+    """Rewrite HTML in a single pass, turning links into spans.
+
+    The output is serialized the same way as BeautifulSoup
+    with the html.parser builder would serialize it:
+    attributes are sorted by name and double-quoted where possible,
+    character references are decoded and only &, < and > escaped,
+    void elements are self-closed and unclosed elements closed."""
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.parts: List[str] = []
+        self.open_elements: List[str] = []
+
+    def handle_starttag(self, tag, attrs):
+        self._start(tag, attrs)
+        if tag not in _void_elements:
+            self.open_elements.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self._start(tag, attrs)
+        if tag not in _void_elements:
+            self.parts.append(f'</{self._rename(tag)}>')
+
+    def _rename(self, tag: str) -> str:
+        return 'span' if tag == 'a' else tag
+
+    def _start(self, tag: str, attrs: List[Tuple[str, Optional[str]]]):
+        # later duplicate attributes replace earlier ones
+        attributes = {name: value or '' for name, value in attrs}
+        if tag == 'a':
+            attributes.pop('href', None)
+        self.parts.append('<' + self._rename(tag))
+        for name, value in sorted(attributes.items()):
+            self.parts.append(f' {name}={_quote_attribute_value(value)}')
+        self.parts.append('/>' if tag in _void_elements else '>')
+
+    def handle_endtag(self, tag):
+        if tag not in self.open_elements:
+            return  # stray end tag, ignore it
+        while True:
+            open_tag = self.open_elements.pop()
+            self.parts.append(f'</{self._rename(open_tag)}>')
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        if self.open_elements and self.open_elements[-1] in _raw_text_elements:
+            self.parts.append(data)
+        else:
+            self.parts.append(_escape_text(data))
+
+    def handle_comment(self, data):
+        self.parts.append(f'<!--{data}-->')
+
+    def handle_decl(self, decl):
+        self.parts.append(f'<!{decl}>')
+
+    def handle_pi(self, data):
+        self.parts.append(f'<?{data}>')
+
+    def unknown_decl(self, data):
+        if data.upper().startswith('CDATA['):
+            self.parts.append(f'<![CDATA[{data[len("CDATA["):]}]]>')
+        else:
+            self.parts.append(f'<!{data}>')
+
+    def result(self) -> str:
+        self.close()
+        while self.open_elements:
+            self.parts.append(f'</{self._rename(self.open_elements.pop())}>')
+        return ''.join(self.parts)
+
+
+def links_to_spans(html: str) -> Markup:
     # turn links into spans – clicking the value should toggle the checkbox,
     # and also the hrefs returned by Wikibase are relative anyways (T218646)
-    for link in html.find_all('a'):
-        link.name = 'span'
-        del link['href']
-    return Markup(html)
+    parser = _LinksToSpansParser()
+    parser.feed(html)
+    return Markup(parser.result())
+
+
+class _PropertyInfo(NamedTuple):
+    datatype: Optional[str]
+    has_formatter_url: bool
+
+
+formatter_url_properties = {'https://www.wikidata.org': 'P1630'}
+"""The formatter URL property of each host, by host.
+
+External identifiers of properties without a formatter URL
+are formatted locally; on other hosts, they are always formatted
+with wbformatvalue, since the formatter URL is unknown."""
+
+property_datatypes = cachetools.TTLCache(maxsize=10000,  # type: ignore
+                                         ttl=24 * 60 * 60)
+"""The data types of properties, and whether they have a formatter URL,
+as _PropertyInfo by (host, property ID).
+
+A data type of None means that the property has no known data type
+(e.g. it is missing, or looking it up failed)."""
+property_datatypes_lock = threading.Lock()
+
+
+def prefetch_property_datatypes(session: mwapi.Session,
+                                property_ids: Collection[str]):
+    """Look up the data types (and formatter URL statements)
+    of the given properties, in batches of 50.
+
+    Errors are only logged, and cached like unknown data types,
+    so that the values of the properties are formatted
+    with wbformatvalue until the lookup expires."""
+    with property_datatypes_lock:
+        missing_property_ids = sorted({
+            property_id for property_id in property_ids
+            if (session.host, property_id) not in property_datatypes
+        })
+    formatter_url_property = formatter_url_properties.get(session.host)
+    entity_spec: Dict[str, jsonstream.Spec] = {'datatype': True}
+    props = ['datatype']
+    if formatter_url_property is not None:
+        entity_spec['claims'] = {formatter_url_property: True}
+        props.append('claims')
+    for i in range(0, len(missing_property_ids), 50):
+        chunk = missing_property_ids[i:i+50]
+        try:
+            entities = session.get_filtered(
+                {'entities': {'*': entity_spec}},
+                action='wbgetentities',
+                ids=chunk,
+                props=props,
+                formatversion=2,
+            )['entities']
+        except Exception as e:
+            print('caught error while looking up property data types:', e,
+                  file=sys.stderr)
+            entities = {}
+        with property_datatypes_lock:
+            for property_id in chunk:
+                entity = entities.get(property_id, {})
+                claims = entity.get('claims') or {}
+                property_datatypes[(session.host, property_id)] = \
+                    _PropertyInfo(
+                        entity.get('datatype'),
+                        formatter_url_property is None
+                        or bool(claims.get(formatter_url_property)),
+                    )
+
+
+def _property_info(session: mwapi.Session,
+                   property_id: str) -> _PropertyInfo:
+    key = (session.host, property_id)
+    with property_datatypes_lock:
+        if key in property_datatypes:
+            return property_datatypes[key]
+    prefetch_property_datatypes(session, [property_id])
+    with property_datatypes_lock:
+        return property_datatypes.get(key, _PropertyInfo(None, True))
+
+
+def property_datatype(session: mwapi.Session,
+                      property_id: str) -> Optional[str]:
+    return _property_info(session, property_id).datatype
+
+
+def format_value_locally(session: mwapi.Session,
+                         lang: str,
+                         property_id: str,
+                         value: dict) -> Optional[Markup]:
+    """Format a value of a simple data type without the wbformatvalue API,
+    producing the same HTML as the API and links_to_spans() would.
+
+    Returns None for other data types (and unknown properties),
+    including external identifiers of properties with a formatter URL,
+    which are linked with it, and monolingual text,
+    whose language name is wrapped in localized parentheses."""
+    if value['type'] != 'string':
+        return None
+    property_info = _property_info(session, property_id)
+    if property_info.datatype == 'string':
+        return Markup(_escape_text(value['value']))
+    if property_info.datatype == 'url':
+        return Markup(f'<span class="external free" rel="nofollow">'
+                      f'{_escape_text(value["value"])}</span>')
+    if property_info.datatype == 'external-id' \
+            and not property_info.has_formatter_url:
+        return Markup(f'<span class="wb-external-id">'
+                      f'{_escape_text(value["value"])}</span>')
+    return None
+
+
+label_store_hosts = {'https://www.wikidata.org', 'https://test.wikidata.org'}
+"""The hosts whose items and properties are formatted from the label store.
+
+These must be Wikibase repositories with items in the main namespace
+and properties in the Property namespace."""
+
+
+class _Labels(NamedTuple):
+    labels: Dict[str, str]
+    expires: float
+    size: int
+
+
+def _labels_size(labels: Dict[str, str]) -> int:
+    return (_entry_overhead
+            + sys.getsizeof(labels)
+            + sum(sys.getsizeof(language) + sys.getsizeof(label)
+                  for language, label in labels.items()))
+
+
+class LabelStore:
+    """The labels of items and properties in all languages,
+    by host and entity ID, shared by all threads.
+
+    One wbgetentities request for an entity serves every interface
+    language, since the links are rendered locally (see entity_link).
+    Like FormatCache, each wiki gets its own TTL cache bounded by the
+    approximate size of its entries in bytes, and a shared cache
+    can be configured as a second tier."""
+
+    def __init__(self, maxbytes: int, ttl: float):
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.caches: Dict[str, cachetools.TLRUCache] = {}
+        self.lock = threading.Lock()
+        self.shared_cache: Optional[sharedcache.SharedCache] = None
+
+    def _cache(self, host: str) -> cachetools.TLRUCache:
+        """Get the cache for the given wiki.
+
+        The caller must hold the lock."""
+        cache = self.caches.get(host)
+        if cache is None:
+            cache = _TLRUCache('labels',
+                               maxsize=self.maxbytes,
+                               ttu=lambda key, entry, now: entry.expires,
+                               timer=time.monotonic,
+                               getsizeof=lambda entry: entry.size)
+            self.caches[host] = cache
+        return cache
+
+    def _store(self, host: str,
+               labels: Iterable[Tuple[str, Dict[str, str], float]]):
+        """Store the given (entity ID, labels, TTL) triples in this store.
+
+        The TTL is usually self.ttl, or less for labels from the
+        shared cache, which expire locally when they expire there."""
+        now = time.monotonic()
+        with self.lock:
+            cache = self._cache(host)
+            for entity_id, entity_labels, ttl in labels:
+                try:
+                    cache[entity_id] = _Labels(entity_labels,
+                                               now + ttl,
+                                               _labels_size(entity_labels))
+                except ValueError:
+                    pass  # larger than the whole cache, don’t cache it
+
+    def _shared_key(self, host: str, entity_id: str) -> str:
+        return json.dumps(['labels', host, entity_id])
+
+    def get(self, host: str, entity_id: str) -> Optional[Dict[str, str]]:
+        with self.lock:
+            entry = self._cache(host).get(entity_id)
+        return entry.labels if entry is not None else None
+
+    def get_with_ttl(self, host: str, entity_id: str) \
+            -> Optional[Tuple[Dict[str, str], float]]:
+        """Get the labels of the given entity and their remaining TTL,
+        if any."""
+        with self.lock:
+            entry = self._cache(host).get(entity_id)
+        if entry is None:
+            return None
+        return entry.labels, entry.expires - time.monotonic()
+
+    def update(self, host: str, labels: Mapping[str, Dict[str, str]]):
+        """Store the given labels in this store and the shared cache."""
+        self._store(host, ((entity_id, entity_labels, self.ttl)
+                           for entity_id, entity_labels in labels.items()))
+        if self.shared_cache is not None:
+            self.shared_cache.set_many(
+                [(self._shared_key(host, entity_id), json.dumps(entity_labels))
+                 for entity_id, entity_labels in labels.items()],
+                self.ttl,
+            )
 
+    def occupancy(self) -> Dict[str, Dict[str, int]]:
+        """Get the number of entries and their approximate total size
+        (and the maximum size) in bytes of the store for each wiki."""
+        with self.lock:
+            return {
+                host: {
+                    'entries': len(cache),
+                    'bytes': int(cache.currsize),
+                    'maxbytes': int(cache.maxsize),
+                }
+                for host, cache in self.caches.items()
+            }
 
-format_entity_cache = cachetools.TTLCache(maxsize=1000,  # type: ignore
-                                          ttl=60 * 60)
-format_entity_cache_lock = threading.RLock()
+    def missing(self, host: str, entity_ids: Iterable[str]) -> List[str]:
+        """Get the entity IDs whose labels are not in the store,
+        after looking for them in the shared cache."""
+        with self.lock:
+            cache = self._cache(host)
+            entity_ids = list(dict.fromkeys(entity_ids))
+            missing = [entity_id for entity_id in entity_ids
+                       if entity_id not in cache]
+        _count_hits('labels', 'local', amount=len(entity_ids) - len(missing))
+        if self.shared_cache is None or not missing:
+            _count_misses('labels', amount=len(missing))
+            return missing
+        shared_keys = {self._shared_key(host, entity_id): entity_id
+                       for entity_id in missing}
+        now = time.time()
+        shared_labels = {
+            shared_keys[shared_key]: (json.loads(value), expires - now)
+            for shared_key, (value, expires)
+            in self.shared_cache.get_many(shared_keys).items()
+        }
+        self._store(host, ((entity_id, entity_labels, ttl)
+                           for entity_id, (entity_labels, ttl)
+                           in shared_labels.items()))
+        _count_hits('labels', 'shared', amount=len(shared_labels))
+        _count_misses('labels', amount=len(missing) - len(shared_labels))
+        return [entity_id for entity_id in missing
+                if entity_id not in shared_labels]
+
+
+label_store = LabelStore(maxbytes=16 * 1024 * 1024,
+                         ttl=60 * 60)
+
+
+def uses_label_store(session: mwapi.Session, entity_id: str) -> bool:
+    """Whether the given entity is formatted from the label store."""
+    return session.host in label_store_hosts \
+        and entity_id[:1] in {'Q', 'P'} \
+        and entity_id[1:].isascii() \
+        and entity_id[1:].isdigit()
+
+
+@tracing.traced('prefetch_labels')
+def prefetch_labels(session: mwapi.Session,
+                    entity_ids: Collection[str]):
+    """Prefetch the labels of the given entities into the label store."""
+    missing_entity_ids = label_store.missing(session.host, entity_ids)
+    entity_id_chunks = [missing_entity_ids[i:i+50]
+                        for i in range(0, len(missing_entity_ids), 50)]
+    if len(entity_id_chunks) == 1:
+        _prefetch_label_chunk(session, entity_id_chunks[0])
+    elif entity_id_chunks:
+        concurrent.futures.wait([
+            _submit(session.host,
+                    _prefetch_label_chunk,
+                    session,
+                    entity_id_chunk)
+            for entity_id_chunk in entity_id_chunks
+        ])
+
+
+def _prefetch_label_chunk(session: mwapi.Session,
+                          entity_id_chunk: List[str]):
+    """Prefetch the labels of one chunk of up to 50 entities.
+
+    Errors are only logged: entities whose labels are missing
+    are formatted with wbformatentities instead.
+    Missing (e.g. deleted) entities are not stored either,
+    so that wbformatentities can format them appropriately."""
+    start = time.perf_counter()
+    try:
+        entities = session.get(
+            action='wbgetentities',
+            ids=entity_id_chunk,
+            props=['labels'],
+            formatversion=2,
+        )['entities']
+    except Exception as e:
+        print('caught error while prefetching labels:', e, file=sys.stderr)
+        return
+    cache_fetches.observe(time.perf_counter() - start, 'labels')
+    label_store.update(session.host, {
+        entity_id: {language: label['value']
+                    for language, label in entity.get('labels', {}).items()}
+        for entity_id, entity in entities.items()
+        if 'missing' not in entity
+    })
+
+
+def label_languages(lang: str) -> List[str]:
+    """The languages in which a label is looked up for the given
+    interface language, in order: the language, its fallbacks,
+    then the multilingual label and finally English."""
+    return [
+        lang,
+        *[fallback_language for fallback_language in fallback_languages(lang)
+          if fallback_language != 'en'],
+        *[language for language in ['mul', 'en'] if language != lang],
+    ]
+
+
+def entity_link(session: mwapi.Session,
+                lang: str,
+                entity_id: str,
+                labels: Dict[str, str]) -> Markup:
+    """Render a link to the given item or property
+    like wbformatentities would, with the label in the given language
+    (or a fallback language, marked with a lang attribute)."""
+    title = entity_id if entity_id.startswith('Q') else f'Property:{entity_id}'
+    href = f'{session.host}/wiki/{title}'
+    attributes = (f'title={_quote_attribute_value(title)} '
+                  f'href={_quote_attribute_value(href)}')
+    for language in label_languages(lang):
+        label = labels.get(language)
+        if label is not None:
+            if language != lang:
+                attributes += f' lang={_quote_attribute_value(language)}'
+            return Markup(f'<a {attributes}>{_escape_text(label)}</a>')
+    return Markup(f'<a {attributes}>{entity_id}</a>')
+
+
+def _cached_formatted_entity(session: mwapi.Session,
+                             lang: str,
+                             entity_id: str) -> Optional[Tuple[Markup, float]]:
+    """Format the given entity if this needs no API request, else None.
+
+    Also returns the remaining TTL of the labels or formatted entity
+    (negative if the formatted entity is stale)."""
+    if uses_label_store(session, entity_id):
+        labels_with_ttl = label_store.get_with_ttl(session.host, entity_id)
+        if labels_with_ttl is not None:
+            labels, ttl = labels_with_ttl
+            return entity_link(session, lang, entity_id, labels), ttl
+    return format_entity_cache.get_with_ttl(
+        format_entity_key(session, lang, entity_id))
+
+
+format_entity_cache = FormatCache('entity',
+                                  maxbytes=4 * 1024 * 1024,
+                                  ttl=60 * 60)
 
 
 def format_entity_key(session: mwapi.Session,
@@ -54,12 +997,34 @@ def format_entity_key(session: mwapi.Session,
     return (session.host, lang, entity_id)
 
 
-@cachetools.cached(cache=format_entity_cache,
-                   key=format_entity_key,
-                   lock=format_entity_cache_lock)
 def format_entity(session: mwapi.Session,
                   lang: str,
                   entity_id: str) -> Markup:
+    """Format a link to the given entity.
+
+    Items and properties of the label_store_hosts are rendered
+    from the label store, other entities with wbformatentities
+    (and cached); so are entities whose labels could not be fetched."""
+    if uses_label_store(session, entity_id):
+        labels = label_store.get(session.host, entity_id)
+        if labels is not None:
+            _count_hits('labels', 'local')
+        else:
+            formatted_entity = format_entity_cache.get(
+                format_entity_key(session, lang, entity_id))
+            if formatted_entity is not None:
+                return formatted_entity  # e.g. a deleted entity
+            prefetch_labels(session, [entity_id])
+            labels = label_store.get(session.host, entity_id)
+        if labels is not None:
+            return entity_link(session, lang, entity_id, labels)
+    return _format_entity_api(session, lang, entity_id)
+
+
+@format_entity_cache.cached(key=format_entity_key)
+def _format_entity_api(session: mwapi.Session,
+                       lang: str,
+                       entity_id: str) -> Markup:
     response = session.get(
         action='wbformatentities',
         ids=[entity_id],
@@ -69,15 +1034,28 @@ def format_entity(session: mwapi.Session,
     return Markup(response['wbformatentities'][entity_id])
 
 
+@tracing.traced('prefetch_entities')
 def prefetch_entities(session: mwapi.Session,
                       lang: str,
                       entity_ids: Collection[str]):
-    with format_entity_cache_lock:
+    label_store_entity_ids = [entity_id for entity_id in entity_ids
+                              if uses_label_store(session, entity_id)]
+    if label_store_entity_ids:
+        prefetch_labels(session, label_store_entity_ids)
+        # entities whose labels could not be fetched
+        # are prefetched with wbformatentities below
+        entity_ids = [
+            entity_id for entity_id in entity_ids
+            if not uses_label_store(session, entity_id)
+            or label_store.get(session.host, entity_id) is None
+        ]
+    keys = {format_entity_key(session, lang, entity_id): entity_id
+            for entity_id in entity_ids}
+    claimed_keys, pending_keys = format_entity_cache.claim(keys)
+    try:
         entity_id_chunks: List[List[str]] = []
-        for entity_id in entity_ids:
-            key = format_entity_key(session, lang, entity_id)
-            if key in format_entity_cache:
-                continue
+        for key in claimed_keys:
+            entity_id = keys[key]
             if len(entity_id_chunks) == 0:
                 entity_id_chunks.append([entity_id])
             else:
@@ -86,15 +1064,175 @@ def prefetch_entities(session: mwapi.Session,
                     entity_id_chunks.append([entity_id])
                 else:
                     last_chunk.append(entity_id)
-    for entity_id_chunk in entity_id_chunks:
+        if len(entity_id_chunks) == 1:
+            _prefetch_entity_chunk(session, lang, entity_id_chunks[0])
+        else:
+            # fetch the chunks concurrently,
+            # at most max_requests_per_host at a time
+            concurrent.futures.wait([
+                _submit(session.host,
+                        _prefetch_entity_chunk,
+                        session,
+                        lang,
+                        entity_id_chunk)
+                for entity_id_chunk in entity_id_chunks
+            ])
+    finally:
+        format_entity_cache.release(claimed_keys)
+    # entities being fetched by other threads should be ready afterwards too
+    format_entity_cache.wait(pending_keys)
+
+
+def _prefetch_entity_chunk(session: mwapi.Session,
+                           lang: str,
+                           entity_id_chunk: List[str]):
+    """Prefetch one chunk of up to 50 entities.
+
+    Errors are only logged: the entities of a failed chunk
+    are formatted individually by format_entity() later."""
+    start = time.perf_counter()
+    try:
         response = session.get(
             action='wbformatentities',
             ids=entity_id_chunk,
             uselang=lang,
             formatversion=2,
         )['wbformatentities']
-        with format_entity_cache_lock:
-            for entity_id in response:
-                key = format_entity_key(session, lang, entity_id)
-                value = Markup(response[entity_id])
-                format_entity_cache[key] = value
+    except Exception as e:
+        print('caught error while prefetching entities:', e, file=sys.stderr)
+        return
+    cache_fetches.observe(time.perf_counter() - start,
+                          format_entity_cache.name)
+    format_entity_cache.update({
+        format_entity_key(session, lang, entity_id): Markup(formatted_entity)
+        for entity_id, formatted_entity in response.items()
+    })
+
+
+@tracing.traced('refresh_entities')
+def refresh_entities(session: mwapi.Session,
+                     languages: Collection[str],
+                     entity_ids: List[str]):
+    """Fetch the labels or formatted versions (in the given languages)
+    of the given entities and store them, even if they are already
+    cached (i.e. refresh them before they expire)."""
+    label_store_entity_ids = [entity_id for entity_id in entity_ids
+                              if uses_label_store(session, entity_id)]
+    for i in range(0, len(label_store_entity_ids), 50):
+        _prefetch_label_chunk(session, label_store_entity_ids[i:i+50])
+    other_entity_ids = [entity_id for entity_id in entity_ids
+                        if not uses_label_store(session, entity_id)]
+    for lang in languages:
+        for i in range(0, len(other_entity_ids), 50):
+            _prefetch_entity_chunk(session, lang, other_entity_ids[i:i+50])
+
+
+prefetch_entity_types = {'item', 'property', 'lexeme'}
+
+
+def value_entity_id(value: dict) -> Optional[str]:
+    """Get the ID of the entity referenced by the given data value,
+    if it can be formatted via wbformatentities, else None."""
+    if value.get('type') != 'wikibase-entityid':
+        return None
+    entity_value = value['value']
+    if entity_value.get('entity-type') not in prefetch_entity_types:
+        return None
+    return entity_value.get('id')
+
+
+@tracing.traced('prefetch_values')
+def prefetch_values(session: mwapi.Session,
+                    lang: str,
+                    values: Collection[Tuple[str, dict]]):
+    """Prefetch the formatted versions of the given data values.
+
+    values is a collection of (property ID, data value) pairs.
+    Values referencing entities are formatted in batches via
+    wbformatentities (see prefetch_entities) instead of one
+    wbformatvalue request per value; values of simple data types
+    are formatted locally (see format_value_locally), once the
+    data types of their properties are known; other values are
+    formatted concurrently in a bounded thread pool."""
+    keys = {format_value_key(session, lang, property_id, value):
+            (property_id, value)
+            for property_id, value in values}
+    prefetch_property_datatypes(session, {
+        property_id for property_id, value in values
+        if value['type'] == 'string'
+    })
+    entity_values: Dict[Tuple[str, str, str, str], str] = {}
+    futures = []
+    for key, (property_id, value) in keys.items():
+        entity_id = value_entity_id(value)
+        if entity_id is not None:
+            entity_values[key] = entity_id
+        elif format_value_locally(session, lang, property_id, value) \
+                is not None:
+            pass  # no need to prefetch anything
+        elif key not in format_value_cache:
+            futures.append(_submit(session.host,
+                                   _format_value_api,
+                                   session,
+                                   lang,
+                                   property_id,
+                                   value))
+
+    claimed_keys, pending_keys = format_value_cache.claim(entity_values)
+    try:
+        if claimed_keys:
+            _prefetch_entity_values(session,
+                                    lang,
+                                    {key: entity_values[key]
+                                     for key in claimed_keys})
+    finally:
+        format_value_cache.release(claimed_keys)
+    format_value_cache.wait(pending_keys)
+
+    # errors are ignored here – rendering will call format_value() again
+    concurrent.futures.wait(futures)
+
+
+def _prefetch_entity_values(
+        session: mwapi.Session,
+        lang: str,
+        entity_values: Dict[Tuple[str, str, str, str], str],
+):
+    prefetch_entities(session, lang, set(entity_values.values()))
+    formatted_values: Dict[tuple, Tuple[Markup, float]] = {}
+    for key, entity_id in entity_values.items():
+        formatted_entity = _cached_formatted_entity(session, lang, entity_id)
+        if formatted_entity is None:
+            continue
+        formatted, ttl = formatted_entity
+        # expire together with the entity; stale values are left
+        # to format_value(), which fetches them again
+        if ttl > 0:
+            formatted_values[key] = links_to_spans(formatted), ttl
+    format_value_cache.update_with_ttls(formatted_values)
+
+
+def _collect_occupancy(counter: str) -> Dict[Tuple[str, ...], float]:
+    return {
+        (cache_name, host.removeprefix('https://')): host_occupancy[counter]
+        for cache_name, occupancy in [
+            (format_value_cache.name, format_value_cache.occupancy()),
+            (format_entity_cache.name, format_entity_cache.occupancy()),
+            ('labels', label_store.occupancy()),
+        ]
+        for host, host_occupancy in occupancy.items()
+    }
+
+
+metrics.Gauge('ranker_format_cache_entries',
+              'Number of entries in each format cache, by wiki.',
+              ['cache', 'wiki'],
+              functools.partial(_collect_occupancy, 'entries'))
+metrics.Gauge('ranker_format_cache_bytes',
+              'Approximate size of each format cache in bytes, by wiki.',
+              ['cache', 'wiki'],
+              functools.partial(_collect_occupancy, 'bytes'))
+metrics.Gauge('ranker_format_cache_max_bytes',
+              'Maximum size of each format cache in bytes, by wiki.',
+              ['cache', 'wiki'],
+              functools.partial(_collect_occupancy, 'maxbytes'))